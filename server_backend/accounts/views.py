@@ -11,6 +11,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework_simplejwt.views import TokenObtainPairView
 from .serializers import CustomTokenObtainPairSerializer
 from .models import Account
+from server_backend.pagination import keyset_page, page_limit, page_response, prefix_range, streaming_json_response
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
@@ -56,9 +57,21 @@ def register(request):
             }, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+ACCOUNT_LISTING_FIELDS = ('username', 'email', 'userId')
+
 @api_view(['GET'])
 def get_accounts(request):
-    if request.method == 'GET':
-        accounts = Account.objects.all()  # Retrieve all accounts
-        data = accounts.values('username', 'email', 'userId')  # Fetch specific fields
-        return Response(data, status=status.HTTP_200_OK)
\ No newline at end of file
+    # ?q=<prefix> searches usernames; ?limit=N&after=<username> pages in
+    # username order, anything else streams every account for an export
+    # (server_backend/pagination.py)
+    accounts = Account.objects.values(*ACCOUNT_LISTING_FIELDS)
+    prefix = request.GET.get('q')
+    if prefix:
+        accounts = accounts.filter(**prefix_range('username', prefix))
+    try:
+        limit = page_limit(request)
+    except ValueError as error:
+        return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    if limit is None:
+        return streaming_json_response(request, accounts, ACCOUNT_LISTING_FIELDS)
+    return page_response(request, *keyset_page(accounts, 'username', request.GET.get('after'), limit))
\ No newline at end of file
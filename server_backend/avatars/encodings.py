@@ -0,0 +1,123 @@
+# avatars/encodings.py
+"""
+The variants of an image worked out once at ingest and stored next to its
+bytes, a per-process cache of stored blobs, and the bodies of the batch
+endpoint (views.image_batch) built from them.
+"""
+import base64
+import gzip
+import json
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .storage import blob_store
+
+BUNDLE_CONTENT_TYPE = 'application/x-avatar-bundle'
+SVG_COMMENT = re.compile(rb'<!--.*?-->', re.S)
+BETWEEN_TAGS = re.compile(rb'>\s+<')
+WHITESPACE = re.compile(rb'\s+')
+
+
+def minify_svg(data):
+    """
+    `data` without comments and with its whitespace collapsed. Whitespace
+    between tags is only dropped when there is no <text> it could show in,
+    and SVGs carrying scripts or CDATA, or asking for their whitespace to be
+    kept with xml:space, are left as they are.
+    """
+    if b'<script' in data or b'<![CDATA[' in data or b'xml:space' in data:
+        return data
+    data = SVG_COMMENT.sub(b'', data)
+    if b'<text' not in data:
+        data = BETWEEN_TAGS.sub(b'><', data)
+    return WHITESPACE.sub(b' ', data).strip()
+
+
+def derive_variants(image_type, data):
+    """
+    The forms of an image's bytes stored at ingest (Image.variants), so no
+    request has to transform them: base64 for the info and html views and,
+    for SVGs, the minified document and that gzipped. gzip is given a fixed
+    mtime so equal SVGs still share one blob.
+    """
+    variants = {'base64': base64.b64encode(data)}
+    if image_type == 'svg':
+        variants['svg.min'] = minify_svg(data)
+        variants['svg.gz'] = gzip.compress(variants['svg.min'], compresslevel=9, mtime=0)
+    return variants
+
+
+class EncodingCache:
+    """
+    Per-process LRU of stored blobs, variants included, keyed by digest.
+    The bytes under a digest never change, so entries only leave to keep
+    the cache within settings.AVATAR_ENCODING_CACHE_BYTES; a blob bigger
+    than a sixteenth of that is read from the store on every call instead
+    of crowding out the avatars.
+    """
+
+    def __init__(self):
+        self._blobs = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'AVATAR_ENCODING_CACHE_BYTES', 16 * 1024 * 1024)
+
+    def get(self, digest):
+        """ the blob under `digest`; raises FileNotFoundError """
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is not None:
+                self._blobs.move_to_end(digest)
+                return blob
+        blob = blob_store().read(digest)
+        if len(blob) <= self.max_bytes // 16:
+            with self._lock:
+                if digest not in self._blobs:
+                    self._blobs[digest] = blob
+                    self._bytes += len(blob)
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._blobs.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return blob
+
+    def clear(self):
+        with self._lock:
+            self._blobs.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+
+encodings = EncodingCache()
+
+
+def encode_bundle(index, blobs):
+    """
+    The index as one line of JSON, then every blob back to back; each entry
+    in index['images'] gets the offset of its blob from the end of that line.
+    """
+    offset = 0
+    for entry in index['images']:
+        entry['offset'] = offset
+        offset += entry['length']
+    return b''.join([json.dumps(index).encode(), b'\n', *blobs])
+
+
+def encode_multipart(index, blobs, content_types):
+    """ (body, boundary) of a multipart/mixed message: the index as JSON, then one part per image """
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode(), json.dumps(index).encode()]
+    for entry, blob, content_type in zip(index['images'], blobs, content_types):
+        parts.append((f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\nContent-ID: <{entry["id"]}>\r\n'
+                      f'Content-Length: {entry["length"]}\r\nETag: "{entry["digest"]}"\r\n\r\n').encode())
+        parts.append(blob)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b''.join(parts), boundary
@@ -0,0 +1,50 @@
+from django.db import migrations, models
+
+from avatars.storage import blob_store
+
+
+def move_data_to_blob_store(apps, schema_editor):
+    Image = apps.get_model('avatars', 'Image')
+    store = blob_store()
+    for image in Image.objects.only('id', 'data').iterator(chunk_size=100):
+        data = bytes(image.data)
+        Image.objects.filter(id=image.id).update(digest=store.put(data), size=len(data))
+
+
+def move_data_to_database(apps, schema_editor):
+    Image = apps.get_model('avatars', 'Image')
+    store = blob_store()
+    for image in Image.objects.only('id', 'digest').iterator(chunk_size=100):
+        Image.objects.filter(id=image.id).update(data=store.read(image.digest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avatars', '0002_images_listing_index'),
+    ]
+
+    operations = [
+        # nullable while it goes away, so that unapplying can re-add it before refilling it
+        migrations.AlterField(
+            model_name='image',
+            name='data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='digest',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='size',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(move_data_to_blob_store, move_data_to_database),
+        migrations.RemoveField(
+            model_name='image',
+            name='data',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avatars', '0003_move_image_data_to_blob_store'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='image',
+            name='images_listing',
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['id', 'type', 'private', 'created_at', 'uploader', 'digest'], name='images_listing'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+from avatars.encodings import derive_variants
+from avatars.storage import blob_store
+
+
+def derive_stored_variants(apps, schema_editor):
+    Image = apps.get_model('avatars', 'Image')
+    store = blob_store()
+    for image in Image.objects.only('id', 'type', 'digest').iterator(chunk_size=100):
+        variants = {name: {'digest': store.put(encoded), 'size': len(encoded)}
+                    for name, encoded in derive_variants(image.type, store.read(image.digest)).items()}
+        Image.objects.filter(id=image.id).update(variants=variants)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('avatars', '0004_images_listing_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='variants',
+            field=models.JSONField(default=dict, editable=False),
+        ),
+        migrations.RunPython(derive_stored_variants, migrations.RunPython.noop),
+    ]
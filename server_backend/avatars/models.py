@@ -2,6 +2,9 @@ from django.db import models
 from django.conf import settings
 import uuid
 
+from .encodings import derive_variants
+from .storage import Stored, blob_store
+
 class Image(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     uploader = models.ForeignKey(
@@ -16,12 +19,44 @@ class Image(models.Model):
         choices=[('svg','SVG'), ('png','PNG'), ('jpg','JPG')],
         default='png'
     )
-    data = models.BinaryField()  # raw bytes for image content
+    # sha-256 of the image bytes, which live in the blob store (avatars/storage.py)
+    digest = models.CharField(max_length=64, editable=False)
+    size = models.PositiveIntegerField(default=0, editable=False)
+    # {name: {"digest", "size"}} of the forms derived at ingest, see encodings.derive_variants
+    variants = models.JSONField(default=dict, editable=False)
     private = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = "images"
+        indexes = [
+            # covers every column image_list reads, so listing never reaches the rows
+            models.Index(fields=['id', 'type', 'private', 'created_at', 'uploader', 'digest'], name='images_listing'),
+        ]
+
+    @property
+    def data(self):
+        """ the image bytes, read from the blob store """
+        return blob_store().read(self.digest)
+
+    @data.setter
+    def data(self, data):
+        # also reached from Image(data=...) and Image.objects.create(data=...), after `type` is set
+        data = bytes(data)
+        store = blob_store()
+        self.digest = store.put(data)
+        self.size = len(data)
+        self.variants = {name: {'digest': store.put(encoded), 'size': len(encoded)}
+                         for name, encoded in derive_variants(self.type, data).items()}
+
+    @property
+    def stored(self):
+        return Stored(self.digest, self.size)
+
+    def variant(self, name):
+        """ the stored variant `name`, None if this image has none """
+        variant = self.variants.get(name)
+        return Stored(variant['digest'], variant['size']) if variant else None
 
     def __str__(self):
         return f"Image {self.id} ({self.type})"
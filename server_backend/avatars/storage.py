@@ -0,0 +1,102 @@
+# avatars/storage.py
+"""
+Content-addressed storage for image bytes.
+
+A blob is named by the SHA-256 of its content, so the same picture
+uploaded twice is stored once and a name always means the same bytes.
+Rows in the images table keep only that digest (Image.digest).
+
+Backends are selected with settings.AVATAR_BLOB_STORE.
+"""
+import functools
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+# where a stored blob is and how long it is
+Stored = namedtuple('Stored', 'digest size')
+
+
+def blob_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class BaseBlobStore:
+
+    def put(self, data):
+        """ stores `data` unless it is already there; returns its digest """
+        raise NotImplementedError("subclasses of BaseBlobStore must provide put()")
+
+    def open(self, digest):
+        """ the blob as a file opened for binary reading; raises FileNotFoundError """
+        raise NotImplementedError("subclasses of BaseBlobStore must provide open()")
+
+    def exists(self, digest):
+        raise NotImplementedError("subclasses of BaseBlobStore must provide exists()")
+
+    def read(self, digest):
+        with self.open(digest) as blob:
+            return blob.read()
+
+
+class FileSystemBlobStore(BaseBlobStore):
+    """
+    One file per blob under `root`, fanned out by the first two hex digits
+    of the digest. Files are written under a temporary name and renamed
+    into place, so a reader never sees half a blob and two writers of the
+    same bytes simply replace one copy with another.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, digest):
+        return self.root / digest[:2] / digest
+
+    def put(self, data):
+        digest = blob_digest(data)
+        path = self.path(digest)
+        if path.exists():
+            return digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=path.parent, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as blob:
+                blob.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        return digest
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def exists(self, digest):
+        return self.path(digest).exists()
+
+
+@functools.cache
+def blob_store():
+    """
+    Builds the blob store configured in settings.AVATAR_BLOB_STORE, falling
+    back to a FileSystemBlobStore next to the database.
+    """
+    config = getattr(settings, 'AVATAR_BLOB_STORE', None) or {}
+    backend = import_string(config.get('BACKEND', 'avatars.storage.FileSystemBlobStore'))
+    options = config.get('OPTIONS') or {'root': Path(settings.BASE_DIR) / 'avatar_blobs'}
+    return backend(**options)
+
+
+@receiver(setting_changed)
+def reset_blob_store(setting, **kwargs):
+    if setting == 'AVATAR_BLOB_STORE':
+        blob_store.cache_clear()
@@ -1,8 +1,10 @@
 from django.urls import path
-from .views import image_list, image_detail, image_single_info
+from .views import image_list, image_detail, image_single_info, image_batch
 
 urlpatterns = [
     path('images/', image_list, name='image-list'),
+    path('images/batch/', image_batch, name='image-batch'),
     path('images/<uuid:image_id>/', image_detail, name='image-detail'),
     path('images/<uuid:image_id>/info/', image_single_info, name='image-info'), 
+    path('images/<uuid:image_id>/<str:digest>/', image_detail, name='image-blob'),
 ]
@@ -1,32 +1,99 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.http import HttpResponse, Http404
+from asgiref.sync import sync_to_async
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, Http404, JsonResponse, \
+    StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_GET
 from .models import Image
-from .serializers import ImageSerializer
+from .encodings import BUNDLE_CONTENT_TYPE, encode_bundle, encode_multipart, encodings
+from .storage import blob_digest, blob_store
+from server_backend.pagination import is_asgi, keyset_page, page_limit, page_response, streaming_json_response
 import base64
+import re
+import uuid
 from django.utils.html import escape
 
+BLOB_CHUNK_SIZE = 64 * 1024
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'svg': 'image/svg+xml'
+}
+# images/<id>/<digest>/ always serves the same bytes
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# images/<id>/ follows the image, so clients check back, cheaply with If-None-Match
+REVALIDATE = 'no-cache'
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+MAX_BATCH_IMAGES = 100
+
+IMAGE_LISTING_FIELDS = ('id', 'uploader', 'type', 'private', 'created_at', 'digest')
+IMAGE_TYPES = frozenset(value for value, _ in Image._meta.get_field('type').choices)
+BOOLEANS = {'true': True, '1': True, 'false': False, '0': False}
+
+def image_filters(params):
+    """ filter() arguments from ?type=png[,svg], ?private=true|false and ?uploader=<id>; raises ValueError """
+    filters = {}
+    if params.get('type'):
+        types = params['type'].split(',')
+        unknown = set(types) - IMAGE_TYPES
+        if unknown:
+            raise ValueError(f"Unknown type {', '.join(sorted(unknown))}")
+        filters['type__in'] = types
+    if params.get('private'):
+        if params['private'].lower() not in BOOLEANS:
+            raise ValueError("private must be true or false")
+        filters['private'] = BOOLEANS[params['private'].lower()]
+    if params.get('uploader'):
+        try:
+            filters['uploader'] = int(params['uploader'])
+        except ValueError:
+            raise ValueError("uploader must be an integer user id") from None
+    return filters
+
+def image_after(params):
+    """ ?after as an image id, None when not given; raises ValueError """
+    if not params.get('after'):
+        return None
+    try:
+        return uuid.UUID(params['after'])
+    except ValueError:
+        raise ValueError("after must be an image id") from None
+
 @api_view(['GET'])
 def image_list(request):
     """
-    Return a list of all images in the database.
+    Return the metadata of the images in the database, never their bytes.
+    ?limit=N&after=<id> pages in id order; anything else streams every
+    image (server_backend/pagination.py).
     """
-    images = Image.objects.all()
-    serializer = ImageSerializer(images, many=True)
-    return Response(serializer.data)
+    try:
+        images = Image.objects.filter(**image_filters(request.GET))
+        limit = page_limit(request)
+        after = image_after(request.GET)
+    except ValueError as error:
+        return Response({'error': str(error)}, status=400)
+    if limit is None:
+        return streaming_json_response(request, images, IMAGE_LISTING_FIELDS)
+    images = images.values(*IMAGE_LISTING_FIELDS)
+    return page_response(request, *keyset_page(images, 'id', after, limit))
 
 
 @api_view(['GET'])
-def image_detail(request, image_id):
+def image_detail(request, image_id, digest=None):
     """
     Return raw image bytes, or HTML with metadata if ?html=1 is passed.
+    Served at images/<id>/<digest>/ (digest from the listing or info) the
+    bytes can be cached forever; images/<id>/ has to be revalidated.
     """
     try:
         image = Image.objects.get(id=image_id)
     except Image.DoesNotExist:
         raise Http404("Image not found")
+    if digest is not None and digest != image.digest:
+        raise Http404("Image has changed")
 
-    html_mode = request.query_params.get('html') == '1'
+    html_mode = request.GET.get('html') == '1'
 
     if html_mode:
         metadata = f"""
@@ -41,23 +108,148 @@ def image_detail(request, image_id):
 
         if image.type == 'svg':
             # Embed SVG inline
-            img_tag = image.data.decode('utf-8')
+            img_tag = read_stored(image.variant('svg.min') or image.stored).decode('utf-8')
         else:
-            # Convert PNG/JPG to base64 for embedding
-            import base64
-            img_b64 = base64.b64encode(image.data).decode('utf-8')
+            # Embed PNG/JPG as base64, encoded at ingest
+            img_b64 = image_base64(image)
             img_tag = f'<img src="data:image/{image.type};base64,{img_b64}" width="300"/>'
 
         html = f"<html><body>{img_tag}{metadata}</body></html>"
         return HttpResponse(html, content_type='text/html')
 
     else:
-        content_type = {
-            'png': 'image/png',
-            'jpg': 'image/jpeg',
-            'svg': 'image/svg+xml'
-        }.get(image.type, 'application/octet-stream')
-        return HttpResponse(image.data, content_type=content_type)
+        if digest is None:
+            stored, content_encoding = image_representation(request, image)
+        else:
+            # the URL names the uploaded bytes, so those are what it serves
+            stored, content_encoding = image.stored, None
+        response = blob_response(request, image, stored, CONTENT_TYPES.get(image.type, 'application/octet-stream'))
+        response['ETag'] = image_etag(stored)
+        response['Cache-Control'] = REVALIDATE if digest is None else IMMUTABLE
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+        if image.type == 'svg' and digest is None:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+def accepts_gzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip'):
+            return not re.fullmatch(r'q=0(\.0*)?', params.replace(' ', ''))
+    return False
+
+def image_representation(request, image):
+    """
+    (stored blob, Content-Encoding) of the form of `image` to send from
+    images/<id>/, all of them made at ingest: SVGs go out minified, and
+    gzipped as well to clients that accept it; other images as they were
+    uploaded.
+    """
+    if image.type == 'svg':
+        if accepts_gzip(request) and image.variant('svg.gz'):
+            return image.variant('svg.gz'), 'gzip'
+        return image.variant('svg.min') or image.stored, None
+    return image.stored, None
+
+def read_stored(stored):
+    """ the bytes of a stored blob; a 404, as in blob_response, when the store has lost them """
+    try:
+        return encodings.get(stored.digest)
+    except FileNotFoundError:
+        raise Http404("Image data not found")
+
+def image_base64(image):
+    """
+    the base64 form of the image bytes stored at ingest; images stored
+    before variants were derived have it encoded from their bytes instead
+    """
+    variant = image.variant('base64')
+    if variant is None:
+        return base64.b64encode(read_stored(image.stored)).decode('ascii')
+    return read_stored(variant).decode('utf-8')
+
+def image_etag(stored):
+    """ strong ETag from the content hash taken when the bytes were stored """
+    return f'"{stored.digest}"'
+
+def byte_range(request, stored):
+    """
+    (start, end), both included, of the one byte range asked for with Range,
+    or None to send the whole image: when there is no Range, several ranges,
+    one we cannot read, or an If-Range naming other content. Raises
+    ValueError for a range that lies past the end of the image.
+    """
+    match = BYTE_RANGE.fullmatch(request.headers.get('Range', '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    if request.headers.get('If-Range', image_etag(stored)) != image_etag(stored):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last `last` bytes
+        if int(last) == 0 or stored.size == 0:
+            raise ValueError("empty range")
+        return max(0, stored.size - int(last)), stored.size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= stored.size:
+        raise ValueError("range starts past the end")
+    return int(first), min(int(last), stored.size - 1) if last else stored.size - 1
+
+def read_blob(blob, start, length):
+    with blob:
+        blob.seek(start)
+        while length > 0 and (chunk := blob.read(min(BLOB_CHUNK_SIZE, length))):
+            length -= len(chunk)
+            yield chunk
+
+async def aread_blob(blob, start, length):
+    """ read_blob() with each read made off the event loop """
+    read = sync_to_async(blob.read, thread_sensitive=False)
+    try:
+        await sync_to_async(blob.seek, thread_sensitive=False)(start)
+        while length > 0 and (chunk := await read(min(BLOB_CHUNK_SIZE, length))):
+            length -= len(chunk)
+            yield chunk
+    finally:
+        blob.close()
+
+def blob_response(request, image, stored, content_type):
+    """
+    The `stored` form of the image, or the byte range asked for, streamed from the blob
+    store and never read whole; a 304 when the client holds them already,
+    decided before the blob is opened. WSGI servers with a file_wrapper
+    send a whole image with sendfile(); under ASGI the chunks come from an
+    async iterator (see is_asgi).
+    """
+    if image_etag(stored) in parse_etags(request.headers.get('If-None-Match', '')):
+        return HttpResponseNotModified()
+    try:
+        span = byte_range(request, stored)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stored.size}'
+        return response
+    try:
+        blob = blob_store().open(stored.digest)
+    except FileNotFoundError:
+        raise Http404("Image data not found")
+
+    asgi = is_asgi(request)
+    if span is None and not asgi:
+        response = FileResponse(blob, content_type=content_type, filename=f'{image.id}.{image.type}')
+    else:
+        start, end = span or (0, stored.size - 1)
+        length = end + 1 - start
+        chunks = aread_blob(blob, start, length) if asgi else read_blob(blob, start, length)
+        response = StreamingHttpResponse(chunks, content_type=content_type, status=206 if span else 200)
+        response['Content-Length'] = str(length)
+        response['Content-Disposition'] = f'inline; filename="{image.id}.{image.type}"'
+        if span:
+            response['Content-Range'] = f'bytes {start}-{end}/{stored.size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
 
 @api_view(['GET'])
 def image_single_info(request, image_id):
@@ -69,7 +261,7 @@ def image_single_info(request, image_id):
     except Image.DoesNotExist:
         raise Http404("Image not found")
 
-    data_base64 = base64.b64encode(img.data).decode('utf-8') if img.data else None
+    data_base64 = image_base64(img) if img.size else None
 
     result = {
         "id": str(img.id),
@@ -77,7 +269,58 @@ def image_single_info(request, image_id):
         "type": img.type,
         "private": img.private,
         "created_at": img.created_at,
+        "digest": img.digest,
         "data_base64": data_base64
     }
 
-    return Response(result)
\ No newline at end of file
+    return Response(result)
+
+@require_GET
+def image_batch(request):
+    """
+    Several images in one response: images/batch/?ids=<id>,<id>,... read
+    with one query. The body starts with an index,
+    {"images": [{"id", "type", "digest", "length"}, ...], "missing": [<id>, ...]},
+    in the order asked for. With Accept: multipart/mixed the index is the
+    first part and each image follows as its own part (Content-ID <id>);
+    otherwise it is an application/x-avatar-bundle: the index as one line
+    of JSON, every entry also carrying "offset", then the images back to back.
+    """
+    try:
+        ids = list(dict.fromkeys(uuid.UUID(image_id) for image_id in request.GET.get('ids', '').split(',') if image_id))
+    except ValueError:
+        return JsonResponse({'error': 'ids must be a comma-separated list of image ids'}, status=400)
+    if not 0 < len(ids) <= MAX_BATCH_IMAGES:
+        return JsonResponse({'error': f'Between 1 and {MAX_BATCH_IMAGES} ids are required'}, status=400)
+
+    found = {image['id']: image for image in Image.objects.filter(id__in=ids).values('id', 'type', 'digest', 'size')}
+    multipart = 'multipart/mixed' in request.headers.get('Accept', '')
+    # names every id and the content behind it, so it changes with any image in the batch
+    contents = [(image_id, found[image_id]['digest'] if image_id in found else None) for image_id in ids]
+    etag = f'"{blob_digest(repr((multipart, contents)).encode())}"'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        index, blobs, content_types = {'images': [], 'missing': []}, [], []
+        for image_id in ids:
+            image = found.get(image_id)
+            try:
+                blob = encodings.get(image['digest']) if image else None
+            except FileNotFoundError:
+                blob = None
+            if blob is None:
+                index['missing'].append(str(image_id))
+                continue
+            blobs.append(blob)
+            index['images'].append({'id': str(image_id), 'type': image['type'], 'digest': image['digest'],
+                                    'length': image['size']})
+            content_types.append(CONTENT_TYPES.get(image['type'], 'application/octet-stream'))
+        if multipart:
+            body, boundary = encode_multipart(index, blobs, content_types)
+            response = HttpResponse(body, content_type=f'multipart/mixed; boundary={boundary}')
+        else:
+            response = HttpResponse(encode_bundle(index, blobs), content_type=BUNDLE_CONTENT_TYPE)
+    response['ETag'] = etag
+    response['Cache-Control'] = REVALIDATE
+    response['Vary'] = 'Accept'
+    return response
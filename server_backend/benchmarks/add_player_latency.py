@@ -0,0 +1,119 @@
+"""
+p50 / p99 latency of POST /api/game/<gameId>/add/ with 1, 50 and 500 sockets
+in the room, sending the add_player broadcast inline (async_to_sync, the old
+behaviour) and through the broadcast outbox.
+
+Runs the ASGI app in-process against a throwaway SQLite database, with the
+sockets held by WebsocketCommunicators on the same event loop:
+
+    cd server_backend
+    python benchmarks/add_player_latency.py --requests 40 --rate 2 --sockets 1 50 500
+    CHANNEL_LAYER=sqlite python benchmarks/add_player_latency.py
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server_backend.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+import django
+from django.conf import settings
+
+workdir = tempfile.mkdtemp()
+settings.DATABASES['default']['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+settings.ALLOWED_HOSTS.append('testserver')
+django.setup()
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import AsyncClient
+
+from accounts.models import Account
+from game.models import Game
+from game.routing import websocket_urlpatterns
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def drain(communicator, counter):
+    while True:
+        await communicator.receive_output(timeout=3600)
+        counter[0] += 1
+
+
+async def run(mode, sockets, requests, rate):
+    settings.GAME_BROADCAST_OUTBOX = mode == 'outbox'
+    game = await Game.objects.acreate()
+    account = await Account.objects.acreate(
+        username=f"{mode}-{sockets}", password='password', email=f"{mode}-{sockets}@example.com")
+
+    application = URLRouter(websocket_urlpatterns)
+    communicators = []
+    for _ in range(sockets):
+        communicator = WebsocketCommunicator(application, f"/ws/game/{game.gameId}/")
+        await communicator.connect()
+        communicators.append(communicator)
+    received = [0]
+    drains = [asyncio.create_task(drain(communicator, received)) for communicator in communicators]
+
+    client = AsyncClient()
+    latencies = []
+
+    async def add_player(number):
+        begin = time.perf_counter()
+        response = await client.post(
+            f"/api/game/{game.gameId}/add/",
+            data={'userId': str(account.userId), 'name': f"Player {number}"},
+            content_type="application/json")
+        latencies.append((time.perf_counter() - begin) * 1000)
+        assert response.status_code == 201, response.status_code
+
+    # open loop: requests arrive at a fixed rate whether or not earlier ones finished
+    started = time.perf_counter()
+    adds = []
+    for number in range(requests):
+        adds.append(asyncio.create_task(add_player(number)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*adds)
+
+    # every broadcast must still arrive
+    while received[0] < sockets * requests:
+        await asyncio.sleep(0.01)
+    delivered = time.perf_counter() - started
+
+    for task in drains:
+        task.cancel()
+    for communicator in communicators:
+        await communicator.disconnect()
+    return latencies, delivered
+
+
+async def main(arguments):
+    print(f"channel layer: {settings.CHANNEL_LAYERS['default']['BACKEND']}, {arguments.rate:g} adds/s")
+    print(f"{'mode':<8} {'sockets':>7} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8} {'all delivered s':>16}")
+    for sockets in arguments.sockets:
+        for mode in ('inline', 'outbox'):
+            latencies, delivered = await run(mode, sockets, arguments.requests, arguments.rate)
+            print(f"{mode:<8} {sockets:>7} {percentile(latencies, 0.50):>8.2f} {percentile(latencies, 0.99):>8.2f} "
+                  f"{statistics.mean(latencies):>8.2f} {delivered:>16.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--sockets', type=int, nargs='+', default=[1, 50, 500])
+    parser.add_argument('--rate', type=float, default=2, help="add_player requests per second")
+    arguments = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    asyncio.run(main(arguments))
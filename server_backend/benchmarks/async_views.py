@@ -0,0 +1,138 @@
+"""
+Throughput and p50 / p99 latency of the sync game views (/api/game/...)
+against their async ORM versions (/api/game/async/...) with a fixed number
+of requests in flight.
+
+Runs the ASGI app in-process against a throwaway SQLite database. SQLite
+answers in microseconds, so --db-latency adds a sleep to every query on
+the connection to stand in for a database across the network:
+
+    cd server_backend
+    python benchmarks/async_views.py --concurrency 1 16 64 --db-latency 2
+    python benchmarks/async_views.py --views info info-cached --requests 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server_backend.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+import django
+from django.conf import settings
+
+workdir = tempfile.mkdtemp()
+settings.DATABASES['default']['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+settings.ALLOWED_HOSTS.append('testserver')
+django.setup()
+
+from django.core.management import call_command
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient
+
+from accounts.models import Account
+from game.consumers import socket_session_connect
+from game.models import Game, Player
+from game.outbox import outbox
+
+VIEWS = ('info', 'info-cached', 'games', 'add', 'claim', 'name')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def add_db_latency(seconds):
+    def sleep_then_execute(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        connection.execute_wrappers.append(sleep_then_execute)
+    connection_created.connect(install, weak=False)
+
+
+async def setup(games):
+    """ `games` games of four players each, every player's user holding a session """
+    rooms = []
+    for number in range(games):
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(
+            username=f"user-{number}", password='password', email=f"user-{number}@example.com")
+        players = [await Player.objects.acreate(game=game, name=f"Player {seat}", userId=account) for seat in range(4)]
+        session_id = f"session-{number}"
+        socket_session_connect(session_id, str(account.userId), f"socket-{number}", game.gameId)
+        rooms.append({'gameId': game.gameId, 'userId': str(account.userId), 'sessionId': session_id,
+                      'playerId': str(players[0].playerId)})
+    await outbox.flush()
+    return rooms
+
+
+def request_for(view, prefix, room, number):
+    game_id = room['gameId']
+    if view in ('info', 'info-cached'):
+        return 'get', f"/api/game/{prefix}{game_id}/info/", None
+    if view == 'games':
+        return 'get', f"/api/game/{prefix}", None
+    if view == 'add':
+        return 'post', f"/api/game/{prefix}{game_id}/add/", {'userId': room['userId'], 'name': f"Extra {number}"}
+    if view == 'claim':
+        return 'post', f"/api/game/{prefix}{game_id}/claim/", {'sessionId': room['sessionId']}
+    return 'post', f"/api/game/{prefix}{game_id}/name/", \
+        {'userId': room['userId'], 'playerId': room['playerId'], 'name': f"Name {number}"}
+
+
+async def run(view, prefix, rooms, requests, concurrency):
+    settings.GAME_SNAPSHOT_CACHE = view != 'info'
+    client = AsyncClient()
+    latencies = []
+    numbers = iter(range(requests))
+
+    async def worker():
+        for number in numbers:
+            method, url, data = request_for(view, prefix, rooms[number % len(rooms)], number)
+            begin = time.perf_counter()
+            if method == 'get':
+                response = await client.get(url)
+            else:
+                response = await client.post(url, data=data, content_type="application/json")
+            latencies.append((time.perf_counter() - begin) * 1000)
+            assert response.status_code in (200, 201), (url, response.status_code)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await outbox.flush()
+    return latencies, elapsed
+
+
+async def main(arguments):
+    rooms = await setup(arguments.games)
+    print(f"{arguments.requests} requests per run, {arguments.db_latency:g} ms added per query")
+    print(f"{'view':<12} {'path':<6} {'in flight':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for view in arguments.views:
+        for concurrency in arguments.concurrency:
+            for prefix, label in (('', 'sync'), ('async/', 'async')):
+                latencies, elapsed = await run(view, prefix, rooms, arguments.requests, concurrency)
+                print(f"{view:<12} {label:<6} {concurrency:>9} {len(latencies) / elapsed:>8.0f} "
+                      f"{percentile(latencies, 0.50):>8.2f} {percentile(latencies, 0.99):>8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--db-latency', type=float, default=0, help="milliseconds added to every query")
+    parser.add_argument('--views', nargs='+', choices=VIEWS, default=list(VIEWS))
+    arguments = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    if arguments.db_latency:
+        add_db_latency(arguments.db_latency / 1000)
+    asyncio.run(main(arguments))
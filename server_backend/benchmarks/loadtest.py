@@ -0,0 +1,479 @@
+"""
+Load generator for the game REST and WebSocket flows, run against a Daphne
+server. The server can be one already running, or one the script starts
+with a throwaway database.
+
+Setup:
+- register accounts and create --rooms games
+- add --sockets-per-room players to each game
+- open one socket per player and send sessionUser / sessionPlayer
+
+Load, for --duration seconds:
+- GET /info/, POST /add/, /claim/ and /name/
+- clientMessage on the sockets
+Each traffic type runs at its own fixed rate.
+
+The report covers:
+- throughput and latency percentiles per operation
+- broadcast fan-out: the time until every socket in the room has the
+  message
+- server memory per connection, when the server's pid is known
+
+Only daphne's own dependencies are used: autobahn for the sockets and
+http.client for REST.
+
+    cd server_backend
+    python benchmarks/loadtest.py --spawn --rooms 4 --sockets-per-room 50 --duration 30
+    python benchmarks/loadtest.py --url http://127.0.0.1:8000 --server-pid 1234
+    SESSION_STORE=sqlite python benchmarks/loadtest.py --spawn --json results.json
+"""
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from game.codecs import CODECS, DEFAULT_CODEC  # noqa: E402  (plain module, no Django setup needed)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def rss_kb(pid):
+    """ resident set size of a process in KiB, from /proc (Linux only) """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, operation, milliseconds, status=None):
+        self.latencies.setdefault(operation, []).append(milliseconds)
+        if status is not None:
+            key = (operation, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def error(self, operation):
+        self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def summary(self, duration):
+        rows = {}
+        for operation in sorted(set(self.latencies) | set(self.errors)):
+            samples = self.latencies.get(operation, [])
+            rows[operation] = {
+                'count': len(samples),
+                'errors': self.errors.get(operation, 0),
+                'per_second': len(samples) / duration,
+                'p50_ms': percentile(samples, 0.50) if samples else None,
+                'p90_ms': percentile(samples, 0.90) if samples else None,
+                'p99_ms': percentile(samples, 0.99) if samples else None,
+                'max_ms': max(samples) if samples else None,
+                'statuses': {str(status): count for (op, status), count in self.statuses.items() if op == operation},
+            }
+        return rows
+
+
+class RestClient:
+    """ keep-alive http.client connections, one per worker thread """
+
+    def __init__(self, url, workers):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._local = threading.local()
+
+    def _request(self, method, path, body, headers):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        data = json.loads(content) if content and response.headers.get('Content-Type', '').startswith('application/json') else None
+        return response.status, response.headers, data
+
+    async def request(self, method, path, body=None, headers=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._request, method, path, body, headers)
+
+
+class GameSocket(WebSocketClientProtocol):
+
+    def onMessage(self, payload, isBinary):
+        harness = self.factory.harness
+        harness.bytes_received += len(payload)
+        harness.on_message(self, harness.codec.decode(payload), time.perf_counter())
+
+    def send_json(self, message):
+        codec = self.factory.harness.codec
+        frame = codec.encode(message)
+        self.sendMessage(frame if codec.binary else frame.encode(), isBinary=codec.binary)
+
+
+class Room:
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.users = []         # userIds
+        self.players = []       # (userId, playerId)
+        self.sockets = []       # (GameSocket, sessionId)
+        self.etag = None
+
+
+class Harness:
+
+    def __init__(self, options):
+        self.options = options
+        self.rest = RestClient(options.url, options.http_workers)
+        parsed = urllib.parse.urlsplit(options.url)
+        self.ws_host, self.ws_port = parsed.hostname, parsed.port or 80
+        self.stats = Stats()
+        self.rooms = []
+        self.sequence = itertools.count()
+        # broadcast token -> [operation, sent_at, sockets expected, sockets received]
+        self.pending = {}
+        self.acks = {}
+        self.messages = 0
+        self.bytes_received = 0
+        self.codec = CODECS[options.subprotocol] if options.subprotocol else DEFAULT_CODEC
+
+    # socket traffic
+
+    def on_message(self, game_socket, message, arrived_at):
+        self.messages += 1
+        if message.get('type') == 'handle_session_user':
+            waiter = self.acks.pop(message.get('session_id'), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+            return
+        if message.get('type') in ('add_player', 'name_player'):
+            token = message.get('name')
+        else:
+            token = message.get('message')
+        pending = self.pending.get(token)
+        if pending is None:
+            return
+        operation, sent_at, expected, received = pending
+        if received == 0:
+            self.stats.record(f"{operation} first delivery", (arrived_at - sent_at) * 1000)
+        pending[3] = received = received + 1
+        if received == expected:
+            del self.pending[token]
+            self.stats.record(f"{operation} fan-out", (arrived_at - sent_at) * 1000)
+
+    def expect_broadcast(self, operation, token, room):
+        if room.sockets:
+            self.pending[token] = [operation, time.perf_counter(), len(room.sockets), 0]
+
+    async def open_socket(self, room, user_id, player_id):
+        factory = WebSocketClientFactory(
+            f"ws://{self.ws_host}:{self.ws_port}/ws/game/{room.game_id}/",
+            protocols=[self.codec.subprotocol] if self.codec.subprotocol else None)
+        factory.protocol = GameSocket
+        factory.harness = self
+        loop = asyncio.get_running_loop()
+        _, game_socket = await loop.create_connection(factory, self.ws_host, self.ws_port)
+        await asyncio.wait_for(game_socket.is_open, 30)
+        session_id = os.urandom(16).hex()
+        ack = self.acks[session_id] = loop.create_future()
+        game_socket.send_json({'type': 'sessionUser', 'sessionId': session_id, 'userId': user_id})
+        await asyncio.wait_for(ack, 30)
+        game_socket.send_json({'type': 'sessionPlayer', 'playerId': player_id})
+        room.sockets.append((game_socket, session_id))
+
+    # setup
+
+    async def setup(self):
+        options = self.options
+        for number in range(options.rooms):
+            status, _, data = await self.rest.request('POST', '/api/game/new/')
+            assert status == 201, f"create game: {status}"
+            room = Room(data['game']['gameId'])
+            for user in range(options.users_per_room):
+                name = f"loadtest-{os.getpid()}-{number}-{user}-{random.randrange(1 << 30)}"
+                status, _, data = await self.rest.request('POST', '/api/accounts/register/', {
+                    'username': name, 'email': f"{name}@example.com", 'password': 'loadtest-password'})
+                assert status == 201, f"register: {status} {data}"
+                room.users.append(data['userId'])
+            self.rooms.append(room)
+
+        async def add_player(room, number):
+            user_id = room.users[number % len(room.users)]
+            status, _, data = await self.rest.request(
+                'POST', f"/api/game/{room.game_id}/add/", {'userId': user_id})
+            assert status == 201, f"add player: {status}"
+            room.players.append((user_id, str(data['player']['playerId'])))
+
+        for room in self.rooms:
+            await asyncio.gather(*(add_player(room, n) for n in range(options.sockets_per_room)))
+
+        rss_before = rss_kb(options.server_pid) if options.server_pid else None
+        begin = time.perf_counter()
+        connect = asyncio.Semaphore(options.connect_concurrency)
+
+        async def open_socket(room, user_id, player_id):
+            async with connect:
+                await self.open_socket(room, user_id, player_id)
+
+        await asyncio.gather(*(
+            open_socket(room, user_id, player_id)
+            for room in self.rooms for user_id, player_id in room.players))
+        connect_seconds = time.perf_counter() - begin
+        await asyncio.sleep(1)
+        rss_after = rss_kb(options.server_pid) if options.server_pid else None
+
+        connections = sum(len(room.sockets) for room in self.rooms)
+        self.connections = {
+            'count': connections,
+            'connect_seconds': connect_seconds,
+            'server_rss_before_kb': rss_before,
+            'server_rss_after_kb': rss_after,
+            'server_kb_per_connection': (rss_after - rss_before) / connections
+            if rss_before is not None and rss_after is not None and connections else None,
+        }
+
+    # load
+
+    async def info(self):
+        room = random.choice(self.rooms)
+        headers = {'If-None-Match': room.etag} if self.options.etag and room.etag else None
+        begin = time.perf_counter()
+        status, response_headers, _ = await self.rest.request('GET', f"/api/game/{room.game_id}/info/", headers=headers)
+        self.stats.record('GET info', (time.perf_counter() - begin) * 1000, status)
+        if status in (200, 304):
+            room.etag = response_headers.get('ETag') or room.etag
+        else:
+            self.stats.error('GET info')
+
+    async def add(self):
+        room = random.choice(self.rooms)
+        name = f"lt-add-{next(self.sequence)}"
+        self.expect_broadcast('add_player', name, room)
+        begin = time.perf_counter()
+        status, _, _ = await self.rest.request(
+            'POST', f"/api/game/{room.game_id}/add/", {'userId': random.choice(room.users), 'name': name})
+        self.stats.record('POST add', (time.perf_counter() - begin) * 1000, status)
+        if status != 201:
+            self.stats.error('POST add')
+
+    async def claim(self):
+        room = random.choice(self.rooms)
+        _, session_id = random.choice(room.sockets)
+        begin = time.perf_counter()
+        status, _, _ = await self.rest.request('POST', f"/api/game/{room.game_id}/claim/", {'sessionId': session_id})
+        self.stats.record('POST claim', (time.perf_counter() - begin) * 1000, status)
+        if status != 200:
+            self.stats.error('POST claim')
+
+    async def name(self):
+        room = random.choice(self.rooms)
+        user_id, player_id = random.choice(room.players)
+        name = f"lt-name-{next(self.sequence)}"
+        self.expect_broadcast('name_player', name, room)
+        begin = time.perf_counter()
+        status, _, _ = await self.rest.request(
+            'POST', f"/api/game/{room.game_id}/name/", {'userId': user_id, 'playerId': player_id, 'name': name})
+        self.stats.record('POST name', (time.perf_counter() - begin) * 1000, status)
+        if status != 200:
+            self.stats.error('POST name')
+
+    async def message(self):
+        room = random.choice(self.rooms)
+        game_socket, _ = random.choice(room.sockets)
+        token = f"lt-message-{next(self.sequence)}"
+        # the consumer echoes "<message> received" to the whole room
+        self.expect_broadcast('clientMessage', f"{token} received", room)
+        game_socket.send_json({'type': 'clientMessage', 'message': token})
+
+    async def drive(self, operation, rate, deadline, tasks):
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        next_at = time.perf_counter()
+        while next_at < deadline:
+            # open loop: a slow server does not slow the offered load down
+            tasks.add(asyncio.ensure_future(self._guarded(operation)))
+            next_at += interval
+            await asyncio.sleep(max(0, next_at - time.perf_counter()))
+
+    async def _guarded(self, operation):
+        try:
+            await operation()
+        except Exception as error:
+            self.stats.error(f"{operation.__name__} ({type(error).__name__})")
+
+    async def run(self):
+        options = self.options
+        await self.setup()
+        received_before = self.messages
+        bytes_before = self.bytes_received
+        begin = time.perf_counter()
+        deadline = begin + options.duration
+        tasks = set()
+        await asyncio.gather(
+            self.drive(self.info, options.info_rate, deadline, tasks),
+            self.drive(self.add, options.add_rate, deadline, tasks),
+            self.drive(self.claim, options.claim_rate, deadline, tasks),
+            self.drive(self.name, options.name_rate, deadline, tasks),
+            self.drive(self.message, options.message_rate, deadline, tasks),
+        )
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+        # let the last broadcasts land
+        settle = time.perf_counter() + 5
+        while self.pending and time.perf_counter() < settle:
+            await asyncio.sleep(0.05)
+        duration = time.perf_counter() - begin
+        for operation, *_ in self.pending.values():
+            self.stats.error(f"{operation} fan-out")
+
+        return {
+            'options': {key: value for key, value in vars(options).items() if key != 'json'},
+            'connections': self.connections,
+            'duration_seconds': duration,
+            'socket_messages_received': self.messages - received_before,
+            'socket_messages_per_second': (self.messages - received_before) / duration,
+            'socket_bytes_received': self.bytes_received - bytes_before,
+            'operations': self.stats.summary(duration),
+            'server_rss_end_kb': rss_kb(options.server_pid) if options.server_pid else None,
+        }
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def spawn_daphne(workdir):
+    """ migrates a fresh database and starts Daphne on it, returning (process, url) """
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'loadtest')
+    env.setdefault('GAME_LOG_LEVEL', 'WARNING')
+    env['DATABASE_PATH'] = os.path.join(workdir, 'loadtest.sqlite3')
+    env.setdefault('SESSION_STORE_PATH', os.path.join(workdir, 'sessions.sqlite3'))
+    env.setdefault('CHANNEL_LAYER_PATH', os.path.join(workdir, 'channels.sqlite3'))
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '-v', '0'], cwd=BASE_DIR, env=env, check=True)
+
+    port = free_port()
+    log = open(os.path.join(workdir, 'daphne.log'), 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'server_backend.asgi:application'],
+        cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"daphne exited with {process.returncode}, see {log.name}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"daphne did not start listening on {port}, see {log.name}")
+
+
+def print_report(results):
+    connections = results['connections']
+    print(f"\n{connections['count']} sockets connected and bound in {connections['connect_seconds']:.2f}s")
+    if connections['server_kb_per_connection'] is not None:
+        print(f"server RSS {connections['server_rss_before_kb']} KiB -> {connections['server_rss_after_kb']} KiB, "
+              f"{connections['server_kb_per_connection']:.1f} KiB per connection")
+    print(f"{results['socket_messages_received']} socket messages received "
+          f"({results['socket_messages_per_second']:.0f}/s, {results['socket_bytes_received']} bytes) "
+          f"over {results['duration_seconds']:.1f}s\n")
+
+    def ms(value):
+        return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+
+    print(f"| {'operation':<28} | {'count':>6} | {'errors':>6} | {'per s':>7} | "
+          f"{'p50 ms':>8} | {'p90 ms':>8} | {'p99 ms':>8} | {'max ms':>8} |")
+    print(f"|{'-' * 30}|{'-' * 7}:|{'-' * 7}:|{'-' * 8}:|{'-' * 9}:|{'-' * 9}:|{'-' * 9}:|{'-' * 9}:|")
+    for operation, row in results['operations'].items():
+        print(f"| {operation:<28} | {row['count']:>6} | {row['errors']:>6} | {row['per_second']:>7.1f} | "
+              f"{ms(row['p50_ms'])} | {ms(row['p90_ms'])} | {ms(row['p99_ms'])} | {ms(row['max_ms'])} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="base URL of a running server, e.g. http://127.0.0.1:8000")
+    target.add_argument('--spawn', action='store_true', help="start Daphne on a throwaway database")
+    parser.add_argument('--server-pid', type=int, help="pid of the server, for memory figures")
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--users-per-room', type=int, default=4)
+    parser.add_argument('--sockets-per-room', type=int, default=25)
+    parser.add_argument('--duration', type=float, default=20, help="seconds of load after setup")
+    parser.add_argument('--info-rate', type=float, default=50, help="GET /info/ per second")
+    parser.add_argument('--add-rate', type=float, default=1, help="POST /add/ per second")
+    parser.add_argument('--claim-rate', type=float, default=5, help="POST /claim/ per second")
+    parser.add_argument('--name-rate', type=float, default=2, help="POST /name/ per second")
+    parser.add_argument('--message-rate', type=float, default=10, help="clientMessage per second")
+    parser.add_argument('--subprotocol', choices=sorted(CODECS), help="socket wire format, JSON if not given")
+    parser.add_argument('--no-etag', dest='etag', action='store_false',
+                        help="poll /info/ without If-None-Match")
+    parser.add_argument('--http-workers', type=int, default=16)
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--json', help="also write the results to this file")
+    options = parser.parse_args()
+
+    process = None
+    if options.spawn:
+        workdir = tempfile.mkdtemp(prefix='loadtest-')
+        process, options.url = spawn_daphne(workdir)
+        options.server_pid = process.pid
+        print(f"daphne pid {process.pid} on {options.url}, logs in {workdir}")
+    try:
+        results = asyncio.run(Harness(options).run())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(10)
+
+    print_report(results)
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
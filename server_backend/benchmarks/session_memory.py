@@ -0,0 +1,69 @@
+"""
+Resident memory of the session store over many connect / bind / disconnect
+cycles, each room seeing a few sockets before the next game starts, with
+compact() run every --compact-every cycles as the consumers' compaction
+task would:
+
+    cd server_backend
+    python benchmarks/session_memory.py --cycles 100000
+    python benchmarks/session_memory.py --store sqlite --compact-every 0
+
+RSS is read from /proc (Linux only). With pruning and compaction it should
+stay flat once the interpreter has warmed up.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game.sessions import SessionRegistry, SQLiteSessionStore
+
+
+def rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=100000)
+    parser.add_argument('--sockets-per-room', type=int, default=4)
+    parser.add_argument('--compact-every', type=int, default=10000, help="0 never compacts")
+    parser.add_argument('--report-every', type=int, default=10000)
+    parser.add_argument('--store', choices=('memory', 'sqlite'), default='memory')
+    options = parser.parse_args()
+
+    if options.store == 'sqlite':
+        workdir = tempfile.mkdtemp()
+        store = SQLiteSessionStore(os.path.join(workdir, 'sessions.sqlite3'))
+    else:
+        store = SessionRegistry()
+
+    print(f"{'cycles':>8} {'rss_kb':>8} {'sockets':>8}")
+    baseline = None
+    for cycle in range(1, options.cycles + 1):
+        room_name = f"room-{cycle // options.sockets_per_room}"
+        socket_id, session_id = f"socket-{cycle}", f"session-{cycle}"
+        store.connect(session_id, f"user-{cycle % 1000}", socket_id, room_name)
+        store.bind_player(f"player-{cycle}", socket_id, room_name)
+        store.bump_room(room_name)
+        store.disconnect(socket_id, room_name)
+        store.bump_room(room_name)
+        if options.compact_every and cycle % options.compact_every == 0:
+            store.compact()
+        if cycle % options.report_every == 0:
+            gc.collect()
+            rss = rss_kb()
+            baseline = baseline or rss
+            print(f"{cycle:>8} {rss:>8} {len(store):>8}")
+    print(f"growth after the first report: {rss_kb() - baseline} KiB")
+
+
+if __name__ == '__main__':
+    main()
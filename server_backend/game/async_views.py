@@ -0,0 +1,172 @@
+# game/async_views.py
+"""
+Async versions of the game views, served under /api/game/async/ with the
+same requests and responses as their sync counterparts in views.py.
+
+The sync views hold a thread from the single thread-sensitive executor for
+their whole run. These run on the event loop and only go to that thread
+for each ORM query, so requests that are between queries, or never query
+at all (a cached snapshot or a 304), no longer wait behind one another.
+Session store lookups go through socketSession.run(), which keeps the
+sqlite store's file access off the event loop.
+"""
+import json
+import uuid
+
+from django.http import JsonResponse
+from django.shortcuts import aget_object_or_404
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework import status
+
+from accounts.models import Account
+from server_backend.pagination import akeyset_page, page_response, streaming_json_response
+from .consumers import get_room_version, get_user_from_session, room_etag, socketSession
+from .models import Game, Player
+from .snapshots import snapshots
+from .views import GAME_LISTING_FIELDS, add_player_response, announce_player, claim_from_snapshot, \
+    game_info_response, games_listing, not_modified, prepare_game_data, prepare_player_data, trace
+
+
+def read_json(request):
+    """ the request body as a dict, or None if it is not a JSON object """
+    try:
+        body_data = json.loads(request.body or b'{}')
+    except json.JSONDecodeError:
+        return None
+    return body_data if isinstance(body_data, dict) else None
+
+
+def read_data(request):
+    """ the request body as DRF's default parsers give it to views.add_player: form fields or JSON """
+    if request.content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+        return request.POST
+    return read_json(request)
+
+
+async def aget_game_snapshot(game_id, version=None):
+    """ views.get_game_snapshot on the async ORM; raises Game.DoesNotExist """
+    if version is None:
+        version = await socketSession.run(get_room_version, game_id)
+    snapshot = snapshots.get(game_id, version)
+    if snapshot is None:
+        game = await Game.objects.aget(gameId=game_id)
+        players = [player async for player in game.players.select_related('userId')]
+        # isActive comes from the session store
+        snapshot = snapshots.put(game_id, await socketSession.run(prepare_game_data, game, players), version)
+    return snapshot
+
+
+@require_GET
+async def get_game_info(request, gameId):
+    version = await socketSession.run(get_room_version, gameId)
+    etag = room_etag(version)
+    try:
+        snapshot = await aget_game_snapshot(gameId, version)
+    except Game.DoesNotExist:
+        return JsonResponse({"error": "Game not found"}, status=404)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    # looks up sessions and sockets when tracing or debugging
+    return await socketSession.run(game_info_response, request, gameId, snapshot, etag)
+
+
+@require_GET
+async def get_games(request):
+    try:
+        games, limit = games_listing(request)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    if limit is None:
+        return streaming_json_response(request, games, GAME_LISTING_FIELDS)
+    return page_response(request, *await akeyset_page(games, 'gameId', request.GET.get('after'), limit))
+
+
+@require_POST
+async def add_player(request, gameId):
+    game = await aget_object_or_404(Game, gameId=gameId)
+    body_data = read_data(request)
+    if body_data is None:
+        return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+    user_id = body_data.get('userId')
+    player_name = body_data.get('name')
+
+    if not user_id:
+        return JsonResponse({'error': 'userId parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        user_account = await Account.objects.aget(userId=user_id)
+    except Account.DoesNotExist:
+        return JsonResponse({'error': 'Account not found for the given userId'}, status=status.HTTP_404_NOT_FOUND)
+
+    if not player_name:
+        player_count = await game.players.acount()
+        player_name = f"Player {player_count + 1}"
+
+    player = await Player.objects.acreate(game=game, name=player_name, userId=user_account)
+    message = announce_player(game, player, 'add_player', f"{player.name} added to the game")
+    players = [player async for player in game.players.select_related('userId')]
+    return add_player_response(game, player, players, message)
+
+
+@require_POST
+async def name_player(request, gameId):
+    game = await aget_object_or_404(Game, gameId=gameId)
+    if await game.players.acount() < 1:
+        return JsonResponse({'error': f"No players found for game {gameId}"}, status=404)
+
+    body_data = read_json(request)
+    if body_data is None:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+    user_id_str = body_data.get('userId')
+    new_player_name = body_data.get('name')
+    player_id_str = body_data.get('playerId')
+
+    if not all([user_id_str, new_player_name, player_id_str]):
+        return JsonResponse({'error': 'playerId, userId and name parameters are required'}, status=400)
+
+    try:
+        player = await Player.objects.select_related('userId').aget(playerId=uuid.UUID(player_id_str), game=game)
+    except Player.DoesNotExist:
+        return JsonResponse({'error': f"No player {player_id_str} to rename for game {gameId}"}, status=404)
+    except ValueError:
+        return JsonResponse({'error': f"Invalid player id {player_id_str} to rename for game {gameId}"}, status=400)
+
+    if str(player.userId.userId) != user_id_str:
+        return JsonResponse({'error': f"You cannot rename a player that is not your own. player:{player_id_str}"}, status=401)
+
+    original_name = player.name
+    player.name = new_player_name
+    await player.asave()
+
+    announce_player(game, player, 'name_player', f"{original_name} renamed to {new_player_name}")
+
+    response_data = {
+        'player': (await socketSession.run(prepare_player_data, [player]))[0],
+        'game': (await aget_game_snapshot(game.gameId)).data
+    }
+    return JsonResponse(response_data, status=200)
+
+
+@require_POST
+async def claim_player(request, gameId):
+    body_data = read_json(request)
+    if body_data is None:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+    session_id_str = body_data.get('sessionId', None)
+    user_id = await socketSession.run(get_user_from_session, session_id_str)
+    user_id_str = str(user_id)
+
+    trace("claim_player", game_id=gameId, session_id=session_id_str, user_id=user_id_str)
+
+    if not session_id_str:
+        return JsonResponse({"error": f"No session id"}, status=400)
+    if not user_id:
+        return JsonResponse({"error": f"No user id for session id {session_id_str}"}, status=400)
+
+    try:
+        snapshot = await aget_game_snapshot(gameId)
+    except Game.DoesNotExist:
+        return JsonResponse({"error": "Game not found"}, status=404)
+    return await socketSession.run(claim_from_snapshot, snapshot, gameId, session_id_str, user_id_str)
@@ -0,0 +1,128 @@
+# game/codecs.py
+import json
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for the game.msgpack subprotocol
+    msgpack = None
+
+
+# short keys for the compact codecs. Only the envelope, the top level of a
+# message, is renamed: what it carries may hold user data or ids as keys,
+# so nested dicts go out as they are.
+COMPACT_KEYS = {
+    'type': 't',
+    'message': 'm',
+    'data': 'd',
+    'gameId': 'g',
+    'game': 'G',
+    'game_identifier': 'gi',
+    'playerId': 'p',
+    'player': 'P',
+    'players': 'ps',
+    'player_id': 'pi',
+    'userId': 'u',
+    'user_id': 'ui',
+    'session_id': 'si',
+    'sessionId': 's',
+    'name': 'n',
+    'isActive': 'a',
+    'status': 'st',
+    'previous': 'pv',
+    'version': 'v',
+    'changes': 'c',
+    'op': 'o',
+    'messages': 'ms',
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+
+
+def rename_keys(message, keys):
+    if type(message) is not dict:
+        return message
+    return {keys.get(key, key): item for key, item in message.items()}
+
+
+class JSONCodec:
+    """ the original wire format: one JSON text frame per message """
+
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+    def batch(self, frames):
+        """ {"type": "batch", "messages": [...]} built from already encoded frames """
+        return '{"type": "batch", "messages": [' + ', '.join(frames) + ']}'
+
+    def frame(self, encoded):
+        """ keyword arguments for AsyncWebsocketConsumer.send() """
+        if self.binary:
+            return {'bytes_data': encoded}
+        return {'text_data': encoded}
+
+
+class CompactJSONCodec(JSONCodec):
+    """ JSON text frames with COMPACT_KEYS envelopes and no whitespace """
+
+    name = 'compact-json'
+    subprotocol = 'game.compact-json'
+
+    def encode(self, message):
+        return json.dumps(rename_keys(message, COMPACT_KEYS), separators=(',', ':'))
+
+    def decode(self, frame):
+        return rename_keys(json.loads(frame), EXPANDED_KEYS)
+
+    def batch(self, frames):
+        return '{"t":"batch","ms":[' + ','.join(frames) + ']}'
+
+
+class MsgPackCodec(JSONCodec):
+    """ MessagePack binary frames with COMPACT_KEYS envelopes """
+
+    name = 'msgpack'
+    subprotocol = 'game.msgpack'
+    binary = True
+
+    def encode(self, message):
+        return msgpack.packb(rename_keys(message, COMPACT_KEYS))
+
+    def decode(self, frame):
+        return rename_keys(msgpack.unpackb(frame), EXPANDED_KEYS)
+
+    def batch(self, frames):
+        # a two entry map whose array value is the packed frames laid end to end
+        return (b'\x82' + msgpack.packb('t') + msgpack.packb('batch') + msgpack.packb('ms')
+                + msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames))
+
+
+DEFAULT_CODEC = JSONCodec()
+CODECS = {CompactJSONCodec.subprotocol: CompactJSONCodec()}
+if msgpack is not None:
+    CODECS[MsgPackCodec.subprotocol] = MsgPackCodec()
+
+
+def negotiate(subprotocols):
+    """ the first codec the client offered that we support, else plain JSON """
+    for subprotocol in subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return DEFAULT_CODEC
+
+
+def encode_frames(message):
+    """
+    `message` encoded once for every codec, keyed by codec name, so a group
+    broadcast costs a fixed number of encodes however many sockets get it
+    """
+    frames = {DEFAULT_CODEC.name: DEFAULT_CODEC.encode(message)}
+    for codec in CODECS.values():
+        frames[codec.name] = codec.encode(message)
+    return frames
@@ -1,11 +1,24 @@
 ﻿import json
-from collections import defaultdict
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 import logging
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .codecs import encode_frames, negotiate
+from .heartbeat import IDLE_CLOSE_CODE, reaper
+from .models import Game
+from .outbox import outbox
+from .roomstate import room_delta, room_log
+from .sessions import Compactor, get_session_store
+from .snapshots import snapshots
+from .ratelimit import FRAME_TOO_BIG_CLOSE_CODE, TokenBucket, limit_options, rejected, room_bucket
+from .socketqueue import SocketQueue, queue_options
+from .tracing import Tracer
 
 logger = logging.getLogger(__name__)
+trace = Tracer(__name__)
 
 
 def loggering(message):
@@ -33,42 +46,23 @@ def jd(arg):
 
 
 
-def debug_socket_lookup(prefix: str, socket_id: str, socketSession: dict):
-    session_id = socketSession.get(socket_id)
-    user_id = socketSession.get(session_id) if session_id else None
-
-    logger.info(f"🧩 {prefix} socket_id={socket_id[:8]} "
-                 f"session_id={str(session_id)[:8] if session_id else 'None'} "
-                 f"user_id={str(user_id)[:8] if user_id else 'None'}")
-
-def dump_socket_session(label: str, socketSession: dict):
-    logger.info(f"=== SOCKET SESSION DUMP: {label} ===")
-    snapshot = {
-        k: str(v)[:8] if not isinstance(v, dict) else {kk: str(vv)[:8] for kk, vv in v.items()}
-        for k, v in socketSession.items()
-    }
-    logger.info(json.dumps(snapshot, indent=2))
-
-# socketSession structure
-# socketSession = {
-#     'room_name': {
-#         'user_id': {
-#             'session_id': 'player_id',
-#         },
-#     },
-#     'socket_id': 'session_id',
-#     'session_id': 'user_id',
-# }
-socketSession = defaultdict(dict)
+# socketSession indexes (see game/sessions.py)
+#     socket_id  <-> session_id
+#     session_id  -> user_id
+#     room_name   -> user_id -> {session_id: player_id}
+#     room_name   -> {player_id: session_id}
+# the backend comes from settings.GAME_SESSION_STORE
+socketSession = get_session_store()
+# empty entries are pruned as sessions leave; this sweeps up the rest
+compactor = Compactor(socketSession)
 
 def reset_socket_session():
     socketSession.clear()
     return socketSession
 
 def get_player_from_session(session_id, room_name):
-    user_id = get_user_from_session(session_id)
-    session_players = get_session_players_from_user(user_id, room_name)
-    return session_players.get(session_id, None)
+    session_id_str = str(session_id) if session_id else None
+    return socketSession.player_for_session(session_id_str, str(room_name)) if session_id else None
 
 def get_player_from_socket(socket_id, room_name):
     session_id = get_session_from_socket(socket_id)
@@ -76,44 +70,23 @@ def get_player_from_socket(socket_id, room_name):
 
 def get_user_from_session(session_id):
     session_id_str = str(session_id) if session_id else None
-    return socketSession.get(session_id_str, None) if session_id else None
+    return socketSession.user_for_session(session_id_str) if session_id else None
 
 def get_session_from_socket(socket_id):
     socket_id_str = str(socket_id) if socket_id else None
-    return socketSession.get(socket_id_str, None) if socket_id else None
+    return socketSession.session_for_socket(socket_id_str) if socket_id else None
 
 def get_socket_from_session(session_id):
-    session_id_str = str(session_id)
-    for socket_id_str, session_str in socketSession.items():
-        if session_str == session_id_str:
-            return socket_id_str
-    return None
+    return socketSession.socket_for_session(str(session_id))
 
 def get_player_sessions_from_room(room_name):
-    room_name_str = str(room_name)
-    output = {}
-    if room_name_str in socketSession:
-        for user_id_str, sessions in socketSession[room_name].items():
-            for session_id_str, player_id_str in sessions.items():
-                output[player_id_str] = session_id_str
-    return output
+    return socketSession.player_sessions(str(room_name))
 
 def get_session_from_player(player_id, room_name):
-    room_name_str = str(room_name)
-    player_id_str = str(player_id)
-    if room_name_str in socketSession:
-        for user_id_str, sessions in socketSession[room_name].items():
-            for session_id_str, current_player_id_str in sessions.items():
-                if current_player_id_str == player_id_str:
-                    return session_id_str
-    return None
+    return socketSession.session_for_player(str(player_id), str(room_name))
 
 def get_session_players_from_user(user_id, room_name):
-    room_name_str = str(room_name)
-    user_id_str = str(user_id)
-    if room_name_str in socketSession:
-        return socketSession[room_name_str].get(user_id_str, {})
-    return {}
+    return socketSession.session_players(str(user_id), str(room_name))
 
 def get_socket_from_player(player_id, room_name):
     room_name_str = str(room_name)
@@ -121,82 +94,146 @@ def get_socket_from_player(player_id, room_name):
     session_id_str = get_session_from_player(player_id_str, room_name_str)
     return get_socket_from_session(session_id_str) if session_id_str else None
 
+def get_room_version(room_name):
+    return socketSession.room_version(str(room_name))
+
+def room_etag(version):
+    """ ETag for anything built from a room at `version` """
+    return f'"{socketSession.epoch}.{version}"'
+
+def room_changed(room_name, changes):
+    """ records a Game / Player change and pushes it to the room as a delta """
+    previous, current = socketSession.bump_room(str(room_name))
+    snapshots.invalidate(room_name)
+    GameConsumer.send_room_delta(room_name, previous, current, changes)
+
+def room_sessions_changed(room_name, player_ids):
+    """
+    as room_changed, for sessions binding to or leaving the given players,
+    but only the store side: returns the send_room_delta() arguments, so
+    that code running on the store's own thread (socketSession.run) can
+    leave the broadcast to its caller on the event loop
+    """
+    previous, current = socketSession.bump_room(str(room_name))
+    active_players = get_player_sessions_from_room(room_name)
+    snapshots.set_active(room_name, active_players, previous, current)
+    changes = [
+        {'op': 'player_active', 'playerId': str(player_id), 'isActive': str(player_id) in active_players}
+        for player_id in dict.fromkeys(player_ids) if player_id is not None
+    ]
+    return room_name, previous, current, changes
+
 def socket_session_connect(session_id, user_id, socket_id, room_name):
-    debug_socket_lookup("BEFORE socket_session_connect", socket_id, socketSession)
-    session_id_str = str(session_id)
-    user_id_str = str(user_id)
-    socket_id_str = str(socket_id)
-    room_name_str = str(room_name)
+    socketSession.connect(str(session_id), str(user_id), str(socket_id), str(room_name))
+    trace("socket_session_connect", socket_id=socket_id, session_id=session_id, user_id=user_id,
+          room_name=room_name, sessions=socketSession.as_dict)
 
-    socketSession[socket_id_str] = session_id_str
-    socketSession[session_id_str] = user_id_str
 
-    if room_name_str not in socketSession:
-        socketSession[room_name_str] = {}
-    if user_id_str not in socketSession[room_name_str]:
-        socketSession[room_name_str][user_id_str] = {}
-    debug_socket_lookup("AFTER socket_session_connect", socket_id, socketSession)
-    dump_socket_session("AFTER session_user mapping", socketSession)
+def bind_socket_player(player_id, socket_id, room_name):
+    """ socket_session_player() without the broadcast; returns the room delta to send """
+    previous_player_id = get_player_from_socket(socket_id, room_name)
+    socketSession.bind_player(str(player_id), str(socket_id), str(room_name))
+    delta = room_sessions_changed(room_name, [previous_player_id, player_id])
+    trace("socket_session_player", socket_id=socket_id, player_id=player_id, room_name=room_name,
+          session_id=lambda: get_session_from_socket(socket_id), sessions=socketSession.as_dict)
+    return delta
 
 
 def socket_session_player(player_id, socket_id, room_name):
-    debug_socket_lookup("BEFORE socket_session_player", socket_id, socketSession)
-    socket_id_str = str(socket_id)
-    room_name_str = str(room_name)
-    player_id_str = str(player_id)
-    session_id_str = socketSession.get(socket_id_str, None)
-    user_id_str = socketSession.get(session_id_str, None) if session_id_str else None
-    if room_name_str in socketSession:
-        if user_id_str in socketSession[room_name_str]:
-            socketSession[room_name_str][user_id_str][session_id_str] = player_id_str
-    debug_socket_lookup("AFTER socket_session_player", socket_id, socketSession)
-    dump_socket_session("AFTER session_player mapping", socketSession)
+    GameConsumer.send_room_delta(*bind_socket_player(player_id, socket_id, room_name))
+
+
+def unbind_socket(socket_id, room_name):
+    """ socket_session_disconnect() without the broadcast; returns (player id, room delta to send or None) """
+    player_id_str = socketSession.disconnect(str(socket_id), str(room_name))
+    delta = room_sessions_changed(room_name, [player_id_str]) if player_id_str is not None else None
+    trace("socket_session_disconnect", socket_id=socket_id, room_name=room_name, player_id=player_id_str)
+    return player_id_str, delta
 
 
 def socket_session_disconnect(socket_id, room_name):
-    debug_socket_lookup("BEFORE socket_session_disconnect", socket_id, socketSession)
-    room_name_str = str(room_name)
-    socket_id_str = str(socket_id)
-    session_id_str = socketSession.pop(socket_id_str, None)
-    user_id_str = socketSession.pop(session_id_str, None) if session_id_str else None
-    print(f"socketSession keys: {list(socketSession.keys())}")
-    print(f"room_name={room_name!r} ({type(room_name)}), room_name_str={room_name_str!r}")
-    if user_id_str is not None and room_name in socketSession:
-        if user_id_str in socketSession[room_name_str]:
-            socketSession[room_name_str][user_id_str].pop(session_id_str, None)
-    debug_socket_lookup("AFTER socket_session_disconnect", socket_id, socketSession)
+    player_id_str, delta = unbind_socket(socket_id, room_name)
+    if delta is not None:
+        GameConsumer.send_room_delta(*delta)
+    return player_id_str
 
 class GameConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.socket_id = self.channel_name
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'game_{self.room_name}'
+        # clients may offer game.compact-json or game.msgpack; plain JSON otherwise
+        self.codec = negotiate(self.scope.get('subprotocols', []))
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept(subprotocol=self.codec.subprotocol)
+        options = queue_options()
+        self.outbound = SocketQueue(
+            self.send, self.close, self.codec,
+            window=options['COALESCE_WINDOW'], max_size=options['MAX_QUEUE'], overflow=options['OVERFLOW'])
+        self.limits = limit_options()
+        self.socket_bucket = TokenBucket(self.limits['SOCKET_RATE'], self.limits['SOCKET_BURST'])
+        self.room_bucket = room_bucket(self.room_name, self.limits['ROOM_RATE'], self.limits['ROOM_BURST'])
+        self.rate_limited = False
+        self.last_seen = self.last_ping = time.monotonic()
+        self.answers_pings = False
+        self.left_room = False
+        reaper.register(self)
+        compactor.register(self, getattr(settings, 'GAME_SESSION_COMPACT_INTERVAL', 300))
 
     async def disconnect(self, close_code):
+        reaper.unregister(self)
+        compactor.unregister(self)
+        await self.leave_room()
+
+    async def leave_room(self):
+        # runs once, from disconnect() or from the reaper evicting the socket first
+        if getattr(self, 'left_room', True):
+            return
+        self.left_room = True
+        self.outbound.stop()
         room_name = str(self.room_name)
         socket_id = self.socket_id
-        player_id = get_player_from_socket(socket_id, room_name)
-        socket_session_disconnect(socket_id, room_name)
+        player_id = await socketSession.run(get_player_from_socket, socket_id, room_name)
+        # the store work runs on the store's thread, the broadcast back here on the loop
+        _, delta = await socketSession.run(unbind_socket, socket_id, room_name)
+        if delta is not None:
+            self.send_room_delta(*delta)
         await self.handle_player_disconnect(player_id)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
+    def ping(self):
+        self.outbound.put(self.codec.encode({'type': 'ping'}))
+
+    async def evict(self):
+        """ drop a socket the reaper found silent, as if it had disconnected """
+        await self.leave_room()
+        await self.close(code=IDLE_CLOSE_CODE)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
-            message_type = data.get("type")
+            data = self.codec.decode(text_data if text_data is not None else bytes_data)
+            message_type = data.get("type") if type(data) is dict else None
+
+            # messages that reach the whole room share one budget per room
+            if message_type in self.limits['ROOM_LIMITED_TYPES'] and not self.room_bucket.take():
+                rejected['room'] += 1
+                await self.reject_rate_limited('room')
+                return
+            self.rate_limited = False
 
             handlers = {
                 "clientMessage": self.handle_client_message,
                 "sessionUser": self.handle_session_user,
-                "sessionPlayer": self.handle_session_player
+                "sessionPlayer": self.handle_session_player,
+                "resync": self.handle_resync,
+                "ping": self.handle_ping,
+                "pong": self.handle_pong,
             }
 
             handler = handlers.get(message_type)
@@ -205,45 +242,106 @@ class GameConsumer(AsyncWebsocketConsumer):
             else:
                 logger.warning(f"Unknown message type: {message_type}")
 
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON received")
+        except (ValueError, TypeError):
+            logger.error(f"Invalid {type(self.codec).__name__} frame received")
+
+    async def send_message(self, message):
+        self.outbound.put(self.codec.encode(message))
+
+    async def send_frames(self, event):
+        frames = event.get("frames")
+        if frames and self.codec.name in frames:
+            self.outbound.put(frames[self.codec.name])
+        else:
+            await self.send_message(event["data"])
+
+    # handlers that only queue a frame; they never touch the database, so
+    # they skip the close_old_connections thread hop dispatch() makes for
+    # every message
+    QUEUE_ONLY_HANDLERS = frozenset({"broadcast_message", "room_delta"})
+
+    async def dispatch(self, message):
+        if message["type"] in self.QUEUE_ONLY_HANDLERS:
+            await getattr(self, message["type"])(message)
+        elif message["type"] != "websocket.receive" or await self.admit_frame(message):
+            await super().dispatch(message)
+
+    async def admit_frame(self, message):
+        """ size and rate checks on a raw inbound frame, before it is parsed """
+        # any frame, even one refused below, shows the client is still there
+        self.last_seen = time.monotonic()
+        frame = message.get("text")
+        if frame is None:
+            frame = message.get("bytes") or b""
+        if len(frame) > self.limits['MAX_FRAME_SIZE']:
+            rejected['oversized'] += 1
+            logger.warning(f"Closing socket {self.socket_id}: {len(frame)} byte frame")
+            await self.close(code=FRAME_TOO_BIG_CLOSE_CODE)
+            return False
+        if not self.socket_bucket.take():
+            rejected['socket'] += 1
+            await self.reject_rate_limited('socket')
+            return False
+        return True
+
+    async def reject_rate_limited(self, scope):
+        # one notice per run of rejected frames, so a flood is not answered frame for frame
+        if not self.rate_limited:
+            self.rate_limited = True
+            await self.send_message({'type': 'rate_limited', 'scope': scope})
 
 
     async def player_added(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'player_added',
             'message': message,
-        }))
+        })
         
     async def player_disconnected(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': event.get('type', 'player_disconnected'),
             'message': event.get('message', ''),
             'data': event.get('data', {})
-        }))
+        })
 
     async def broadcast_message(self, event):
-        await self.send(text_data=json.dumps(event["data"]))
-        
+        await self.send_frames(event)
+
+    async def room_delta(self, event):
+        room_log.record(event["data"])
+        await self.send_frames(event)
+
+    @staticmethod
+    def group_event(handler, message, keep_data=False):
+        """
+        A channel layer event for `handler` carrying `message` already encoded
+        for every codec, so each consumer in the group only writes a frame.
+        """
+        event = {"type": handler, "frames": encode_frames(message)}
+        if keep_data:
+            event["data"] = message
+        return event
+
     @classmethod
     def send_message_to_group(cls, group_name, json_data):
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {"type": "broadcast_message", "data": json_data})
+        # queued for the event loop; the calling view does not wait for the fan-out
+        outbox.post(group_name, cls.group_event("broadcast_message", json_data))
+
+    @classmethod
+    def send_room_delta(cls, room_name, previous, version, changes):
+        delta = room_delta(room_name, previous, version, changes)
+        room_log.record(delta)
+        outbox.post(f"game_{room_name}", cls.group_event("room_delta", delta, keep_data=True))
 
 
     async def handle_client_message(self, data):
         message = data.get("message")
-        print(f"Client message received: {message}")
+        trace("client_message", room_name=self.room_name, socket_id=self.socket_id, message=message)
         # Send message to room group
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'type': 'broadcast_message',
-                "data": {'message': f'{message} received'},
-            }
+            self.group_event('broadcast_message', {'message': f'{message} received'})
         )
         
     async def handle_session_user(self, data):
@@ -251,52 +349,89 @@ class GameConsumer(AsyncWebsocketConsumer):
         user_id = data.get("userId")
         socket_id = self.socket_id
         room_name = self.room_name
-        socket_session_connect(session_id, user_id, socket_id, room_name)
-        await self.send(text_data=json.dumps({
+        await socketSession.run(socket_session_connect, session_id, user_id, socket_id, room_name)
+        await self.send_message({
             'type': 'handle_session_user',
             'message': f'socket->session / session->user mapped',
             'session_id': session_id,
             'user_id': user_id,
-        }))
+        })
 
 
     async def handle_session_player(self, data):
         player_id = data.get("playerId")
         room_name = self.room_name
         socket_id = self.socket_id
-        session_id = socketSession.get(socket_id, None)
-        user_id = socketSession.get(session_id, None) if session_id else None
-        socket_session_player(player_id, socket_id, room_name)
+        session_id = await socketSession.run(get_session_from_socket, socket_id)
+        user_id = await socketSession.run(get_user_from_session, session_id)
+        self.send_room_delta(*await socketSession.run(bind_socket_player, player_id, socket_id, room_name))
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'type': 'broadcast_handle_session_player',
+            self.group_event('broadcast_message', {
+                'type': 'handle_session_player',
                 'message': f'socketSession[{room_name}][{user_id}][{session_id}] = {player_id}',
                 'session_id': session_id,
                 'user_id': user_id,
                 'player_id': player_id,
-            }
+            })
         )
 
+    async def handle_ping(self, data):
+        await self.send_message({'type': 'pong'})
+
+    async def handle_pong(self, data):
+        # last_seen was already updated by admit_frame(); from now on this
+        # client is known to keep the socket alive, so it may be evicted
+        self.answers_pings = True
+
+    async def handle_resync(self, data):
+        # {"type": "resync", "version": n} replays the deltas since n when this
+        # worker still has them, otherwise sends the whole game
+        version = data.get("version")
+        current = await socketSession.run(get_room_version, self.room_name)
+        deltas = room_log.since(self.room_name, version, current) if type(version) is int else None
+        if deltas is not None:
+            for delta in deltas:
+                await self.send_message(delta)
+            return
+
+        # views imports this module
+        from .views import get_game_snapshot
+        try:
+            snapshot = await database_sync_to_async(get_game_snapshot)(self.room_name, current)
+            game, version = snapshot.data, snapshot.version
+        except Game.DoesNotExist:
+            game, version = None, current
+        await self.send_message({
+            'type': 'room_snapshot',
+            'gameId': self.room_name,
+            'version': version,
+            'game': game,
+        })
+
+    # player_added, player_disconnected and broadcast_handle_session_player
+    # are no longer sent from here; they still handle events from workers
+    # running the previous release
+
     async def broadcast_handle_session_player(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'handle_session_player',
             'message': event['message'],
             'session_id': event['session_id'],
             'user_id': event['user_id'],
             'player_id': event['player_id'],
-        }))
+        })
 
     async def handle_player_disconnect(self, player_id):
         game_id = self.room_name
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'message': f"{player_id} disconnected",
+            self.group_event('broadcast_message', {
                 'type': 'player_disconnected',
+                'message': f"{player_id} disconnected",
                 'data': {
                     'playerId': str(player_id),
                     'game_identifier': game_id,
                 }
-            }
+            })
         )
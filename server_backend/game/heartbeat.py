@@ -0,0 +1,79 @@
+# game/heartbeat.py
+import asyncio
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# close code sent to a socket evicted for not answering pings
+IDLE_CLOSE_CODE = 4000
+
+
+def heartbeat_options():
+    options = {'PING_INTERVAL': 20, 'IDLE_TIMEOUT': 60, 'REAP_INTERVAL': 5}
+    options.update(getattr(settings, 'GAME_SOCKET_HEARTBEAT', None) or {})
+    return options
+
+
+class Reaper:
+    """
+    One task per worker that pings quiet sockets and evicts those that have
+    sent nothing, pong included, for IDLE_TIMEOUT seconds. Only a socket
+    that has answered a ping at least once is evicted: clients written
+    before the heartbeat never send a pong, and are kept however quiet they
+    are.
+
+    Consumers register with a `last_seen` monotonic timestamp, an
+    `answers_pings` flag, a ping() method and an async evict(). The task
+    stops when the last consumer leaves and is started again by the next
+    one.
+    """
+
+    def __init__(self):
+        self._consumers = weakref.WeakSet()
+        self._task = None
+        self.evicted = 0
+
+    def register(self, consumer):
+        self._consumers.add(consumer)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    def unregister(self, consumer):
+        self._consumers.discard(consumer)
+
+    async def _run(self):
+        while self._consumers:
+            options = heartbeat_options()
+            await asyncio.sleep(options['REAP_INTERVAL'])
+            self.sweep(options)
+
+    def sweep(self, options):
+        now = time.monotonic()
+        ping_interval, idle_timeout = options['PING_INTERVAL'], options['IDLE_TIMEOUT']
+        for consumer in list(self._consumers):
+            idle = now - consumer.last_seen
+            if idle_timeout and idle > idle_timeout and consumer.answers_pings:
+                self._consumers.discard(consumer)
+                self.evicted += 1
+                asyncio.ensure_future(self._evict(consumer, idle))
+            elif ping_interval and idle > ping_interval and now - consumer.last_ping > ping_interval:
+                consumer.last_ping = now
+                consumer.ping()
+
+    async def _evict(self, consumer, idle):
+        logger.info(f"Evicting socket {consumer.socket_id}: nothing received for {idle:.1f}s")
+        try:
+            await consumer.evict()
+        except Exception:
+            logger.exception(f"Evicting socket {consumer.socket_id} failed")
+
+    def __len__(self):
+        return len(self._consumers)
+
+
+reaper = Reaper()
@@ -0,0 +1,379 @@
+# game/layers.py
+import asyncio
+import base64
+import fnmatch
+import json
+import logging
+import re
+import sqlite3
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable by the channel layer")
+
+
+def _decode_hook(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+class _LocalChannel:
+    __slots__ = ('messages', 'waiter')
+
+    def __init__(self):
+        self.messages = deque()
+        self.waiter = None
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared by every process that points at the same SQLite file,
+    so group_send from one Daphne worker reaches sockets held by the others
+    without running a broker.
+
+    Messages for channels owned by this process never touch the database;
+    everything else is written in one transaction per send / group_send and
+    picked up by the owning process's poller, which drains all of its
+    channels with a single query.
+
+    group_options maps group name globs to {'capacity': n, 'expiry': seconds}
+    overriding the layer defaults for messages fanned out to that group.
+    """
+
+    extensions = ['groups', 'flush']
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS layer_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            process TEXT NOT NULL,
+            expires REAL NOT NULL,
+            body TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS layer_messages_process ON layer_messages (process, id);
+        CREATE INDEX IF NOT EXISTS layer_messages_channel ON layer_messages (channel);
+        CREATE TABLE IF NOT EXISTS layer_groups (
+            group_name TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            process TEXT NOT NULL,
+            joined REAL NOT NULL,
+            PRIMARY KEY (group_name, channel)
+        );
+        CREATE INDEX IF NOT EXISTS layer_groups_process ON layer_groups (process);
+        CREATE TABLE IF NOT EXISTS layer_processes (
+            process TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+    """
+
+    def __init__(
+        self,
+        path,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        group_options=None,
+        poll_interval=0.01,
+        max_poll_interval=0.1,
+        batch_size=500,
+        process_timeout=30,
+        timeout=5.0,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_options = [
+            (pattern if hasattr(pattern, 'match') else re.compile(fnmatch.translate(pattern)), options)
+            for pattern, options in (group_options or {}).items()
+        ]
+        self.group_expiry = group_expiry
+        self.path = str(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.batch_size = batch_size
+        self.process_timeout = process_timeout
+
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self.own_processes = set()
+        self.local_channels = {}
+        self._loop = None
+        self._poller = None
+        self._housekept = 0.0
+        self._connection = None
+        # sqlite work happens on one dedicated thread so the event loop never blocks on file locks
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+        self._executor.submit(self._setup).result()
+
+    # database side, only ever run on the executor thread
+
+    def _setup(self):
+        self._connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+
+    def _db_insert(self, channel, process, expires, body, capacity):
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            (pending,) = connection.execute(
+                'SELECT count(*) FROM layer_messages WHERE channel = ?', (channel,)).fetchone()
+            sent = pending < capacity
+            if sent:
+                connection.execute(
+                    'INSERT INTO layer_messages (channel, process, expires, body) VALUES (?, ?, ?, ?)',
+                    (channel, process, expires, body))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return sent
+
+    def _db_fan_out(self, group, expires, body, capacity):
+        """ queues body for every remote member of group and returns the local members """
+        connection = self._connection
+        stale = time.time() - self.process_timeout
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            members = connection.execute(
+                'SELECT g.channel, g.process FROM layer_groups g '
+                'LEFT JOIN layer_processes p ON p.process = g.process '
+                'WHERE g.group_name = ? AND (p.last_seen IS NULL OR p.last_seen > ?)',
+                (group, stale)).fetchall()
+            local = [channel for channel, process in members if process in self.own_processes]
+            remote = [(channel, process) for channel, process in members if process not in self.own_processes]
+            if remote:
+                placeholders = ','.join('?' * len(remote))
+                pending = dict(connection.execute(
+                    f'SELECT channel, count(*) FROM layer_messages WHERE channel IN ({placeholders}) GROUP BY channel',
+                    [channel for channel, _ in remote]).fetchall())
+                connection.executemany(
+                    'INSERT INTO layer_messages (channel, process, expires, body) VALUES (?, ?, ?, ?)',
+                    [
+                        (channel, process, expires, body)
+                        for channel, process in remote
+                        if pending.get(channel, 0) < capacity
+                    ])
+        except BaseException:
+            # a partial fan-out would reach some members and not others
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return local
+
+    def _db_take(self, processes):
+        placeholders = ','.join('?' * len(processes))
+        rows = self._connection.execute(
+            f'DELETE FROM layer_messages WHERE id IN ('
+            f'SELECT id FROM layer_messages WHERE process IN ({placeholders}) ORDER BY id LIMIT ?'
+            f') RETURNING id, channel, expires, body',
+            (*processes, self.batch_size)).fetchall()
+        rows.sort()
+        return rows
+
+    def _db_housekeeping(self, processes):
+        connection = self._connection
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT OR REPLACE INTO layer_processes VALUES (?, ?)', [(process, now) for process in processes])
+            dead = [row[0] for row in connection.execute(
+                'SELECT process FROM layer_processes WHERE last_seen < ?', (now - self.process_timeout,))]
+            for table in ('layer_groups', 'layer_messages', 'layer_processes'):
+                connection.executemany(f'DELETE FROM {table} WHERE process = ?', [(process,) for process in dead])
+            connection.execute('DELETE FROM layer_messages WHERE expires < ?', (now,))
+            connection.execute('DELETE FROM layer_groups WHERE joined < ?', (now - self.group_expiry,))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _db_execute(self, query, params=()):
+        self._connection.execute(query, params)
+
+    def _db_flush(self):
+        for table in ('layer_messages', 'layer_groups', 'layer_processes'):
+            self._connection.execute(f'DELETE FROM {table}')
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    # process side
+
+    def _encode(self, message):
+        return json.dumps(message, default=_encode_default, separators=(',', ':'))
+
+    def _decode(self, body):
+        return json.loads(body, object_hook=_decode_hook)
+
+    def _options_for_group(self, group):
+        for pattern, options in self.group_options:
+            if pattern.match(group):
+                return options
+        return {}
+
+    def _process_for(self, channel):
+        return self.non_local_name(channel)
+
+    def _deliver(self, channel, expires, body, capacity):
+        local = self.local_channels.get(channel)
+        if local is None:
+            local = self.local_channels[channel] = _LocalChannel()
+        if len(local.messages) >= capacity:
+            return False
+        local.messages.append((expires, body))
+        if local.waiter is not None and not local.waiter.done():
+            local.waiter.set_result(None)
+        return True
+
+    async def _deliver_local(self, channels, expires, body, capacity):
+        """ hands messages to channels owned by this process, on the loop their receivers wait on """
+        loop = self._loop
+        if loop is None or loop.is_closed() or loop is asyncio.get_running_loop():
+            return [self._deliver(channel, expires, body, capacity) for channel in channels]
+
+        async def deliver():
+            return [self._deliver(channel, expires, body, capacity) for channel in channels]
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(deliver(), loop))
+
+    def _attach(self, loop):
+        if self._loop is not loop:
+            self._loop = loop
+        if self._poller is None or self._poller.done() or self._poller.get_loop() is not loop:
+            self._poller = loop.create_task(self._poll())
+
+    async def _poll(self):
+        interval = self.poll_interval
+        while True:
+            processes = set(self.own_processes)
+            processes.update(
+                channel for channel, local in self.local_channels.items()
+                if '!' not in channel and local.waiter is not None)
+            try:
+                if time.time() - self._housekept > self.process_timeout / 3:
+                    self._housekept = time.time()
+                    await self._run(self._db_housekeeping, sorted(self.own_processes))
+                    self._expire_local()
+                rows = await self._run(self._db_take, sorted(processes)) if processes else []
+            except sqlite3.Error:
+                logger.exception("SQLite channel layer poll failed")
+                rows = []
+            for _, channel, expires, body in rows:
+                self._deliver(channel, expires, body, self.get_capacity(channel))
+            if rows:
+                interval = self.poll_interval
+            else:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+    def _expire_local(self):
+        now = time.time()
+        for channel, local in list(self.local_channels.items()):
+            while local.messages and local.messages[0][0] < now:
+                local.messages.popleft()
+            if not local.messages and local.waiter is None:
+                del self.local_channels[channel]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        expires = time.time() + self.expiry
+        body = self._encode(message)
+        capacity = self.get_capacity(channel)
+        process = self._process_for(channel)
+        if process in self.own_processes:
+            (sent,) = await self._deliver_local([channel], expires, body, capacity)
+        else:
+            sent = await self._run(self._db_insert, channel, process, expires, body, capacity)
+        if not sent:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        self._attach(loop)
+
+        while True:
+            local = self.local_channels.get(channel)
+            if local is None:
+                local = self.local_channels[channel] = _LocalChannel()
+            while local.messages:
+                expires, body = local.messages.popleft()
+                if expires >= time.time():
+                    if not local.messages:
+                        self.local_channels.pop(channel, None)
+                    return self._decode(body)
+            local.waiter = loop.create_future()
+            try:
+                await local.waiter
+            finally:
+                local.waiter = None
+
+    async def new_channel(self, prefix="specific."):
+        channel = "%s.%s!%s" % (prefix, self.client_prefix, uuid.uuid4().hex)
+        process = self._process_for(channel)
+        if process not in self.own_processes:
+            self.own_processes.add(process)
+            await self._run(self._db_execute, 'INSERT OR REPLACE INTO layer_processes VALUES (?, ?)',
+                            (process, time.time()))
+        return channel
+
+    # Flush extension
+
+    async def flush(self):
+        self.local_channels = {}
+        await self._run(self._db_flush)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(
+            self._db_execute, 'INSERT OR REPLACE INTO layer_groups VALUES (?, ?, ?, ?)',
+            (group, channel, self._process_for(channel), time.time()))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(
+            self._db_execute, 'DELETE FROM layer_groups WHERE group_name = ? AND channel = ?', (group, channel))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+
+        options = self._options_for_group(group)
+        expires = time.time() + options.get('expiry', self.expiry)
+        capacity = options.get('capacity', self.capacity)
+        # encoded once, whatever the group size
+        body = self._encode(message)
+        local = await self._run(self._db_fan_out, group, expires, body, capacity)
+        if local:
+            await self._deliver_local(local, expires, body, capacity)
@@ -18,9 +18,23 @@ class Game(models.Model):
         ('completed', 'Completed')
     ], default='waiting')
 
+    class Meta:
+        indexes = [
+            # the lobby lists games by status, a page at a time in gameId order
+            models.Index(fields=['status', 'gameId'], name='game_status_gameid'),
+        ]
+
     def __str__(self):
         return f"Game {self.gameId} - {self.status}"
 
+class PlayerQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create skips save(), so set game_identifier here the same way
+        objs = list(objs)
+        for player in objs:
+            player.game_identifier = player.game_id
+        return super().bulk_create(objs, *args, **kwargs)
+
 class Player(models.Model):
     playerId = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     game = models.ForeignKey(Game, related_name='players', on_delete=models.CASCADE)
@@ -28,6 +42,8 @@ class Player(models.Model):
     game_identifier = models.CharField(max_length=16, editable=False)
     userId = models.ForeignKey('accounts.Account', on_delete=models.CASCADE, related_name='players')
 
+    objects = PlayerQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         # Set game_identifier to the game's id, truncated to 6 characters
         self.game_identifier = self.game.gameId
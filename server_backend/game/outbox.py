@@ -0,0 +1,116 @@
+# game/outbox.py
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import request_finished
+
+logger = logging.getLogger(__name__)
+
+
+def _server_loop():
+    """
+    The event loop serving this request, if there is one. Sync views under
+    Daphne run on a SyncToAsync executor thread which records the loop that
+    dispatched them.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    if getattr(SyncToAsync.threadlocal, 'main_event_loop_pid', None) != os.getpid():
+        return None
+    loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+    if loop is None or loop.is_closed() or not loop.is_running():
+        return None
+    return loop
+
+
+class BroadcastOutbox:
+    """
+    Collects group_send calls made by sync HTTP views and sends them from the
+    event loop once the response has gone out, so a request never waits on
+    the fan-out to every socket in the room. Messages keep the order they
+    were posted in.
+
+    The flush is kicked by request_finished; posts made outside a request
+    are flushed after `delay` seconds. Without a running server loop
+    (manage.py test, runserver) the message is sent inline, as before.
+    """
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._loop = None
+        # only touched on self._loop
+        self._timer = None
+        self._flushing = False
+
+    def post(self, group_name, message):
+        loop = _server_loop() if getattr(settings, 'GAME_BROADCAST_OUTBOX', True) else None
+        if loop is None:
+            async_to_sync(get_channel_layer().group_send)(group_name, message)
+            return
+
+        with self._lock:
+            self._pending.append((group_name, message))
+            if self._loop is not loop:
+                # whatever was scheduled on a previous loop died with it
+                self._loop = loop
+                self._timer = None
+                self._flushing = False
+        loop.call_soon_threadsafe(self._arm)
+
+    def kick(self):
+        loop = self._loop
+        if self._pending and loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._start)
+
+    def _arm(self):
+        if self._timer is None and not self._flushing:
+            self._timer = self._loop.call_later(self.delay, self._start)
+
+    def _start(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing or not self._pending:
+            return
+        self._flushing = True
+        self._loop.create_task(self.flush())
+
+    async def flush(self):
+        channel_layer = get_channel_layer()
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    batch = list(self._pending)
+                    self._pending.clear()
+                for group_name, message in batch:
+                    try:
+                        await channel_layer.group_send(group_name, message)
+                    except Exception:
+                        logger.exception(f"Broadcast to {group_name} failed")
+        finally:
+            self._flushing = False
+
+    def __len__(self):
+        return len(self._pending)
+
+
+outbox = BroadcastOutbox()
+
+
+def flush_outbox(sender, **kwargs):
+    outbox.kick()
+
+
+request_finished.connect(flush_outbox, dispatch_uid='game.outbox.flush_outbox')
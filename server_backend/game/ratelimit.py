@@ -0,0 +1,61 @@
+# game/ratelimit.py
+import time
+import weakref
+
+from django.conf import settings
+
+# close code for a frame over MAX_FRAME_SIZE (RFC 6455 "message too big")
+FRAME_TOO_BIG_CLOSE_CODE = 1009
+
+rejected = {'oversized': 0, 'socket': 0, 'room': 0}
+
+
+def limit_options():
+    options = {
+        'MAX_FRAME_SIZE': 16384,
+        'SOCKET_RATE': 20, 'SOCKET_BURST': 40,
+        'ROOM_RATE': 100, 'ROOM_BURST': 200,
+        'ROOM_LIMITED_TYPES': ('clientMessage', 'sessionPlayer'),
+    }
+    options.update(getattr(settings, 'GAME_SOCKET_LIMITS', None) or {})
+    return options
+
+
+class TokenBucket:
+    """ `rate` tokens a second, holding at most `burst`; a rate of 0 never limits """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# one bucket per room shared by the sockets in it on this worker; it goes
+# away with the last consumer holding it
+_room_buckets = weakref.WeakValueDictionary()
+
+
+def room_bucket(room_name, rate, burst):
+    bucket = _room_buckets.get(room_name)
+    if bucket is None:
+        bucket = _room_buckets[room_name] = _RoomBucket(rate, burst)
+    return bucket
+
+
+class _RoomBucket(TokenBucket):
+    # __slots__ classes need a __weakref__ slot to live in a WeakValueDictionary
+    __slots__ = ('__weakref__',)
@@ -0,0 +1,81 @@
+# game/roomstate.py
+import threading
+from collections import OrderedDict
+
+
+def room_delta(room_name, previous, version, changes):
+    """
+    The room_delta message sent to clients. A client holding the room at
+    `previous` applies `changes` and is then at `version`; any other client
+    asks for a resync from the version it has.
+
+    changes are applied in order:
+        {'op': 'player_added', 'player': {...}}       same fields as /info/ players
+        {'op': 'player_renamed', 'playerId': ..., 'name': ...}
+        {'op': 'player_removed', 'playerId': ...}
+        {'op': 'player_active', 'playerId': ..., 'isActive': bool}
+        {'op': 'status', 'status': ...}
+        {'op': 'game_removed'}
+    """
+    return {
+        'type': 'room_delta',
+        'gameId': str(room_name),
+        'previous': previous,
+        'version': version,
+        'changes': changes,
+    }
+
+
+class RoomLog:
+    """
+    The most recent deltas seen for each room, indexed by the version they
+    apply to, so a client that missed a few can be replayed forward instead
+    of being sent the whole game.
+
+    The worker making a change records its delta when sending it, and every
+    worker records the deltas its sockets receive from other workers. Each
+    socket in a room receives the same delta, so a delta already logged
+    under its version is not recorded again.
+    """
+
+    def __init__(self, size=64, max_rooms=1024):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()     # room_name -> OrderedDict(previous -> delta)
+        self._lock = threading.Lock()
+
+    def record(self, delta):
+        room_name = delta['gameId']
+        with self._lock:
+            log = self._rooms.get(room_name)
+            if log is not None and delta['previous'] in log and log[delta['previous']]['version'] == delta['version']:
+                return
+            if log is None:
+                log = self._rooms[room_name] = OrderedDict()
+                while len(self._rooms) > self.max_rooms:
+                    self._rooms.popitem(last=False)
+            else:
+                self._rooms.move_to_end(room_name)
+            log[delta['previous']] = delta
+            while len(log) > self.size:
+                log.popitem(last=False)
+
+    def since(self, room_name, version, current):
+        """ the deltas leading from `version` to `current`, or None if some are missing """
+        with self._lock:
+            log = self._rooms.get(str(room_name), {})
+            deltas = []
+            while version != current:
+                delta = log.get(version)
+                if delta is None or len(deltas) >= self.size:
+                    return None
+                deltas.append(delta)
+                version = delta['version']
+            return deltas
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+room_log = RoomLog()
@@ -0,0 +1,556 @@
+# game/sessions.py
+import asyncio
+import functools
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+EMPTY = MappingProxyType({})
+
+
+class BaseSessionStore:
+    """
+    Tracks which socket belongs to which session, which user owns a session,
+    and which player each session is driving in a room.
+
+    It also numbers the changes made to each room. room_version() is drawn
+    from a store-wide sequence, so a room's version never repeats, and
+    `epoch` changes whenever the numbering starts over. Together they make
+    an ETag for anything derived from the room.
+
+    Entries for users and rooms are dropped as their last session leaves.
+    compact() also forgets the versions of rooms nobody is connected to;
+    such rooms then report the highest version forgotten so far, which a
+    room can only have reached by changing since any ETag it handed out.
+
+    Async code makes its calls through run(), which keeps them off the
+    event loop for stores that wait on disk or locks.
+
+    Backends are selected with settings.GAME_SESSION_STORE.
+    """
+
+    epoch = None
+    # seconds between heartbeat() calls, None for stores only one process sees
+    heartbeat_interval = None
+
+    async def run(self, function, *args):
+        """ function(*args), which uses the store, called from async code """
+        return function(*args)
+
+    def heartbeat(self):
+        """ marks this process alive and drops the sockets of processes that stopped doing so """
+        return 0
+
+    def clear(self):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide clear()")
+
+    # lookups
+
+    def session_for_socket(self, socket_id):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide session_for_socket()")
+
+    def socket_for_session(self, session_id):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide socket_for_session()")
+
+    def user_for_session(self, session_id):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide user_for_session()")
+
+    def player_for_session(self, session_id, room_name):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide player_for_session()")
+
+    def session_for_player(self, player_id, room_name):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide session_for_player()")
+
+    def player_sessions(self, room_name):
+        """ {player_id: session_id} for every bound player in the room """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide player_sessions()")
+
+    def session_players(self, user_id, room_name):
+        """ {session_id: player_id} for every session the user has in the room """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide session_players()")
+
+    # mutations
+
+    def connect(self, session_id, user_id, socket_id, room_name):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide connect()")
+
+    def bind_player(self, player_id, socket_id, room_name):
+        raise NotImplementedError("subclasses of BaseSessionStore must provide bind_player()")
+
+    def disconnect(self, socket_id, room_name):
+        """ unmaps the socket and its session, returning the player it was driving """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide disconnect()")
+
+    # room versions
+
+    def room_version(self, room_name):
+        """ the room's current version, 0 (or the compact() floor) if nothing has happened in it """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide room_version()")
+
+    def bump_room(self, room_name):
+        """ advances the room's version, returning (previous, current) """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide bump_room()")
+
+    def compact(self):
+        """ drops bookkeeping nothing refers to any more, returning how many entries went """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide compact()")
+
+    def as_dict(self):
+        """ the legacy flat socketSession layout, for debugging output """
+        raise NotImplementedError("subclasses of BaseSessionStore must provide as_dict()")
+
+
+class SessionRegistry(BaseSessionStore):
+    """
+    In-process session store. Every relation is kept in a forward and a
+    reverse index so that lookups in either direction are a single dict
+    access. Only sockets held by this process are visible.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._sequence = itertools.count(1)
+        self._room_versions = {}    # room_name -> version, kept across clear()
+        self._version_floor = 0     # version of rooms missing from _room_versions
+        self.clear()
+
+    def clear(self):
+        self._socket_session = {}   # socket_id -> session_id
+        self._session_socket = {}   # session_id -> socket_id
+        self._session_user = {}     # session_id -> user_id
+        self._rooms = {}            # room_name -> user_id -> {session_id: player_id}
+        self._room_players = {}     # room_name -> {player_id: session_id}
+        # every room just lost its sessions
+        version = next(self._sequence)
+        for room_name in self._room_versions:
+            self._room_versions[room_name] = version
+
+    def session_for_socket(self, socket_id):
+        return self._socket_session.get(socket_id)
+
+    def socket_for_session(self, session_id):
+        return self._session_socket.get(session_id)
+
+    def user_for_session(self, session_id):
+        return self._session_user.get(session_id)
+
+    def player_for_session(self, session_id, room_name):
+        user_id = self._session_user.get(session_id)
+        return self.session_players(user_id, room_name).get(session_id)
+
+    def session_for_player(self, player_id, room_name):
+        return self._room_players.get(room_name, EMPTY).get(player_id)
+
+    def player_sessions(self, room_name):
+        return MappingProxyType(self._room_players.get(room_name, {}))
+
+    def session_players(self, user_id, room_name):
+        return MappingProxyType(self._rooms.get(room_name, EMPTY).get(user_id, {}))
+
+    def connect(self, session_id, user_id, socket_id, room_name):
+        self._socket_session[socket_id] = session_id
+        self._session_socket[session_id] = socket_id
+        self._session_user[session_id] = user_id
+        self._rooms.setdefault(room_name, {}).setdefault(user_id, {})
+        self._room_players.setdefault(room_name, {})
+
+    def bind_player(self, player_id, socket_id, room_name):
+        session_id = self._socket_session.get(socket_id)
+        user_id = self._session_user.get(session_id) if session_id else None
+        if user_id is None:
+            return
+        # the user's entry is gone if another of their sessions left the room
+        sessions = self._rooms.setdefault(room_name, {}).setdefault(user_id, {})
+        room_players = self._room_players.setdefault(room_name, {})
+        previous_player_id = sessions.get(session_id)
+        if previous_player_id is not None and room_players.get(previous_player_id) == session_id:
+            del room_players[previous_player_id]
+        sessions[session_id] = player_id
+        room_players[player_id] = session_id
+
+    def disconnect(self, socket_id, room_name):
+        session_id = self._socket_session.pop(socket_id, None)
+        if session_id is None:
+            return None
+        if self._session_socket.get(session_id) == socket_id:
+            del self._session_socket[session_id]
+        user_id = self._session_user.pop(session_id, None)
+        users = self._rooms.get(room_name)
+        sessions = users.get(user_id) if users is not None else None
+        player_id = sessions.pop(session_id, None) if sessions is not None else None
+        room_players = self._room_players.get(room_name)
+        if player_id is not None and room_players and room_players.get(player_id) == session_id:
+            del room_players[player_id]
+        # prune what the session leaves empty
+        if sessions is not None and not sessions:
+            del users[user_id]
+        if users is not None and not users:
+            del self._rooms[room_name]
+        if room_players is not None and not room_players:
+            del self._room_players[room_name]
+        return player_id
+
+    def room_version(self, room_name):
+        return self._room_versions.get(room_name, self._version_floor)
+
+    def bump_room(self, room_name):
+        previous = self._room_versions.get(room_name, self._version_floor)
+        current = self._room_versions[room_name] = next(self._sequence)
+        return previous, current
+
+    def compact(self):
+        idle_rooms = [room_name for room_name in self._room_versions
+                      if room_name not in self._rooms and room_name not in self._room_players]
+        for room_name in idle_rooms:
+            self._version_floor = max(self._version_floor, self._room_versions.pop(room_name))
+        # sessions whose socket went on to another session
+        stale = [session_id for session_id, socket_id in self._session_socket.items()
+                 if self._socket_session.get(socket_id) != session_id]
+        for session_id in stale:
+            del self._session_socket[session_id]
+            self._session_user.pop(session_id, None)
+        # dicts keep their table size after deletes, so copy them to give it back
+        self._socket_session = dict(self._socket_session)
+        self._session_socket = dict(self._session_socket)
+        self._session_user = dict(self._session_user)
+        self._rooms = dict(self._rooms)
+        self._room_players = dict(self._room_players)
+        self._room_versions = dict(self._room_versions)
+        return len(idle_rooms) + len(stale)
+
+    def as_dict(self):
+        output = {}
+        for room_name, users in self._rooms.items():
+            output[room_name] = {user_id: dict(sessions) for user_id, sessions in users.items()}
+        output.update(self._socket_session)
+        output.update(self._session_user)
+        return output
+
+    def __len__(self):
+        return len(self._socket_session)
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """
+    Session store kept in a SQLite file so that several worker processes on
+    one host share the same view of connected sockets. Every lookup is a
+    primary key or index probe.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS socket_sessions (
+            socket_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            process TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS socket_sessions_session ON socket_sessions (session_id);
+        CREATE TABLE IF NOT EXISTS session_users (
+            session_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS room_users (
+            room_name TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (room_name, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS room_players (
+            room_name TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            PRIMARY KEY (room_name, session_id)
+        );
+        CREATE INDEX IF NOT EXISTS room_players_player ON room_players (room_name, player_id);
+        CREATE INDEX IF NOT EXISTS room_players_user ON room_players (room_name, user_id);
+        CREATE TABLE IF NOT EXISTS room_versions (
+            room_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS store_meta (
+            key TEXT PRIMARY KEY,
+            value NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS store_processes (
+            process TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, timeout=5.0, process_timeout=30):
+        self.path = str(path)
+        self.timeout = timeout
+        self.process_timeout = process_timeout
+        self.heartbeat_interval = process_timeout / 3
+        # each socket row names the process holding it, see heartbeat()
+        self.process = uuid.uuid4().hex[:12]
+        self._local = threading.local()
+        # async callers queue here instead of blocking the event loop on the busy timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-session-store')
+        self._connection().executescript(self.SCHEMA)
+        columns = [row[1] for row in self._connection().execute('PRAGMA table_info(socket_sessions)')]
+        if 'process' not in columns:
+            # files from before heartbeats; their rows belong to no live process and get reaped
+            self._connection().execute("ALTER TABLE socket_sessions ADD COLUMN process TEXT NOT NULL DEFAULT ''")
+        with self._write() as connection:
+            # the sequence lives as long as the file, so the epoch only has to tell files apart
+            connection.execute("INSERT OR IGNORE INTO store_meta VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+            connection.execute("INSERT OR IGNORE INTO store_meta VALUES ('sequence', 0)")
+            connection.execute("INSERT OR IGNORE INTO store_meta VALUES ('floor', 0)")
+        self.epoch = self._value("SELECT value FROM store_meta WHERE key = 'epoch'")
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, and sync views
+        # run on executor threads while consumers run on the event loop
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _write(self):
+        return _Transaction(self._connection())
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
+
+    def _value(self, query, *params):
+        row = self._connection().execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def clear(self):
+        with self._write() as connection:
+            for table in ('socket_sessions', 'session_users', 'room_users', 'room_players'):
+                connection.execute(f'DELETE FROM {table}')
+            # every room just lost its sessions
+            connection.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'sequence'")
+            connection.execute("UPDATE room_versions SET version = (SELECT value FROM store_meta WHERE key = 'sequence')")
+
+    def session_for_socket(self, socket_id):
+        return self._value('SELECT session_id FROM socket_sessions WHERE socket_id = ?', socket_id)
+
+    def socket_for_session(self, session_id):
+        return self._value(
+            'SELECT socket_id FROM socket_sessions WHERE session_id = ? ORDER BY rowid DESC LIMIT 1', session_id)
+
+    def user_for_session(self, session_id):
+        return self._value('SELECT user_id FROM session_users WHERE session_id = ?', session_id)
+
+    def player_for_session(self, session_id, room_name):
+        return self._value(
+            'SELECT player_id FROM room_players WHERE room_name = ? AND session_id = ?', room_name, session_id)
+
+    def session_for_player(self, player_id, room_name):
+        return self._value(
+            'SELECT session_id FROM room_players WHERE room_name = ? AND player_id = ? ORDER BY rowid DESC LIMIT 1',
+            room_name, player_id)
+
+    def player_sessions(self, room_name):
+        rows = self._connection().execute(
+            'SELECT player_id, session_id FROM room_players WHERE room_name = ? ORDER BY rowid', (room_name,))
+        return dict(rows.fetchall())
+
+    def session_players(self, user_id, room_name):
+        rows = self._connection().execute(
+            'SELECT session_id, player_id FROM room_players WHERE room_name = ? AND user_id = ?',
+            (room_name, user_id))
+        return dict(rows.fetchall())
+
+    def connect(self, session_id, user_id, socket_id, room_name):
+        with self._write() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO socket_sessions (socket_id, session_id, process) VALUES (?, ?, ?)',
+                (socket_id, session_id, self.process))
+            connection.execute('INSERT OR REPLACE INTO store_processes VALUES (?, ?)', (self.process, time.time()))
+            connection.execute('INSERT OR REPLACE INTO session_users VALUES (?, ?)', (session_id, user_id))
+            connection.execute('INSERT OR IGNORE INTO room_users VALUES (?, ?)', (room_name, user_id))
+
+    def bind_player(self, player_id, socket_id, room_name):
+        with self._write() as connection:
+            row = connection.execute(
+                'SELECT s.session_id, u.user_id FROM socket_sessions s '
+                'JOIN session_users u ON u.session_id = s.session_id '
+                'WHERE s.socket_id = ?', (socket_id,)).fetchone()
+            if row is None:
+                return
+            session_id, user_id = row
+            # the user's row is gone if another of their sessions left the room
+            connection.execute('INSERT OR IGNORE INTO room_users VALUES (?, ?)', (room_name, user_id))
+            connection.execute(
+                'INSERT OR REPLACE INTO room_players VALUES (?, ?, ?, ?)',
+                (room_name, session_id, user_id, player_id))
+
+    def disconnect(self, socket_id, room_name):
+        with self._write() as connection:
+            row = connection.execute(
+                'DELETE FROM socket_sessions WHERE socket_id = ? RETURNING session_id', (socket_id,)).fetchone()
+            if row is None:
+                return None
+            session_id = row[0]
+            row = connection.execute(
+                'DELETE FROM session_users WHERE session_id = ? RETURNING user_id', (session_id,)).fetchone()
+            user_id = row[0] if row else None
+            row = connection.execute(
+                'DELETE FROM room_players WHERE room_name = ? AND session_id = ? RETURNING player_id',
+                (room_name, session_id)).fetchone()
+            # prune the user's row once they have no player left in the room
+            connection.execute(
+                'DELETE FROM room_users WHERE room_name = ? AND user_id = ? AND NOT EXISTS '
+                '(SELECT 1 FROM room_players p WHERE p.room_name = ? AND p.user_id = ?)',
+                (room_name, user_id, room_name, user_id))
+        return row[0] if row else None
+
+    ROOM_VERSION = ("SELECT coalesce((SELECT version FROM room_versions WHERE room_name = ?), "
+                    "(SELECT value FROM store_meta WHERE key = 'floor'))")
+
+    def room_version(self, room_name):
+        return self._value(self.ROOM_VERSION, room_name)
+
+    def bump_room(self, room_name):
+        with self._write() as connection:
+            current = connection.execute(
+                "UPDATE store_meta SET value = value + 1 WHERE key = 'sequence' RETURNING value").fetchone()[0]
+            previous = connection.execute(self.ROOM_VERSION, (room_name,)).fetchone()[0]
+            connection.execute('INSERT OR REPLACE INTO room_versions VALUES (?, ?)', (room_name, current))
+        return previous, current
+
+    def compact(self):
+        with self._write() as connection:
+            idle_rooms = connection.execute(
+                'DELETE FROM room_versions WHERE room_name NOT IN (SELECT room_name FROM room_users) '
+                'AND room_name NOT IN (SELECT room_name FROM room_players) RETURNING version').fetchall()
+            if idle_rooms:
+                connection.execute(
+                    "UPDATE store_meta SET value = max(value, ?) WHERE key = 'floor'",
+                    (max(version for version, in idle_rooms),))
+            stale = connection.execute(
+                'DELETE FROM session_users WHERE session_id NOT IN (SELECT session_id FROM socket_sessions)').rowcount
+        # freed pages are reused in place; this only keeps the WAL file from growing
+        self._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return len(idle_rooms) + stale
+
+    def heartbeat(self):
+        """
+        Refreshes this process's row in store_processes and reaps the sockets
+        of processes that have not refreshed theirs for process_timeout
+        seconds, as a crashed worker never disconnects them. Their sessions,
+        players and users go with them, and every room that lost a player
+        moves to a new version.
+        """
+        now = time.time()
+        with self._write() as connection:
+            connection.execute('INSERT OR REPLACE INTO store_processes VALUES (?, ?)', (self.process, now))
+            connection.execute('DELETE FROM store_processes WHERE last_seen < ?', (now - self.process_timeout,))
+            reaped = connection.execute(
+                'DELETE FROM socket_sessions WHERE process NOT IN (SELECT process FROM store_processes)').rowcount
+            if not reaped:
+                return 0
+            connection.execute('DELETE FROM session_users WHERE session_id NOT IN (SELECT session_id FROM socket_sessions)')
+            rooms = {room_name for room_name, in connection.execute(
+                'DELETE FROM room_players WHERE session_id NOT IN (SELECT session_id FROM socket_sessions) '
+                'RETURNING room_name')}
+            connection.execute('DELETE FROM room_users WHERE user_id NOT IN (SELECT user_id FROM session_users)')
+            for room_name in rooms:
+                current = connection.execute(
+                    "UPDATE store_meta SET value = value + 1 WHERE key = 'sequence' RETURNING value").fetchone()[0]
+                connection.execute('INSERT OR REPLACE INTO room_versions VALUES (?, ?)', (room_name, current))
+        return reaped
+
+    def as_dict(self):
+        output = {}
+        with self._write() as connection:
+            for room_name, user_id in connection.execute('SELECT room_name, user_id FROM room_users'):
+                output.setdefault(room_name, {})[user_id] = {}
+            for room_name, session_id, user_id, player_id in connection.execute('SELECT * FROM room_players'):
+                output.setdefault(room_name, {}).setdefault(user_id, {})[session_id] = player_id
+            output.update(connection.execute('SELECT socket_id, session_id FROM socket_sessions'))
+            output.update(connection.execute('SELECT session_id, user_id FROM session_users'))
+        return output
+
+    def __len__(self):
+        return self._value('SELECT count(*) FROM socket_sessions')
+
+
+class _Transaction:
+    """ BEGIN IMMEDIATE / COMMIT around a block, so writers from other processes queue instead of interleaving """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+class Compactor:
+    """
+    Calls store.compact() every `interval` seconds, and store.heartbeat()
+    every store.heartbeat_interval, on the event loop that started it.
+
+    Consumers register when they connect and unregister when they go. The
+    task runs while any are registered, whether or not they have a session
+    in the store yet: a worker that stopped heartbeating while it still
+    held sockets would have them reaped by the others. It is started again
+    by the next consumer after the last one leaves.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._consumers = weakref.WeakSet()
+        self._task = None
+
+    def register(self, consumer, interval):
+        self._consumers.add(consumer)
+        if not interval and not self.store.heartbeat_interval:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run(interval))
+
+    def unregister(self, consumer):
+        self._consumers.discard(consumer)
+
+    async def _run(self, interval):
+        loop = asyncio.get_running_loop()
+        heartbeat = self.store.heartbeat_interval
+        tick = min(seconds for seconds in (interval, heartbeat) if seconds)
+        compact_at = loop.time() + interval if interval else None
+        while self._consumers:
+            await asyncio.sleep(tick)
+            try:
+                if heartbeat:
+                    reaped = await self.store.run(self.store.heartbeat)
+                    if reaped:
+                        logger.info(f"Reaped {reaped} sockets of session store processes that stopped")
+                if compact_at is not None and loop.time() >= compact_at:
+                    compact_at = loop.time() + interval
+                    removed = await self.store.run(self.store.compact)
+                    logger.debug(f"Compacted the session store, {removed} entries removed")
+            except Exception:
+                logger.exception("Session store housekeeping failed")
+
+
+def get_session_store():
+    """
+    Builds the session store configured in settings.GAME_SESSION_STORE,
+    falling back to the in-process SessionRegistry.
+    """
+    config = getattr(settings, 'GAME_SESSION_STORE', None) or {}
+    backend = import_string(config.get('BACKEND', 'game.sessions.SessionRegistry'))
+    return backend(**config.get('OPTIONS', {}))
@@ -0,0 +1,41 @@
+# game/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .consumers import room_changed
+from .models import Game, Player
+
+
+@receiver(post_save, sender=Game, dispatch_uid='game.signals.game_saved')
+def game_saved(sender, instance, **kwargs):
+    room_changed(instance.gameId, [{'op': 'status', 'status': instance.status}])
+
+
+@receiver(post_delete, sender=Game, dispatch_uid='game.signals.game_deleted')
+def game_deleted(sender, instance, **kwargs):
+    room_changed(instance.gameId, [{'op': 'game_removed'}])
+
+
+def player_added_change(player):
+    # also sent by views.add_players, as bulk_create fires no post_save
+    return {'op': 'player_added', 'player': {
+        'playerId': str(player.playerId),
+        'name': player.name,
+        'game_identifier': player.game_identifier,
+        'userId': str(player.userId.userId),
+        'isActive': False,
+    }}
+
+
+@receiver(post_save, sender=Player, dispatch_uid='game.signals.player_saved')
+def player_saved(sender, instance, created, **kwargs):
+    if created:
+        change = player_added_change(instance)
+    else:
+        change = {'op': 'player_renamed', 'playerId': str(instance.playerId), 'name': instance.name}
+    room_changed(instance.game_identifier, [change])
+
+
+@receiver(post_delete, sender=Player, dispatch_uid='game.signals.player_deleted')
+def player_deleted(sender, instance, **kwargs):
+    room_changed(instance.game_identifier, [{'op': 'player_removed', 'playerId': str(instance.playerId)}])
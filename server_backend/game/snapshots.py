@@ -0,0 +1,117 @@
+# game/snapshots.py
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class GameSnapshot:
+    """
+    prepare_game_data() output for one game, plus the get_game_info body
+    encoded from it. The body is re-encoded lazily after a patch; encoding
+    and patching hold the same lock, so a body encoded from the data as it
+    was before a patch is never kept after it.
+    """
+
+    __slots__ = ('data', 'version', 'players', '_body', '_lock')
+
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+        self.players = {player['playerId']: player for player in data['players']}
+        self._body = None
+        self._lock = threading.Lock()
+
+    def body(self):
+        body = self._body
+        if body is None:
+            with self._lock:
+                body = self._body
+                if body is None:
+                    body = self._body = json.dumps({'game': self.data}).encode()
+        return body
+
+    def copy(self):
+        """ a copy of the game data that callers are free to modify """
+        with self._lock:
+            return {**self.data, 'players': [dict(player) for player in self.data['players']]}
+
+    def set_active(self, active_players):
+        with self._lock:
+            changed = False
+            for player_id, player in self.players.items():
+                active = player_id in active_players
+                if player['isActive'] != active:
+                    player['isActive'] = active
+                    changed = True
+            if changed:
+                self._body = None
+
+
+class GameSnapshotCache:
+    """
+    Per-process LRU of GameSnapshots keyed by gameId, each tagged with the
+    room version (see BaseSessionStore.room_version) read before it was
+    built. A snapshot is only handed out while that version is current, so
+    changes made by other workers are picked up as well.
+
+    Session changes in this process patch isActive in place instead of
+    dropping the snapshot.
+    """
+
+    def __init__(self, max_games=1024):
+        self.max_games = max_games
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'GAME_SNAPSHOT_CACHE', True)
+
+    def get(self, game_id, version):
+        if not self.enabled:
+            return None
+        with self._lock:
+            snapshot = self._snapshots.get(game_id)
+            if snapshot is None or snapshot.version != version:
+                return None
+            self._snapshots.move_to_end(game_id)
+            return snapshot
+
+    def put(self, game_id, data, version):
+        snapshot = GameSnapshot(data, version)
+        if not self.enabled:
+            return snapshot
+        with self._lock:
+            self._snapshots[game_id] = snapshot
+            self._snapshots.move_to_end(game_id)
+            while len(self._snapshots) > self.max_games:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, game_id):
+        with self._lock:
+            self._snapshots.pop(str(game_id), None)
+
+    def set_active(self, game_id, active_players, previous, current):
+        """
+        Patches isActive after a session change that moved the room from
+        version `previous` to `current`. A snapshot that missed some other
+        change in between is left alone and will be rebuilt.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(str(game_id))
+            if snapshot is not None and snapshot.version == previous:
+                snapshot.set_active(active_players)
+                snapshot.version = current
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+
+snapshots = GameSnapshotCache()
@@ -0,0 +1,116 @@
+# game/socketqueue.py
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# close code sent to a socket that fell too far behind under the "disconnect" policy
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+_queues = weakref.WeakSet()
+_totals = {'dropped': 0, 'disconnected': 0, 'frames': 0, 'batches': 0}
+
+
+def queue_options():
+    options = {'COALESCE_WINDOW': 0, 'MAX_QUEUE': 256, 'OVERFLOW': 'drop'}
+    options.update(getattr(settings, 'GAME_SOCKET_QUEUE', None) or {})
+    return options
+
+
+class SocketQueue:
+    """
+    Outbound frames for one socket, written by a task of their own so that
+    consumer handlers only ever append and go back to draining the channel
+    layer.
+
+    With a COALESCE_WINDOW the writer waits that long after the first frame
+    and sends everything queued by then as one codec batch frame. A queue
+    already holding MAX_QUEUE frames either drops the new frame (clients
+    catch up with a resync) or closes the socket, per OVERFLOW.
+
+    This only bounds the frames waiting in this process. ASGI gives no
+    transport backpressure: under Daphne send() returns as soon as the
+    frame is handed to the server, which buffers it for a slow peer without
+    limit, so MAX_QUEUE is reached when this process outpaces its own event
+    loop, not when a client stops reading.
+    """
+
+    def __init__(self, send, close, codec, window=0, max_size=256, overflow='drop'):
+        self.send = send
+        self.close = close
+        self.codec = codec
+        self.window = window
+        self.max_size = max_size
+        self.overflow = overflow
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        self._frames = deque()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        _queues.add(self)
+
+    def put(self, frame):
+        if self.closed:
+            return False
+        if len(self._frames) >= self.max_size:
+            if self.overflow == 'disconnect':
+                _totals['disconnected'] += 1
+                logger.warning(f"Closing a socket {len(self._frames)} frames behind")
+                self.closed = True
+                self._frames.clear()
+                asyncio.ensure_future(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+            else:
+                self.dropped += 1
+                _totals['dropped'] += 1
+            return False
+        self._frames.append(frame)
+        self.high_water = max(self.high_water, len(self._frames))
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        frames = self._frames
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self.window:
+                await asyncio.sleep(self.window)
+            try:
+                while frames:
+                    if self.window and len(frames) > 1:
+                        batch = list(frames)
+                        frames.clear()
+                        _totals['batches'] += 1
+                        _totals['frames'] += len(batch)
+                        await self.send(**self.codec.frame(self.codec.batch(batch)))
+                    else:
+                        _totals['frames'] += 1
+                        await self.send(**self.codec.frame(frames.popleft()))
+            except Exception:
+                logger.exception("Sending queued frames failed")
+
+    def stop(self):
+        self.closed = True
+        self._task.cancel()
+        _queues.discard(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+
+def queue_metrics():
+    """ queue depth and overflow counts for the sockets held by this process """
+    queues = list(_queues)
+    depths = [len(queue) for queue in queues]
+    return {
+        'sockets': len(depths),
+        'queued': sum(depths),
+        'deepest': max(depths, default=0),
+        'high_water': max((queue.high_water for queue in queues), default=0),
+        **_totals,
+    }
@@ -0,0 +1,36 @@
+# game/tracing.py
+import logging
+
+
+def _render(value):
+    if callable(value):
+        value = value()
+    if isinstance(value, str):
+        return value
+    return repr(value)
+
+
+class Tracer:
+    """
+    Structured debug events for the socket and view hot paths.
+
+        trace = Tracer(__name__)
+        trace("socket_session_connect", socket_id=socket_id, sessions=store.as_dict)
+
+    Field values that are callables are only called when the event is
+    emitted, so with the logger above DEBUG an event costs one level check.
+    Turn tracing on with GAME_LOG_LEVEL=DEBUG.
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    @property
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, event, **fields):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.logger.debug(
+            "%s %s", event, " ".join(f"{key}={_render(value)}" for key, value in fields.items()))
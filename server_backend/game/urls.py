@@ -1,11 +1,19 @@
 ﻿# game/urls.py
 from django.urls import path
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('new/', views.create_game, name='create_game'),
+    path('metrics/sockets/', views.socket_metrics, name='socket_metrics'),
+    # the same views on the async ORM (game/async_views.py)
+    path('async/', async_views.get_games, name='async_get_games'),
+    path('async/<str:gameId>/info/', async_views.get_game_info, name='async_get_game_info'),
+    path('async/<str:gameId>/add/', async_views.add_player, name='async_add_player'),
+    path('async/<str:gameId>/claim/', async_views.claim_player, name='async_claim_player'),
+    path('async/<str:gameId>/name/', async_views.name_player, name='async_name_player'),
     path('<str:gameId>/info/', views.get_game_info, name='get_game_info'),
     path('<str:gameId>/add/', views.add_player, name='add_player'),
+    path('<str:gameId>/add/bulk/', views.add_players, name='add_players'),
     path('<str:gameId>/claim/', views.claim_player, name='claim_player'),
     path('<str:gameId>/name/', views.name_player, name='name_player'),
     path('', views.get_games, name='get_games'),
@@ -3,20 +3,31 @@ import json
 import uuid
 
 from .serializers import GameSerializer, PlayerSerializer
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
 
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from .models import Game, Player
 from accounts.models import Account
+from server_backend.pagination import keyset_page, page_limit, page_response, streaming_json_response
 from rest_framework import status
 from uuid import UUID
-from .consumers import get_session_from_player, get_socket_from_player, socketSession, get_player_sessions_from_room, get_session_players_from_user, get_user_from_session, \
-    GameConsumer
+from .consumers import get_session_from_player, get_socket_from_player, get_socket_from_session, get_player_sessions_from_room, get_session_players_from_user, get_user_from_session, \
+    get_room_version, room_etag, room_changed, GameConsumer
+from .heartbeat import reaper
+from .signals import player_added_change
+from .snapshots import snapshots
+from .ratelimit import rejected
+from .socketqueue import queue_metrics
+from .tracing import Tracer
 import logging
 
 logger = logging.getLogger(__name__)
+trace = Tracer(__name__)
 
 def loggering(message):
     print(message)
@@ -63,7 +74,7 @@ def prepare_game_data(game, players=None):
     player_data = prepare_player_data(players)
 
     if not player_data:
-        logger.info(f"*** GAME_INFO No players found for game {game.gameId}")
+        trace("game_info_no_players", game_id=game.gameId)
 
     return {
         'gameId': game.gameId,
@@ -76,7 +87,7 @@ def prepare_game_data(game, players=None):
 def create_game(request):
 
     user_id = request.query_params.get('userId')
-    logger.info(f"user_id passed to create_game is {user_id}")  # Debugging log
+    trace("create_game", user_id=user_id)
     #todo: save creator id too
     # userId should be in the body of this post
     game_data = request.data
@@ -87,56 +98,106 @@ def create_game(request):
         'game':serializer.data,
     }, status=201)
 
-@api_view(['GET'])
-def get_game_info(request, gameId):
-    try:
-        game = Game.objects.get(gameId=gameId)
-        game_info_response = {
-            'game': prepare_game_data(game),
-            'socketSession': socketSession
+def get_game_snapshot(game_id, version=None):
+    """ the cached prepare_game_data() for a game; raises Game.DoesNotExist """
+    if version is None:
+        version = get_room_version(game_id)
+    snapshot = snapshots.get(game_id, version)
+    if snapshot is None:
+        game = Game.objects.get(gameId=game_id)
+        snapshot = snapshots.put(game_id, prepare_game_data(game), version)
+    return snapshot
+
+def prepare_session_data(room_name):
+    """ the sockets and sessions bound to players in one room, for ?debug=1 when settings.DEBUG is on """
+    return {
+        player_id: {
+            'sessionId': session_id,
+            'userId': get_user_from_session(session_id),
+            'socketId': get_socket_from_session(session_id),
         }
-        players = game_info_response["game"]["players"]
-
-        logger.info(f"\n=== DEBUG: Game Info for room {gameId}  ({len(players)} players) ===")
-
-        for player in players:
-            # logger.info(f"player::")
-            # player_name = player["name"]
-            # logger.info(f"player_name: {player_name}")
-            # user_id = player["userId"]
-            # logger.info(f"user_id: {user_id}")
-            # player_id = player["playerId"]
-            # logger.info(f"player_id: {player_id}")
-            # session_id = get_session_from_player(player_id, gameId)
-            # logger.info(f"session_id: {session_id}")
-            # socket_id = get_socket_from_player(player_id, gameId)
-            # logger.info(f"socket_id: {socket_id}")
-
-            player_name = player["name"]
-            user_id = player["userId"]
+        for player_id, session_id in get_player_sessions_from_room(room_name).items()
+    }
+
+def not_modified(request, etag):
+    """ a 304 if the client already holds `etag`, else None """
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    return None
+
+def game_info_response(request, gameId, snapshot, etag):
+    if trace.enabled:
+        # one session/socket lookup per player, so only when someone is reading it
+        for player in snapshot.data["players"]:
             player_id = player["playerId"]
-            session_id = get_session_from_player(player_id, gameId)
-            socket_id = get_socket_from_player(player_id, gameId)
-            socket_active = "✅" if socket_id else "❌"
-            logger.info(
-                f" Player: {player_name or 'None':<12} | "
-                f"User: {(user_id[:6] if user_id else 'None'):<6} | "
-                f"PlayerID: {(player_id[:6] if player_id else 'None'):<6} | "
-                f"Session: {(session_id[:6] if session_id else 'None'):<6} | {socket_active}"
-            )
-        logger.info(f"=== END DEBUG {gameId} ===\n")
-
-        return JsonResponse(game_info_response, status=200)
+            trace("game_info_player", game_id=gameId, name=player["name"], user_id=player["userId"],
+                  player_id=player_id, session_id=get_session_from_player(player_id, gameId),
+                  connected=bool(get_socket_from_player(player_id, gameId)))
+
+    if settings.DEBUG and request.GET.get('debug'):
+        return JsonResponse({
+            'game': snapshot.data,
+            'sessions': prepare_session_data(gameId),
+        }, status=200)
+    # the encoded body is kept with the snapshot, so a repeat poll skips the ORM and json.dumps
+    response = HttpResponse(snapshot.body(), content_type='application/json', status=200)
+    response['ETag'] = etag
+    return response
 
+@api_view(['GET'])
+def get_game_info(request, gameId):
+    # pollers send back the ETag they were given; while the room has not
+    # changed that is answered from the session store and the cached
+    # snapshot. The snapshot is looked up first so that a game which does
+    # not exist is a 404 whatever ETag comes with it.
+    version = get_room_version(gameId)
+    etag = room_etag(version)
+    try:
+        snapshot = get_game_snapshot(gameId, version)
     except Game.DoesNotExist:
         return Response({"error": "Game not found"}, status=404)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    return game_info_response(request, gameId, snapshot, etag)
+
 
+@api_view(['GET'])
+def socket_metrics(request):
+    # outbound queue depth, rejected inbound frames and idle evictions for
+    # the sockets held by the worker answering this
+    return JsonResponse({**queue_metrics(), 'rejected': dict(rejected), 'evicted': reaper.evicted}, status=200)
+
+
+GAME_STATUSES = frozenset(value for value, _ in Game._meta.get_field('status').choices)
+GAME_LISTING_FIELDS = ('gameId', 'status')
+
+def games_listing(request):
+    """ (queryset, ?limit) for get_games; raises ValueError on a bad status or limit """
+    # unpaged listings keep the table's own order; keyset_page() sorts by gameId
+    games = Game.objects.values(*GAME_LISTING_FIELDS)
+    statuses = request.GET.get('status')
+    if statuses:
+        statuses = statuses.split(',')
+        unknown = set(statuses) - GAME_STATUSES
+        if unknown:
+            raise ValueError(f"Unknown status {', '.join(sorted(unknown))}")
+        games = games.filter(status__in=statuses)
+    return games, page_limit(request)
 
 @api_view(['GET'])
 def get_games(request):
-    games = Game.objects.all()
-    data = games.values('gameId', 'status')  # Fetch specific fields
-    return Response(data, status=status.HTTP_200_OK)
+    # ?status=waiting[,in-progress] filters; ?limit=N&after=<gameId> pages,
+    # anything else streams every game (server_backend/pagination.py)
+    try:
+        games, limit = games_listing(request)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    if limit is None:
+        return streaming_json_response(request, games, GAME_LISTING_FIELDS)
+    return page_response(request, *keyset_page(games, 'gameId', request.GET.get('after'), limit))
 
 @api_view(['POST'])
 def name_player(request, gameId):
@@ -170,22 +231,12 @@ def name_player(request, gameId):
     player.save()
 
     # Notify via WebSocket
-    player_announce = {
-        'message': f"{original_name} renamed to {new_player_name}",
-        'type': 'name_player',
-        'playerId': str(player.playerId),
-        'name': player.name,
-        'game_identifier': player.game_identifier,
-    }
-    GameConsumer.send_message_to_group(
-        group_name=f"game_{game.gameId}",
-        json_data=player_announce
-    )
+    announce_player(game, player, 'name_player', f"{original_name} renamed to {new_player_name}")
 
     # Prepare response
     response_data = {
         'player': prepare_player_data([player])[0],
-        'game': prepare_game_data(game)
+        'game': get_game_snapshot(game.gameId).data
     }
 
     return JsonResponse(response_data, status=200)
@@ -198,10 +249,7 @@ def claim_player(request, gameId):
     user_id = get_user_from_session(session_id_str)
     user_id_str = str(user_id)
 
-    print("\n===== CLAIM PLAYER REQUEST =====")
-    print(f"USER_ID: {user_id_str}")
-    print(f"SESSION_ID: {session_id_str}")
-    print(f"GAME_ID: {gameId}")
+    trace("claim_player", game_id=gameId, session_id=session_id_str, user_id=user_id_str)
 
     if not session_id_str:
         return JsonResponse({"error": f"No session id"}, status = 400)
@@ -210,48 +258,50 @@ def claim_player(request, gameId):
 
 
     try:
-        game = Game.objects.get(gameId=gameId)
-        print(f"FOUND GAME: {game.gameId}")
-        player_info_response = prepare_game_data(game)
-        player_data = player_info_response['players']
-
-        if not player_data:
-            return JsonResponse({"error": f"No players found for game {gameId}"}, status=404)
-
-        claimed_player = None
-        player_sessions = get_player_sessions_from_room(gameId)
-        if player_sessions:
-            for p, s in player_sessions.items():
-                if s == session_id_str:
-                    claimed_player = p
-                    print(f"EXISTING PLAYER FOUND: (1) Session matched:{session_id_str}: {claimed_player}")
-
-        if not claimed_player:
-            # ok, no session, so maybe there was a dc
-            for p in player_data:
-                player_id_str = p['playerId']
-                p_user_id_str = p['userId']
-
-                if player_id_str not in player_sessions and p_user_id_str == user_id_str:
-                    claimed_player = player_id_str
-                    print(f"EXISTING PLAYER FOUND (2) Session disconnected: "
-                        f"{get_session_from_player(claimed_player, game.gameId)}: {claimed_player}")
-                    break
-
-        for person in player_data:
-            if person['playerId'] == claimed_player:
-                player_info_response['player'] = person
-                break
-
-        if player_info_response.get('player',None) is not None:
-            print(f"CLAIM PLAYER {player_info_response['player'].get('playerId')}")
-            return JsonResponse(player_info_response, status = 200)
-        
-        print(f"No available players found for game {gameId}")
-        return JsonResponse({"error": f"No available players found for game {gameId}"}, status = 404)
+        return claim_from_snapshot(get_game_snapshot(gameId), gameId, session_id_str, user_id_str)
     except Game.DoesNotExist:
         return JsonResponse({"error": "Game not found"}, status = 404)
 
+def claim_from_snapshot(snapshot, gameId, session_id_str, user_id_str):
+    """ the claim_player response: the session's player, or else the user's unclaimed one """
+    player_info_response = snapshot.copy()
+    player_data = player_info_response['players']
+
+    if not player_data:
+        return JsonResponse({"error": f"No players found for game {gameId}"}, status=404)
+
+    claimed_player = None
+    player_sessions = get_player_sessions_from_room(gameId)
+    if player_sessions:
+        for p, s in player_sessions.items():
+            if s == session_id_str:
+                claimed_player = p
+                trace("claim_player_session_match", game_id=gameId, session_id=session_id_str,
+                      player_id=claimed_player)
+
+    if not claimed_player:
+        # ok, no session, so maybe there was a dc
+        for p in player_data:
+            player_id_str = p['playerId']
+            p_user_id_str = p['userId']
+
+            if player_id_str not in player_sessions and p_user_id_str == user_id_str:
+                claimed_player = player_id_str
+                trace("claim_player_user_match", game_id=gameId, user_id=user_id_str,
+                      player_id=claimed_player)
+                break
+
+    for person in player_data:
+        if person['playerId'] == claimed_player:
+            player_info_response['player'] = person
+            break
+
+    if player_info_response.get('player',None) is not None:
+        return JsonResponse(player_info_response, status = 200)
+    
+    trace("claim_player_none_available", game_id=gameId, user_id=user_id_str)
+    return JsonResponse({"error": f"No available players found for game {gameId}"}, status = 404)
+
 @api_view(['POST'])
 def add_player(request, gameId):
     game = get_object_or_404(Game, gameId=gameId)
@@ -273,42 +323,106 @@ def add_player(request, gameId):
         player_name = f"Player {player_count + 1}"
 
     player = Player.objects.create(game=game, name=player_name, userId=user_account)
+    message = announce_player(game, player, 'add_player', f"{player.name} added to the game")
+    # Fetch updated players list after player creation
+    players = game.players.select_related('userId').all()
+    return add_player_response(game, player, players, message)
 
-    player_announce = {
-        'message': f"{player.name} added to the game",
-        'type': 'add_player',
-        'playerId': str(player.playerId),
+def player_entry(player):
+    return {
+        'playerId': player.playerId,
         'name': player.name,
         'game_identifier': player.game_identifier,
+        'userId': str(player.userId.userId),
     }
+
+def announce_player(game, player, message_type, message):
+    """ tells the room about an added or renamed player, returning the message """
     GameConsumer.send_message_to_group(
         group_name=f"game_{game.gameId}",
-        json_data=player_announce
-    )
-    # Fetch updated players list after player creation
-    players = game.players.select_related('userId').all()
-    player_data = [
-        {
-            'playerId': player.playerId,
+        json_data={
+            'message': message,
+            'type': message_type,
+            'playerId': str(player.playerId),
             'name': player.name,
             'game_identifier': player.game_identifier,
-            'userId': str(player.userId.userId),
         }
-        for player in players
-    ]
+    )
+    return message
 
+def add_player_response(game, player, players, message):
     response_data = {
-        'message': player_announce['message'],
+        'message': message,
         'game': {
             'gameId': game.gameId,
             'status': game.status,
-            'players': player_data,
+            'players': [player_entry(player) for player in players],
         },
-        'player': {
-            'playerId': player.playerId,
-            'name': player.name,
-            'game_identifier': player.game_identifier,
-            'userId': str(player.userId.userId),
-        }
+        'player': player_entry(player),
     }
     return JsonResponse(response_data, status=status.HTTP_201_CREATED)
+
+
+# the most players one add/bulk/ request may create
+MAX_BULK_PLAYERS = 100
+
+@api_view(['POST'])
+def add_players(request, gameId):
+    """
+    add_player for many players: {"players": [{"userId": ..., "name": ...}, ...]}.
+    The accounts are looked up in one query, the players are inserted with one
+    bulk_create, and the room gets one room_delta and one add_players message.
+    """
+    game = get_object_or_404(Game, gameId=gameId)
+    entries = request.data.get('players') if isinstance(request.data, dict) else None
+
+    if not isinstance(entries, list) or not entries \
+            or not all(isinstance(entry, dict) and entry.get('userId') for entry in entries):
+        return JsonResponse({'error': 'players must be a list of entries with a userId'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(entries) > MAX_BULK_PLAYERS:
+        return JsonResponse({'error': f'at most {MAX_BULK_PLAYERS} players can be added at once'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        user_ids = [UUID(str(entry['userId'])) for entry in entries]
+    except ValueError:
+        return JsonResponse({'error': 'userId must be a UUID'}, status=status.HTTP_400_BAD_REQUEST)
+
+    accounts = Account.objects.in_bulk(set(user_ids), field_name='userId')
+    missing = sorted({str(user_id) for user_id in user_ids if user_id not in accounts})
+    if missing:
+        return JsonResponse({'error': 'Account not found for the given userId', 'userIds': missing}, status=status.HTTP_404_NOT_FOUND)
+
+    with transaction.atomic():
+        # default names carry on from the players already seated
+        player_count = game.players.count() if not all(entry.get('name') for entry in entries) else 0
+        players = Player.objects.bulk_create([
+            Player(game=game, name=entry.get('name') or f"Player {player_count + number}", userId=accounts[user_id])
+            for number, (entry, user_id) in enumerate(zip(entries, user_ids), start=1)
+        ])
+
+    room_changed(game.gameId, [player_added_change(player) for player in players])
+    added = [player_entry(player) for player in players]
+    message = f"{len(players)} players added to the game"
+    GameConsumer.send_message_to_group(
+        group_name=f"game_{game.gameId}",
+        json_data={
+            'message': message,
+            'type': 'add_players',
+            'players': [
+                {'playerId': str(player.playerId), 'name': player.name, 'game_identifier': player.game_identifier}
+                for player in players
+            ],
+        }
+    )
+
+    players = game.players.select_related('userId').all()
+    player_data = [player_entry(player) for player in players]
+    return JsonResponse({
+        'message': message,
+        'game': {
+            'gameId': game.gameId,
+            'status': game.status,
+            'players': player_data,
+        },
+        'players': added,
+    }, status=status.HTTP_201_CREATED)
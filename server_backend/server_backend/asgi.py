@@ -2,7 +2,6 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-import game.routing
 
 import logging
 from django.conf import settings
@@ -11,8 +10,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server_backend.settings")
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("django")
 
+# sets up Django, which has to happen before the consumers import any models
+django_asgi_app = get_asgi_application()
+
+import game.routing
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             game.routing.websocket_urlpatterns
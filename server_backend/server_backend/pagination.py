@@ -0,0 +1,141 @@
+# server_backend/pagination.py
+"""
+Keyset pagination and streamed JSON arrays for the listing endpoints.
+
+A listing without ?limit is the whole table, streamed as one JSON array.
+With ?limit=N it is one page of at most N rows, ordered by a unique key;
+the next page is asked for with ?after=<key of the last row> and its URL
+comes back in a Link header (rel="next"), so the body keeps the same
+JSON array shape either way.
+"""
+import json
+import sys
+
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+# rows fetched per query, and encoded per chunk, when streaming
+STREAM_CHUNK_SIZE = 500
+
+
+def is_asgi(request):
+    """
+    Whether `request`, a Django or DRF request, is being served over ASGI.
+    A streamed response must then be fed by an async iterator: Django reads
+    a sync one into memory before serving it there.
+    """
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+def page_limit(request, maximum=MAX_LIMIT):
+    """ ?limit as an int from 1 to `maximum`, None when no page was asked for; raises ValueError """
+    limit = request.GET.get('limit')
+    if limit is None:
+        return None
+    try:
+        limit = int(limit) if limit else DEFAULT_LIMIT
+    except ValueError:
+        raise ValueError("limit must be a positive number") from None
+    if limit < 1:
+        raise ValueError("limit must be a positive number")
+    return min(limit, maximum)
+
+
+def _row_key(row, key):
+    return row[key] if isinstance(row, dict) else getattr(row, key)
+
+
+def keyset_page(queryset, key, after, limit):
+    """ (rows, key of the last row if there is a next page) for `queryset` ordered by the unique `key` """
+    if after:
+        queryset = queryset.filter(**{f'{key}__gt': after})
+    rows = list(queryset.order_by(key)[:limit + 1])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, _row_key(rows[-1], key)
+    return rows, None
+
+
+async def akeyset_page(queryset, key, after, limit):
+    """ keyset_page() on the async ORM """
+    if after:
+        queryset = queryset.filter(**{f'{key}__gt': after})
+    rows = [row async for row in queryset.order_by(key)[:limit + 1]]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, _row_key(rows[-1], key)
+    return rows, None
+
+
+def page_response(request, rows, next_key):
+    response = JsonResponse(rows, safe=False, status=200)
+    if next_key is not None:
+        query = request.GET.copy()
+        query['after'] = str(next_key)
+        response['Link'] = f'<{request.path}?{query.urlencode()}>; rel="next"'
+    return response
+
+
+def prefix_range(field, prefix):
+    """
+    filter() arguments matching values of `field` that start with `prefix`,
+    as a range so that a plain index on the field serves it (SQLite's LIKE
+    is case-insensitive and cannot); the match is case-sensitive
+    """
+    # nothing sorts after U+10FFFF, so trailing ones are dropped before the
+    # last character is bumped; a prefix of only those has no upper bound
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return {f'{field}__gte': prefix}
+    return {f'{field}__gte': prefix, f'{field}__lt': stem[:-1] + chr(ord(stem[-1]) + 1)}
+
+
+def _encode_chunk(rows, fields, first):
+    # tuples from values_list() are paired with `fields`; dicts are sent as they are
+    body = ','.join(json.dumps(dict(zip(fields, row)) if fields else row, cls=DjangoJSONEncoder) for row in rows)
+    return (body if first else ',' + body).encode()
+
+
+def _json_array(rows, fields):
+    yield b'['
+    chunk, first = [], True
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield _encode_chunk(chunk, fields, first)
+            chunk, first = [], False
+    if chunk:
+        yield _encode_chunk(chunk, fields, first)
+    yield b']'
+
+
+async def _ajson_array(rows, fields=None):
+    yield b'['
+    chunk, first = [], True
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield _encode_chunk(chunk, fields, first)
+            chunk, first = [], False
+    if chunk:
+        yield _encode_chunk(chunk, fields, first)
+    yield b']'
+
+
+def streaming_json_response(request, queryset, fields):
+    """
+    `fields` of every row in `queryset` as a JSON array of objects, read
+    with values_list() and sent in chunks. Under ASGI (see is_asgi) the rows
+    come from values().aiterator(), as values_list().aiterator() runs its
+    query outside the executor.
+    """
+    if is_asgi(request):
+        rows = queryset.values(*fields).aiterator(chunk_size=STREAM_CHUNK_SIZE)
+        content = _ajson_array(rows)
+    else:
+        rows = queryset.values_list(*fields).iterator(chunk_size=STREAM_CHUNK_SIZE)
+        content = _json_array(rows, fields)
+    return StreamingHttpResponse(content, content_type='application/json')
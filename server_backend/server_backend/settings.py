@@ -69,7 +69,7 @@ AUTH_USER_MODEL = 'accounts.Account'
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": env('DATABASE_PATH', default=str(BASE_DIR / "db.sqlite3")),
     }
 }
 
@@ -117,6 +117,12 @@ LOGGING = {
             'level': 'CRITICAL',
             'propagate': True,
         },
+        # GAME_LOG_LEVEL=DEBUG turns on the socket session / view traces (game/tracing.py)
+        'game': {
+            'handlers': ['console'],
+            'level': env('GAME_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
     },
 }
 
@@ -132,11 +138,112 @@ MIDDLEWARE = [
 ]
 
 
-CHANNEL_LAYERS = {
-    "default": {
+# The in-memory layer only reaches sockets held by its own process; the sqlite
+# layer shares groups and queues between every worker on the host.
+CHANNEL_LAYER_BACKENDS = {
+    "memory": {
         "BACKEND": "channels.layers.InMemoryChannelLayer",
     },
+    "sqlite": {
+        "BACKEND": "game.layers.SQLiteChannelLayer",
+        "CONFIG": {
+            "path": env('CHANNEL_LAYER_PATH', default=str(BASE_DIR / "channels.sqlite3")),
+            "expiry": 60,
+            "capacity": 100,
+            "group_options": {
+                "game_*": {"capacity": 200, "expiry": 30},
+            },
+        },
+    },
 }
+CHANNEL_LAYERS = {
+    "default": CHANNEL_LAYER_BACKENDS[env('CHANNEL_LAYER', default='memory')],
+}
+
+# Broadcasts from HTTP views are queued and sent from the event loop instead
+# of blocking the request thread until every socket has been handed the message.
+GAME_BROADCAST_OUTBOX = True
+
+# Per-socket outbound queue (game/socketqueue.py). COALESCE_WINDOW > 0 sends
+# whatever queues up within that many seconds as one {"type": "batch"} frame,
+# so only turn it on for clients that understand batches. A socket with
+# MAX_QUEUE frames waiting has new ones dropped, or is closed with code 4008
+# when OVERFLOW is "disconnect". The limit only counts frames not yet handed
+# to the ASGI server; Daphne buffers frames for a slow client without bound
+# and does not tell us, so this is no guard against clients that stop reading.
+GAME_SOCKET_QUEUE = {
+    "COALESCE_WINDOW": env.float('SOCKET_COALESCE_WINDOW', default=0),
+    "MAX_QUEUE": env.int('SOCKET_MAX_QUEUE', default=256),
+    "OVERFLOW": env('SOCKET_OVERFLOW', default='drop'),
+}
+
+# Inbound socket limits (game/ratelimit.py). Frames over MAX_FRAME_SIZE
+# (characters for text, bytes for binary) close the socket with 1009. Every
+# frame takes a token from its socket's bucket; the message types in
+# ROOM_LIMITED_TYPES, which are echoed to the whole room, also take one from
+# the room's. A rate of 0 turns that bucket off.
+GAME_SOCKET_LIMITS = {
+    "MAX_FRAME_SIZE": env.int('SOCKET_MAX_FRAME_SIZE', default=16384),
+    "SOCKET_RATE": env.float('SOCKET_RATE', default=20),
+    "SOCKET_BURST": env.int('SOCKET_BURST', default=40),
+    "ROOM_RATE": env.float('ROOM_RATE', default=100),
+    "ROOM_BURST": env.int('ROOM_BURST', default=200),
+    "ROOM_LIMITED_TYPES": ("clientMessage", "sessionPlayer"),
+}
+
+# Socket heartbeat (game/heartbeat.py). A socket that has sent nothing for
+# PING_INTERVAL seconds is sent {"type": "ping"} and should answer with
+# {"type": "pong"}; one silent for IDLE_TIMEOUT seconds is dropped from its
+# room, announced as player_disconnected and closed with code 4000. Only
+# sockets that have sent a pong at least once are evicted, so clients that
+# do not implement the heartbeat are never dropped for being quiet. The
+# check runs every REAP_INTERVAL seconds. An IDLE_TIMEOUT of 0 keeps every
+# socket until it disconnects.
+GAME_SOCKET_HEARTBEAT = {
+    "PING_INTERVAL": env.float('SOCKET_PING_INTERVAL', default=20),
+    "IDLE_TIMEOUT": env.float('SOCKET_IDLE_TIMEOUT', default=60),
+    "REAP_INTERVAL": env.float('SOCKET_REAP_INTERVAL', default=5),
+}
+
+# Where socket -> session -> player mappings live. The in-memory registry is
+# only visible to its own process; run several Daphne workers against the
+# sqlite store so they all agree on who is connected. Each worker refreshes
+# a heartbeat row, and sockets held by a worker silent for process_timeout
+# seconds (one that crashed) are dropped.
+GAME_SESSION_STORES = {
+    "memory": {
+        "BACKEND": "game.sessions.SessionRegistry",
+    },
+    "sqlite": {
+        "BACKEND": "game.sessions.SQLiteSessionStore",
+        "OPTIONS": {
+            "path": env('SESSION_STORE_PATH', default=str(BASE_DIR / "sessions.sqlite3")),
+            "process_timeout": 30,
+        },
+    },
+}
+GAME_SESSION_STORE = GAME_SESSION_STORES[env('SESSION_STORE', default='memory')]
+
+# Image bytes are kept out of the database, in files named by the sha-256 of
+# their content; rows in the images table only hold that digest.
+AVATAR_BLOB_STORE = {
+    "BACKEND": "avatars.storage.FileSystemBlobStore",
+    "OPTIONS": {
+        "root": env('AVATAR_STORE_PATH', default=str(BASE_DIR / "avatar_blobs")),
+    },
+}
+
+# Bytes of stored avatar blobs (batch images, base64 and SVG variants) each
+# process keeps in memory.
+AVATAR_ENCODING_CACHE_BYTES = env.int('AVATAR_ENCODING_CACHE_BYTES', default=16 * 1024 * 1024)
+
+# Seconds between session store compactions, which forget the versions of
+# rooms nobody is connected to and hand freed memory back. 0 turns them off.
+GAME_SESSION_COMPACT_INTERVAL = env.float('SESSION_COMPACT_INTERVAL', default=300)
+
+# get_game_info / claim_player answer from a per-process snapshot of each game,
+# reused for as long as the room's version in the session store is unchanged.
+GAME_SNAPSHOT_CACHE = env.bool('GAME_SNAPSHOT_CACHE', default=True)
 
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_ORIGINS = True
@@ -0,0 +1,57 @@
+import django
+django.setup()
+
+import json
+from unittest import mock
+
+from django.test import Client, TestCase
+
+from accounts.models import Account
+
+
+class AccountListingTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        for username in ('alice', 'albert', 'Alfred', 'bob', 'carol'):
+            Account.objects.create(username=username, password='password', email=f'{username}@email.com')
+
+    def test_list_accounts_streamed(self):
+        with mock.patch('server_backend.pagination.STREAM_CHUNK_SIZE', 2):
+            response = self.client.get('/api/accounts/')
+            self.assertTrue(response.streaming)
+            accounts = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(accounts), 5)
+        self.assertEqual(set(accounts[0]), {'username', 'email', 'userId'})
+        alice = Account.objects.get(username='alice')
+        self.assertIn({'username': 'alice', 'email': 'alice@email.com', 'userId': str(alice.userId)}, accounts)
+
+    def test_list_accounts_paged(self):
+        seen, url = [], '/api/accounts/?limit=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(account['username'] for account in json.loads(response.content))
+            link = response.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(seen, sorted(Account.objects.values_list('username', flat=True)))
+        self.assertEqual(self.client.get('/api/accounts/?limit=0').status_code, 400)
+        response = self.client.get('/api/accounts/?limit=ten')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {'error': 'limit must be a positive number'})
+
+    def test_username_prefix_search(self):
+        response = self.client.get('/api/accounts/?q=al&limit=10')
+        self.assertEqual([account['username'] for account in json.loads(response.content)], ['albert', 'alice'])
+        # case-sensitive, so the username index can serve it
+        response = self.client.get('/api/accounts/?q=Al')
+        self.assertEqual([account['username'] for account in json.loads(b''.join(response.streaming_content))],
+                         ['Alfred'])
+
+    def test_prefix_ending_in_the_last_code_point(self):
+        Account.objects.create(username='al\U0010ffffx', password='password', email='max@email.com')
+        response = self.client.get('/api/accounts/', {'q': 'al\U0010ffff', 'limit': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([account['username'] for account in json.loads(response.content)], ['al\U0010ffffx'])
+        response = self.client.get('/api/accounts/', {'q': '\U0010ffff', 'limit': 10})
+        self.assertEqual(json.loads(response.content), [])
@@ -0,0 +1,352 @@
+import django
+django.setup()
+
+import base64
+import gzip
+import json
+import shutil
+import tempfile
+import uuid
+from unittest import mock
+
+from django.db import connection
+from django.test import AsyncClient, Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import Account
+from avatars.encodings import encodings
+from avatars.models import Image
+from avatars.storage import FileSystemBlobStore, blob_digest, blob_store
+
+BLOB_ROOT = tempfile.mkdtemp()
+use_test_blob_store = override_settings(AVATAR_BLOB_STORE={
+    'BACKEND': 'avatars.storage.FileSystemBlobStore',
+    'OPTIONS': {'root': BLOB_ROOT},
+})
+
+
+def tearDownModule():
+    shutil.rmtree(BLOB_ROOT, ignore_errors=True)
+
+
+@use_test_blob_store
+class ImageListingTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.alice = Account.objects.create(username='alice', password='password', email='alice@email.com')
+        self.bob = Account.objects.create(username='bob', password='password', email='bob@email.com')
+        self.images = [
+            Image.objects.create(uploader=self.alice, type='png', data=b'\x89PNG' * 1000, private=False),
+            Image.objects.create(uploader=self.alice, type='svg', data=b'<svg/>'),
+            Image.objects.create(uploader=self.bob, type='jpg', data=b'\xff\xd8' * 1000, private=False),
+            Image.objects.create(uploader=self.bob, type='png', data=b'\x89PNG'),
+            Image.objects.create(uploader=None, type='svg', data=b'<svg/>', private=False),
+        ]
+
+    def list_images(self, query=''):
+        response = self.client.get(f'/api/avatars/images/{query}')
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return json.loads(b''.join(response.streaming_content))
+        return json.loads(response.content)
+
+    def test_list_images_streamed(self):
+        with mock.patch('server_backend.pagination.STREAM_CHUNK_SIZE', 2), \
+                CaptureQueriesContext(connection) as queries:
+            images = self.list_images()
+        self.assertEqual(len(images), 5)
+        self.assertEqual(set(images[0]), {'id', 'uploader', 'type', 'private', 'created_at', 'digest'})
+        first = next(image for image in images if image['id'] == str(self.images[0].id))
+        self.assertEqual(first, dict(first, uploader=self.alice.pk, type='png', private=False))
+        for query in queries.captured_queries:
+            self.assertNotIn('"data"', query['sql'])
+
+    def test_list_images_paged(self):
+        seen, url = [], '/api/avatars/images/?limit=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(image['id'] for image in json.loads(response.content))
+            link = response.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(seen, sorted(str(image.id) for image in self.images))
+
+    def test_filters(self):
+        self.assertEqual(len(self.list_images('?type=png')), 2)
+        self.assertEqual(len(self.list_images('?type=png,svg&limit=10')), 4)
+        self.assertEqual({image['type'] for image in self.list_images('?private=true')}, {'svg', 'png'})
+        self.assertEqual(len(self.list_images('?private=false')), 3)
+        images = self.list_images(f'?uploader={self.bob.pk}&private=0')
+        self.assertEqual([image['id'] for image in images], [str(self.images[2].id)])
+
+    def test_bad_parameters(self):
+        for query in ('?type=gif', '?private=maybe', '?uploader=bob', '?limit=0', '?limit=2&after=nope'):
+            self.assertEqual(self.client.get(f'/api/avatars/images/{query}').status_code, 400, query)
+        for query, error in (('?uploader=bob', 'uploader must be an integer user id'),
+                             ('?limit=2&after=nope', 'after must be an image id')):
+            response = self.client.get(f'/api/avatars/images/{query}')
+            self.assertEqual(json.loads(response.content), {'error': error}, query)
+
+
+@use_test_blob_store
+class BlobStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.svg = b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+
+    def test_images_share_blobs(self):
+        first = Image.objects.create(type='svg', data=self.svg)
+        second = Image.objects.create(type='svg', data=self.svg)
+        self.assertEqual(first.digest, blob_digest(self.svg))
+        self.assertEqual(second.digest, first.digest)
+        self.assertEqual(first.size, len(self.svg))
+        self.assertEqual(second.variants, first.variants)
+        self.assertEqual(list(blob_store().path(first.digest).parent.glob('.incoming-*')), [])
+        self.assertEqual(Image.objects.get(id=second.id).data, self.svg)
+
+    def test_image_detail_streams_blob(self):
+        png = b'\x89PNG' + bytes(range(256)) * 100
+        image = Image.objects.create(type='png', data=png)
+        response = self.client.get(f'/api/avatars/images/{image.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Length'], str(len(png)))
+        self.assertEqual(b''.join(response.streaming_content), png)
+        response.close()
+
+        response = self.client.get(f'/api/avatars/images/{image.id}/info/')
+        self.assertEqual(base64.b64decode(response.json()['data_base64']), png)
+
+    async def test_image_detail_streams_blob_under_asgi(self):
+        png = b'\x89PNG' + bytes(range(256)) * 1000
+        image = await Image.objects.acreate(type='png', data=png)
+        response = await AsyncClient().get(f'/api/avatars/images/{image.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(png)))
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), png)
+
+    def test_missing_blob(self):
+        image = Image.objects.create(type='svg', data=self.svg)
+        blob_store().path(image.digest).unlink()
+        self.assertEqual(self.client.get(f'/api/avatars/images/{image.id}/').status_code, 404)
+
+    def test_missing_blob_in_info_and_html(self):
+        png = Image.objects.create(type='png', data=b'\x89PNG')
+        blob_store().path(png.variant('base64').digest).unlink()
+        svg = Image.objects.create(type='svg', data=b'<svg><text>kept</text></svg>')
+        blob_store().path(svg.variant('svg.min').digest).unlink()
+        encodings.clear()
+        for url in (f'/api/avatars/images/{png.id}/info/', f'/api/avatars/images/{png.id}/?html=1',
+                    f'/api/avatars/images/{svg.id}/?html=1'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+    def test_image_without_variants(self):
+        # stored before variants were derived at ingest
+        png = Image.objects.create(type='png', data=b'\x89PNG')
+        Image.objects.filter(id=png.id).update(variants={})
+        response = self.client.get(f'/api/avatars/images/{png.id}/info/')
+        self.assertEqual(base64.b64decode(response.json()['data_base64']), b'\x89PNG')
+        response = self.client.get(f'/api/avatars/images/{png.id}/?html=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(base64.b64encode(b'\x89PNG'), response.content)
+
+
+@use_test_blob_store
+class ImageCachingTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.png = bytes(range(256)) * 40
+        self.image = Image.objects.create(type='png', data=self.png)
+        self.url = f'/api/avatars/images/{self.image.id}/'
+        self.etag = f'"{blob_digest(self.png)}"'
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_validators(self):
+        response, body = self.get()
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        info = self.client.get(f'{self.url}info/').json()
+        response, body = self.get(f'{self.url}{info["digest"]}/')
+        self.assertEqual(body, self.png)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        # a digest URL only ever serves the bytes it names
+        self.assertEqual(self.get(f'{self.url}{blob_digest(b"other")}/')[0].status_code, 404)
+
+    def test_not_modified_without_opening_blob(self):
+        with mock.patch.object(FileSystemBlobStore, 'open') as open_blob:
+            response, body = self.get(If_None_Match=f'"stale", {self.etag}')
+        open_blob.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(self.get(If_None_Match='"stale"')[0].status_code, 200)
+
+    def test_ranges(self):
+        size = len(self.png)
+        for header, status, content_range, expected in (
+                ('bytes=0-99', 206, f'bytes 0-99/{size}', self.png[:100]),
+                ('bytes=10000-', 206, f'bytes 10000-{size - 1}/{size}', self.png[10000:]),
+                ('bytes=-10', 206, f'bytes {size - 10}-{size - 1}/{size}', self.png[-10:]),
+                ('bytes=100-99999', 206, f'bytes 100-{size - 1}/{size}', self.png[100:]),
+                ('bytes=0-1,5-6', 200, None, self.png),
+                ('bytes=9-1', 200, None, self.png),
+                ('lines=0-1', 200, None, self.png)):
+            response, body = self.get(Range=header)
+            self.assertEqual(response.status_code, status, header)
+            self.assertEqual(response.get('Content-Range'), content_range, header)
+            self.assertEqual(response['Content-Length'], str(len(expected)), header)
+            self.assertEqual(body, expected, header)
+
+        response, body = self.get(Range=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+        self.assertEqual(self.get(Range='bytes=0-9', If_Range=self.etag)[0].status_code, 206)
+        response, body = self.get(Range='bytes=0-9', If_Range='"stale"')
+        self.assertEqual((response.status_code, body), (200, self.png))
+
+    async def test_range_under_asgi(self):
+        response = await AsyncClient().get(self.url, headers={'Range': 'bytes=256-511'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.png[256:512])
+
+
+@use_test_blob_store
+class ImageBatchTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        encodings.clear()
+        self.images = [Image.objects.create(type='png', data=bytes([number]) * (100 + number)) for number in range(12)]
+        self.images.append(Image.objects.create(type='svg', data=b'<svg/>'))
+        self.ids = [str(image.id) for image in self.images]
+        self.url = '/api/avatars/images/batch/?ids=' + ','.join(self.ids)
+
+    def test_bundle(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-avatar-bundle')
+        line, _, blobs = response.content.partition(b'\n')
+        index = json.loads(line)
+        self.assertEqual([entry['id'] for entry in index['images']], self.ids)
+        self.assertEqual(index['missing'], [])
+        for entry, image in zip(index['images'], self.images):
+            self.assertEqual(blobs[entry['offset']:entry['offset'] + entry['length']], image.data)
+            self.assertEqual(entry['digest'], image.digest)
+
+    def test_multipart(self):
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.client.get(f'{self.url},{missing}', headers={'Accept': 'multipart/mixed'})
+        self.assertEqual(response.status_code, 200)
+        content_type, _, boundary = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/mixed')
+        parts = response.content.split(f'--{boundary}'.encode())[1:-1]
+        self.assertEqual(len(parts), len(self.images) + 1)
+        headers, _, body = parts[0].partition(b'\r\n\r\n')
+        self.assertEqual(json.loads(body)['missing'], [missing])
+        for part, image in zip(parts[1:], self.images):
+            headers, _, body = part.partition(b'\r\n\r\n')
+            self.assertIn(f'Content-ID: <{image.id}>'.encode(), headers)
+            self.assertEqual(body[:-2], image.data)
+
+    def test_cached_encodings_and_not_modified(self):
+        response = self.client.get(self.url)
+        with mock.patch.object(FileSystemBlobStore, 'open') as open_blob:
+            self.assertEqual(self.client.get(self.url).content.partition(b'\n')[2],
+                             response.content.partition(b'\n')[2])
+            self.assertEqual(self.client.get(self.url, headers={'If-None-Match': response['ETag']}).status_code, 304)
+        open_blob.assert_not_called()
+        # another representation of the same batch is another ETag
+        multipart = self.client.get(self.url, headers={'Accept': 'multipart/mixed'})
+        self.assertNotEqual(multipart['ETag'], response['ETag'])
+
+    def test_bad_ids(self):
+        for query in ('', '?ids=', '?ids=nope', '?ids=' + ','.join(str(uuid.uuid4()) for _ in range(101))):
+            self.assertEqual(self.client.get(f'/api/avatars/images/batch/{query}').status_code, 400, query)
+
+
+@use_test_blob_store
+class ImageVariantsTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.svg = b'<?xml version="1.0"?>\n<!-- drawn by hand -->\n<svg xmlns="http://www.w3.org/2000/svg">\n' \
+                   b'    <circle cx="5"   cy="5" r="4"/>\n    <rect width="2" height="2"/>\n</svg>\n'
+        self.minified = b'<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg"><circle cx="5" cy="5" r="4"/>' \
+                        b'<rect width="2" height="2"/></svg>'
+        self.image = Image.objects.create(type='svg', data=self.svg)
+        self.url = f'/api/avatars/images/{self.image.id}/'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content)
+        response.close()
+        return response, body
+
+    def test_variants_stored_at_ingest(self):
+        self.assertEqual(set(self.image.variants), {'base64', 'svg.min', 'svg.gz'})
+        self.assertEqual(blob_store().read(self.image.variant('svg.min').digest), self.minified)
+        self.assertEqual(gzip.decompress(blob_store().read(self.image.variant('svg.gz').digest)), self.minified)
+        png = Image.objects.create(type='png', data=b'\x89PNG')
+        self.assertEqual(set(png.variants), {'base64'})
+
+    def test_accept_encoding(self):
+        response, body = self.get(Accept_Encoding='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response['ETag'], f'"{self.image.variant("svg.gz").digest}"')
+        self.assertEqual(gzip.decompress(body), self.minified)
+
+        for accept_encoding in ('', 'identity', 'gzip;q=0', 'deflate, gzip; q=0.0'):
+            response, body = self.get(Accept_Encoding=accept_encoding)
+            self.assertFalse(response.has_header('Content-Encoding'), accept_encoding)
+            self.assertEqual(body, self.minified, accept_encoding)
+            self.assertEqual(response['ETag'], f'"{self.image.variant("svg.min").digest}"')
+
+    def test_no_per_request_encoding(self):
+        encodings.clear()
+        self.client.get(f'{self.url}info/')
+        self.client.get(f'{self.url}?html=1')
+        with mock.patch('avatars.encodings.base64.b64encode') as b64encode, \
+                mock.patch('avatars.encodings.gzip.compress') as compress, \
+                mock.patch.object(FileSystemBlobStore, 'open') as open_blob:
+            info = self.client.get(f'{self.url}info/').json()
+            html = self.client.get(f'{self.url}?html=1').content
+        b64encode.assert_not_called()
+        compress.assert_not_called()
+        open_blob.assert_not_called()
+        self.assertEqual(base64.b64decode(info['data_base64']), self.svg)
+        self.assertIn(self.minified, html)
+
+    def test_minify_leaves_text_and_scripts(self):
+        text = b'<svg><text>a</text> <text>b</text></svg>'
+        self.assertEqual(blob_store().read(Image.objects.create(type='svg', data=text).variant('svg.min').digest), text)
+        script = b'<svg><script>// hi\nrun()</script></svg>'
+        self.assertEqual(blob_store().read(Image.objects.create(type='svg', data=script).variant('svg.min').digest),
+                         script)
+        preserved = b'<svg xml:space="preserve"><text>a   b</text>\n</svg>'
+        self.assertEqual(blob_store().read(Image.objects.create(type='svg', data=preserved).variant('svg.min').digest),
+                         preserved)
+
+    def test_digest_url_serves_the_digested_bytes(self):
+        response = self.client.get(f'{self.url}{self.image.digest}/', headers={'Accept-Encoding': 'gzip'})
+        body = b''.join(response.streaming_content)
+        response.close()
+        self.assertEqual(blob_digest(body), self.image.digest)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['ETag'], f'"{self.image.digest}"')
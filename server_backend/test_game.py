@@ -5,18 +5,33 @@ django.setup()
 import asyncio
 import json
 import os
+import sqlite3
+import tempfile
+import threading
 import uuid
+from unittest import mock
 from collections import defaultdict
 
-from django.test import Client, RequestFactory, TestCase
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from channels.layers import get_channel_layer
 from asgiref.testing import ApplicationCommunicator
 from channels.testing import WebsocketCommunicator
 from game.consumers import GameConsumer, socket_session_connect, get_user_from_session, get_socket_from_session, \
     get_session_players_from_user, socketSession, socket_session_player, reset_socket_session, socket_session_disconnect, \
-    get_session_from_player, get_socket_from_player, get_player_sessions_from_room
+    get_session_from_player, get_socket_from_player, get_player_sessions_from_room, get_room_version, room_etag
 from channels.routing import  URLRouter
-from game.models import Game
+from game.models import Game, Player
+from game.heartbeat import IDLE_CLOSE_CODE, reaper
+from game.codecs import CODECS, COMPACT_KEYS, DEFAULT_CODEC, negotiate
+from game.layers import SQLiteChannelLayer
+from game.outbox import outbox
+from game.ratelimit import FRAME_TOO_BIG_CLOSE_CODE, TokenBucket
+from game.sessions import Compactor, SessionRegistry, SQLiteSessionStore
+from game.socketqueue import SLOW_CONSUMER_CLOSE_CODE, SocketQueue, queue_metrics
+from game.roomstate import RoomLog, room_delta
+from game.snapshots import GameSnapshot, snapshots
 from accounts.models import Account
 from django.urls import path
 
@@ -56,7 +71,6 @@ class Utility():
 
     def list_games(self):
         response = self.client.get('/api/game/')
-        response.render()
         return json.loads(response.getvalue())
 
     def get_game_info(self, game_id):
@@ -129,12 +143,88 @@ class GameViewTestCase(TestCase):
         game_list = utility.list_games()
         self.assertEqual(game_list, expected)
 
+    def test_list_games_paged(self):
+        utility = Utility()
+        for number in range(5):
+            Game.objects.create(status='in-progress' if number % 2 else 'waiting')
+        every_game = sorted(Game.objects.values_list('gameId', flat=True))
+
+        seen, url = [], '/api/game/?limit=2'
+        while url:
+            response = utility.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.getvalue())
+            self.assertLessEqual(len(page), 2)
+            seen.extend(game['gameId'] for game in page)
+            link = response.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(seen, every_game)
+
+        waiting = json.loads(utility.client.get('/api/game/?status=waiting&limit=10').getvalue())
+        self.assertEqual([game['gameId'] for game in waiting],
+                         sorted(Game.objects.filter(status='waiting').values_list('gameId', flat=True)))
+        self.assertEqual({game['status'] for game in waiting}, {'waiting'})
+        both = json.loads(utility.client.get('/api/game/?status=waiting,in-progress').getvalue())
+        self.assertEqual(len(both), 5)
+
+        for query in ('status=bogus', 'limit=0', 'limit=many'):
+            self.assertEqual(utility.client.get(f'/api/game/?{query}').status_code, 400)
+
+    def test_list_games_streamed(self):
+        utility = Utility()
+        for _ in range(5):
+            Game.objects.create()
+        with mock.patch('server_backend.pagination.STREAM_CHUNK_SIZE', 2):
+            response = utility.client.get('/api/game/')
+            self.assertTrue(response.streaming)
+            chunks = list(response.streaming_content)
+        # "[", three chunks of rows, "]"
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(b''.join(chunks)), list(Game.objects.values('gameId', 'status')))
+
     def test_get_game_info(self):
         utility = Utility()
         new_game_response = utility.create_game_post()
         game_id = new_game_response['game']['gameId']
         body = utility.get_game_info(game_id)
         self.assertEqual(body['game']['gameId'], game_id)
+        self.assertNotIn('socketSession', body)
+        self.assertNotIn('sessions', body)
+
+    def test_get_game_info_debug_needs_debug_setting(self):
+        utility = Utility()
+        reset_socket_session()
+        game_id = utility.create_game()
+        user_id = utility.create_account('username', 'password', 'email@email.com')
+        player_id = utility.add_player(game_id, user_id)
+        socket_session_connect('session-1', user_id, 'socket-1', game_id)
+        socket_session_player(player_id, 'socket-1', game_id)
+
+        response = utility.client.get(f"/api/game/{game_id}/info/", {'debug': 1})
+        body = json.loads(response.getvalue())
+        self.assertNotIn('sessions', body)
+        self.assertNotIn('session-1', response.getvalue().decode())
+
+    @override_settings(DEBUG=True)
+    def test_get_game_info_debug_is_room_scoped(self):
+        utility = Utility()
+        reset_socket_session()
+        game_id = utility.create_game()
+        other_game_id = utility.create_game()
+        user_id = utility.create_account('username', 'password', 'email@email.com')
+        player_id = utility.add_player(game_id, user_id)
+        other_player_id = utility.add_player(other_game_id, user_id)
+        socket_session_connect('session-1', user_id, 'socket-1', game_id)
+        socket_session_player(player_id, 'socket-1', game_id)
+        socket_session_connect('session-2', user_id, 'socket-2', other_game_id)
+        socket_session_player(other_player_id, 'socket-2', other_game_id)
+
+        response = utility.client.get(f"/api/game/{game_id}/info/", {'debug': 1})
+        body = json.loads(response.getvalue())
+        self.assertEqual(body['sessions'], {
+            str(player_id): {'sessionId': 'session-1', 'userId': str(user_id), 'socketId': 'socket-1'},
+        })
+        self.assertTrue(body['game']['players'][0]['isActive'])
 
     def test_add_player_no_game_404(self):
         utility = Utility()
@@ -253,6 +343,69 @@ class GameViewTestCase(TestCase):
         self.assertEqual(game_player.get('playerId', None), player_id)
         self.assertEqual(game_player, player)
 
+    def test_add_players_bulk(self):
+        utility = Utility()
+        new_game_id = utility.create_game()
+        user_ids = [utility.create_account(f'user{n}', 'password', f'user{n}@email.com') for n in range(3)]
+
+        response = utility.client.post(
+            f"/api/game/{new_game_id}/add/bulk/",
+            data={'players': [
+                {'userId': str(user_ids[0])},
+                {'userId': str(user_ids[1]), 'name': 'Named'},
+                {'userId': str(user_ids[2])},
+            ]},
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+        json_data = json.loads(response.getvalue())
+        self.assertEqual(json_data['message'], '3 players added to the game')
+        self.assertEqual([player['name'] for player in json_data['players']], ['Player 1', 'Named', 'Player 3'])
+        self.assertEqual([player['userId'] for player in json_data['players']], [str(user_id) for user_id in user_ids])
+        self.assertEqual({player['game_identifier'] for player in json_data['players']}, {new_game_id})
+        self.assertCountEqual(json_data['game']['players'], json_data['players'])
+        self.assertEqual(
+            set(Player.objects.filter(game_id=new_game_id).values_list('game_identifier', flat=True)), {new_game_id})
+
+    def test_add_players_bulk_query_count(self):
+        utility = Utility()
+        new_game_id = utility.create_game()
+        user_ids = [utility.create_account(f'user{n}', 'password', f'user{n}@email.com') for n in range(20)]
+
+        def add(user_ids):
+            return utility.client.post(
+                f"/api/game/{new_game_id}/add/bulk/",
+                data={'players': [{'userId': str(user_id)} for user_id in user_ids]},
+                content_type="application/json"
+            )
+
+        with CaptureQueriesContext(connection) as two:
+            self.assertEqual(add(user_ids[:2]).status_code, 201)
+        with CaptureQueriesContext(connection) as eighteen:
+            self.assertEqual(add(user_ids[2:]).status_code, 201)
+        self.assertEqual(len(two), len(eighteen))
+        self.assertEqual(Player.objects.filter(game_id=new_game_id).count(), 20)
+
+    def test_add_players_bulk_errors(self):
+        utility = Utility()
+        new_game_id = utility.create_game()
+        user_id = utility.create_account('username', 'password', 'email@email.com')
+        missing = '937ea451-3db3-4af2-9d93-ee8d4cae4b2c'
+
+        def add(data):
+            return utility.client.post(f"/api/game/{new_game_id}/add/bulk/", data=data, content_type="application/json")
+
+        self.assertEqual(add({'players': []}).status_code, 400)
+        self.assertEqual(add({'players': [{'name': 'no user'}]}).status_code, 400)
+        self.assertEqual(add({'players': [{'userId': 'not-a-uuid'}]}).status_code, 400)
+        response = add({'players': [{'userId': str(user_id)}, {'userId': missing}]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.getvalue())['userIds'], [missing])
+        self.assertEqual(Player.objects.filter(game_id=new_game_id).count(), 0)
+        self.assertEqual(utility.client.post(
+            "/api/game/567890/add/bulk/", data={'players': [{'userId': str(user_id)}]},
+            content_type="application/json").status_code, 404)
+
     def test_socket_session_connect(self):
         utility = Utility()
 
@@ -1191,3 +1344,862 @@ class GameViewTestCase(TestCase):
         self.assertEqual(json_data['error'], f"Invalid player id {player_id_bad} to rename for game {game_id}")
 
         self.assertEqual(response.status_code, 400)
+
+
+class SessionStoreTests:
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def test_rebind_session_to_other_player(self):
+        registry = self.make_store()
+        registry.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        registry.bind_player('player-1', 'socket-1', 'ROOM01')
+        registry.bind_player('player-2', 'socket-1', 'ROOM01')
+
+        self.assertEqual(dict(registry.player_sessions('ROOM01')), {'player-2': 'session-1'})
+        self.assertEqual(registry.session_for_player('player-1', 'ROOM01'), None)
+        self.assertEqual(registry.session_for_player('player-2', 'ROOM01'), 'session-1')
+        self.assertEqual(registry.player_for_session('session-1', 'ROOM01'), 'player-2')
+
+    def test_player_claimed_by_new_session(self):
+        registry = self.make_store()
+        registry.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        registry.bind_player('player-1', 'socket-1', 'ROOM01')
+        registry.connect('session-2', 'user-1', 'socket-2', 'ROOM01')
+        registry.bind_player('player-1', 'socket-2', 'ROOM01')
+
+        # the stale session going away must not unbind the player from the new one
+        self.assertEqual(registry.disconnect('socket-1', 'ROOM01'), 'player-1')
+        self.assertEqual(registry.session_for_player('player-1', 'ROOM01'), 'session-2')
+        self.assertEqual(registry.socket_for_session('session-2'), 'socket-2')
+        self.assertEqual(registry.socket_for_session('session-1'), None)
+        self.assertEqual(registry.user_for_session('session-1'), None)
+
+    def test_disconnect_unknown_socket(self):
+        registry = self.make_store()
+        self.assertEqual(registry.disconnect('socket-1', 'ROOM01'), None)
+        self.assertEqual(dict(registry.player_sessions('ROOM01')), {})
+
+    def test_room_versions(self):
+        registry = self.make_store()
+        self.assertEqual(registry.room_version('ROOM01'), 0)
+        previous, current = registry.bump_room('ROOM01')
+        self.assertEqual((previous, registry.room_version('ROOM01')), (0, current))
+        other_previous, other_current = registry.bump_room('ROOM02')
+        self.assertEqual(other_previous, 0)
+        self.assertEqual(registry.bump_room('ROOM01')[0], current)
+
+        # clearing drops every session, so every room has changed
+        version = registry.room_version('ROOM01')
+        registry.clear()
+        self.assertGreater(registry.room_version('ROOM01'), version)
+        self.assertGreater(registry.room_version('ROOM02'), other_current)
+
+    def test_empty_entries_pruned(self):
+        registry = self.make_store()
+        registry.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        registry.connect('session-2', 'user-1', 'socket-2', 'ROOM01')
+        registry.bind_player('player-1', 'socket-1', 'ROOM01')
+        registry.disconnect('socket-1', 'ROOM01')
+
+        # the user's other session can still take a player
+        registry.bind_player('player-2', 'socket-2', 'ROOM01')
+        self.assertEqual(dict(registry.player_sessions('ROOM01')), {'player-2': 'session-2'})
+
+        registry.disconnect('socket-2', 'ROOM01')
+        self.assertEqual(registry.as_dict(), {})
+        self.assertEqual(len(registry), 0)
+
+    def test_compact(self):
+        registry = self.make_store()
+        registry.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        registry.bind_player('player-1', 'socket-1', 'ROOM01')
+        live = registry.bump_room('ROOM01')[1]
+        idle = registry.bump_room('ROOM02')[1]
+        # a socket reused for a new session leaves the old session behind
+        registry.connect('session-2', 'user-2', 'socket-2', 'ROOM01')
+        registry.connect('session-3', 'user-2', 'socket-2', 'ROOM01')
+
+        self.assertEqual(registry.compact(), 2)
+        self.assertEqual(registry.user_for_session('session-2'), None)
+        self.assertEqual(registry.user_for_session('session-3'), 'user-2')
+        self.assertEqual(registry.room_version('ROOM01'), live)
+        # forgotten rooms never go back to a version they had before a change
+        self.assertEqual(registry.room_version('ROOM02'), idle)
+        self.assertEqual(registry.room_version('ROOM03'), idle)
+        self.assertEqual(registry.bump_room('ROOM02')[0], idle)
+        self.assertEqual(registry.compact(), 1)
+
+
+class SessionRegistryTestCase(SessionStoreTests, TestCase):
+
+    def make_store(self):
+        return SessionRegistry()
+
+
+class SQLiteSessionStoreTestCase(SessionStoreTests, TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'sessions.sqlite3')
+
+    def make_store(self):
+        return SQLiteSessionStore(self.path)
+
+    def test_stores_share_state(self):
+        # two stores on one file stand in for two worker processes
+        worker_1 = self.make_store()
+        worker_2 = self.make_store()
+        worker_1.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        worker_1.bind_player('player-1', 'socket-1', 'ROOM01')
+
+        self.assertEqual(worker_2.user_for_session('session-1'), 'user-1')
+        self.assertEqual(worker_2.player_sessions('ROOM01'), {'player-1': 'session-1'})
+        self.assertEqual(worker_2.session_players('user-1', 'ROOM01'), {'session-1': 'player-1'})
+
+        self.assertEqual(worker_2.disconnect('socket-1', 'ROOM01'), 'player-1')
+        self.assertEqual(worker_1.session_for_player('player-1', 'ROOM01'), None)
+        self.assertEqual(worker_1.socket_for_session('session-1'), None)
+
+        _, version = worker_1.bump_room('ROOM01')
+        self.assertEqual(worker_2.room_version('ROOM01'), version)
+        self.assertEqual(worker_1.epoch, worker_2.epoch)
+
+    def test_dead_process_reaped(self):
+        crashed = self.make_store()
+        alive = self.make_store()
+        crashed.connect('session-1', 'user-1', 'socket-1', 'ROOM01')
+        crashed.bind_player('player-1', 'socket-1', 'ROOM01')
+        alive.connect('session-2', 'user-2', 'socket-2', 'ROOM01')
+        alive.bind_player('player-2', 'socket-2', 'ROOM01')
+        version = alive.room_version('ROOM01')
+
+        # still within process_timeout of its last heartbeat
+        self.assertEqual(alive.heartbeat(), 0)
+        alive._connection().execute('UPDATE store_processes SET last_seen = 0 WHERE process = ?', (crashed.process,))
+        self.assertEqual(alive.heartbeat(), 1)
+
+        self.assertEqual(alive.session_for_socket('socket-1'), None)
+        self.assertEqual(alive.user_for_session('session-1'), None)
+        self.assertEqual(dict(alive.player_sessions('ROOM01')), {'player-2': 'session-2'})
+        self.assertGreater(alive.room_version('ROOM01'), version)
+        self.assertEqual(alive.heartbeat(), 0)
+
+    async def test_run_off_the_event_loop(self):
+        store = self.make_store()
+        self.assertNotEqual(await store.run(threading.get_ident), threading.get_ident())
+        await store.run(store.connect, 'session-1', 'user-1', 'socket-1', 'ROOM01')
+        self.assertEqual(await store.run(store.user_for_session, 'session-1'), 'user-1')
+
+    async def test_heartbeat_runs_while_sockets_are_open(self):
+        store = SQLiteSessionStore(self.path, process_timeout=0.03)
+        compactor = Compactor(store)
+        consumer = mock.Mock()
+        with mock.patch.object(store, 'heartbeat', wraps=store.heartbeat) as heartbeat:
+            # connected, but no sessionUser yet, so the store has no row for it
+            compactor.register(consumer, 0)
+            await asyncio.sleep(0.1)
+            self.assertGreater(heartbeat.call_count, 1)
+            self.assertFalse(compactor._task.done())
+            compactor.unregister(consumer)
+            await asyncio.wait_for(compactor._task, 1)
+
+
+@mock.patch('django.conf.settings.GAME_SNAPSHOT_CACHE', True, create=True)
+class GameSnapshotCacheTestCase(TestCase):
+
+    def setUp(self):
+        snapshots.clear()
+        reset_socket_session()
+        self.utility = Utility()
+        self.game_id = self.utility.create_game()
+        self.user_id = self.utility.create_account('username', 'password', 'email@email.com')
+        self.player_id = self.utility.add_player(self.game_id, self.user_id)
+
+    def test_repeat_info_skips_the_database(self):
+        first = self.utility.get_game_info(self.game_id)
+        with self.assertNumQueries(0):
+            second = self.utility.get_game_info(self.game_id)
+        self.assertEqual(first, second)
+
+    def test_add_and_rename_invalidate(self):
+        self.utility.get_game_info(self.game_id)
+        second_player_id = self.utility.add_player(self.game_id, self.user_id)
+        players = self.utility.get_game_info(self.game_id)['game']['players']
+        self.assertEqual([p['playerId'] for p in players], [self.player_id, second_player_id])
+
+        self.utility.client.post(
+            f"/api/game/{self.game_id}/name/",
+            data={'userId': str(self.user_id), 'playerId': self.player_id, 'name': 'renamed'},
+            content_type="application/json"
+        )
+        players = self.utility.get_game_info(self.game_id)['game']['players']
+        self.assertEqual(players[0]['name'], 'renamed')
+
+    def test_session_changes_patch_is_active(self):
+        self.utility.get_game_info(self.game_id)
+        socket_session_connect('session-1', self.user_id, 'socket-1', self.game_id)
+        socket_session_player(self.player_id, 'socket-1', self.game_id)
+        with self.assertNumQueries(0):
+            players = self.utility.get_game_info(self.game_id)['game']['players']
+        self.assertTrue(players[0]['isActive'])
+
+        socket_session_disconnect('socket-1', self.game_id)
+        with self.assertNumQueries(0):
+            players = self.utility.get_game_info(self.game_id)['game']['players']
+        self.assertFalse(players[0]['isActive'])
+
+    def test_patch_during_encoding_is_not_lost(self):
+        snapshot = GameSnapshot({'gameId': self.game_id, 'players': [{'playerId': 1, 'isActive': False}]}, 1)
+        patch = threading.Thread(target=snapshot.set_active, args=({1},))
+        dumps = json.dumps
+
+        def slow_dumps(value):
+            # another thread patches the snapshot while its body is being encoded
+            encoded = dumps(value)
+            patch.start()
+            patch.join(0.1)
+            return encoded
+
+        with mock.patch('game.snapshots.json.dumps', slow_dumps):
+            snapshot.body()
+        patch.join()
+        self.assertTrue(json.loads(snapshot.body())['game']['players'][0]['isActive'])
+
+    def test_snapshot_built_before_a_change_is_not_used(self):
+        version = get_room_version(self.game_id)
+        snapshots.put(self.game_id, {'gameId': self.game_id, 'status': 'waiting', 'players': []}, version)
+        Game.objects.filter(gameId=self.game_id).get().save()
+        self.assertIsNone(snapshots.get(self.game_id, get_room_version(self.game_id)))
+
+    def test_unchanged_info_is_not_modified(self):
+        response = self.utility.client.get(f"/api/game/{self.game_id}/info/")
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.utility.client.get(f"/api/game/{self.game_id}/info/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        socket_session_connect('session-1', self.user_id, 'socket-1', self.game_id)
+        socket_session_player(self.player_id, 'socket-1', self.game_id)
+        response = self.utility.client.get(f"/api/game/{self.game_id}/info/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        self.utility.add_player(self.game_id, self.user_id)
+        response = self.utility.client.get(f"/api/game/{self.game_id}/info/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['game']['players']), 2)
+
+    def test_missing_game_is_never_not_modified(self):
+        # a room nobody has touched is at version 0, so its ETag is easy to guess
+        response = self.utility.client.get("/api/game/567890/info/", HTTP_IF_NONE_MATCH=room_etag(0))
+        self.assertEqual(response.status_code, 404)
+
+
+class SQLiteChannelLayerTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'channels.sqlite3')
+
+    def make_layer(self, **config):
+        layer = SQLiteChannelLayer(self.path, poll_interval=0.005, **config)
+        self.addCleanup(layer._executor.shutdown)
+        return layer
+
+    async def test_group_send_reaches_other_process(self):
+        # two layers on one file stand in for two worker processes
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer()
+        channel_1 = await worker_1.new_channel()
+        channel_2 = await worker_2.new_channel()
+        await worker_1.group_add('game_ROOM01', channel_1)
+        await worker_2.group_add('game_ROOM01', channel_2)
+
+        await worker_2.group_send('game_ROOM01', {'type': 'broadcast_message', 'data': {'message': 'hello'}})
+
+        for layer, channel in ((worker_1, channel_1), (worker_2, channel_2)):
+            message = await asyncio.wait_for(layer.receive(channel), 2)
+            self.assertEqual(message, {'type': 'broadcast_message', 'data': {'message': 'hello'}})
+        await worker_1.close()
+        await worker_2.close()
+
+    async def test_group_discard(self):
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer()
+        channel_1 = await worker_1.new_channel()
+        await worker_1.group_add('game_ROOM01', channel_1)
+        await worker_1.group_discard('game_ROOM01', channel_1)
+
+        await worker_2.group_send('game_ROOM01', {'type': 'broadcast_message'})
+        await worker_2.send(channel_1, {'type': 'direct'})
+
+        message = await asyncio.wait_for(worker_1.receive(channel_1), 2)
+        self.assertEqual(message, {'type': 'direct'})
+        await worker_1.close()
+
+    async def test_group_capacity(self):
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer(group_options={'game_*': {'capacity': 2}})
+        channel_1 = await worker_1.new_channel()
+        await worker_1.group_add('game_ROOM01', channel_1)
+
+        for number in range(4):
+            await worker_2.group_send('game_ROOM01', {'type': 'broadcast_message', 'number': number})
+
+        received = [(await asyncio.wait_for(worker_1.receive(channel_1), 2))['number'] for _ in range(2)]
+        self.assertEqual(received, [0, 1])
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(worker_1.receive(channel_1), 0.1)
+        await worker_1.close()
+
+    async def test_failed_fan_out_rolls_back(self):
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer()
+        for _ in range(2):
+            await worker_2.group_add('game_ROOM01', await worker_2.new_channel())
+        with sqlite3.connect(self.path) as connection:
+            # the second queued copy fails, after the first was written
+            connection.execute(
+                'CREATE TRIGGER fail_second AFTER INSERT ON layer_messages '
+                'WHEN (SELECT count(*) FROM layer_messages) > 1 BEGIN SELECT RAISE(FAIL, "full"); END')
+
+        with self.assertRaises(sqlite3.Error):
+            await worker_1.group_send('game_ROOM01', {'type': 'broadcast_message'})
+
+        self.assertFalse(worker_1._connection.in_transaction)
+        with sqlite3.connect(self.path) as connection:
+            (queued,) = connection.execute('SELECT count(*) FROM layer_messages').fetchone()
+        self.assertEqual(queued, 0)
+        await worker_1.close()
+        await worker_2.close()
+
+    async def test_group_expiry(self):
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer(group_options={'game_*': {'expiry': -1}})
+        channel_1 = await worker_1.new_channel()
+        await worker_1.group_add('game_ROOM01', channel_1)
+        await worker_1.group_add('lobby', channel_1)
+
+        await worker_2.group_send('game_ROOM01', {'type': 'expired'})
+        await worker_2.group_send('lobby', {'type': 'fresh'})
+
+        message = await asyncio.wait_for(worker_1.receive(channel_1), 2)
+        self.assertEqual(message, {'type': 'fresh'})
+        await worker_1.close()
+
+    async def test_bytes_survive_the_database(self):
+        worker_1 = self.make_layer()
+        worker_2 = self.make_layer()
+        channel_1 = await worker_1.new_channel()
+
+        await worker_2.send(channel_1, {'type': 'binary', 'bytes': b'\x00\x01\xff'})
+
+        message = await asyncio.wait_for(worker_1.receive(channel_1), 2)
+        self.assertEqual(message['bytes'], b'\x00\x01\xff')
+        await worker_1.close()
+
+
+class BroadcastOutboxTestCase(TestCase):
+
+    async def test_add_player_broadcast_flushed_on_loop(self):
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(username='username', password='password', email='email@email.com')
+        await outbox.flush()  # the game's own creation delta goes out before anyone has joined
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        with mock.patch.object(outbox, 'flush', wraps=outbox.flush) as flush:
+            response = await self.async_client.post(
+                f"/api/game/{game.gameId}/add/",
+                data={'userId': str(account.userId)},
+                content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 201)
+            delta = await communicator.receive_json_from(2)
+            message = await communicator.receive_json_from(2)
+
+        self.assertTrue(flush.called)
+        self.assertEqual(delta['type'], 'room_delta')
+        self.assertEqual(message['type'], 'add_player')
+        self.assertEqual(message['name'], 'Player 1')
+        await communicator.disconnect()
+
+    async def test_add_players_broadcast_once(self):
+        game = await Game.objects.acreate()
+        accounts = [await Account.objects.acreate(username=f'user{n}', password='password', email=f'user{n}@email.com')
+                    for n in range(3)]
+        await outbox.flush()
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        response = await self.async_client.post(
+            f"/api/game/{game.gameId}/add/bulk/",
+            data={'players': [{'userId': str(account.userId)} for account in accounts]},
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+        delta = await communicator.receive_json_from(2)
+        message = await communicator.receive_json_from(2)
+        self.assertTrue(await communicator.receive_nothing(0.1))
+
+        self.assertEqual(delta['type'], 'room_delta')
+        self.assertEqual([change['player']['name'] for change in delta['changes']], ['Player 1', 'Player 2', 'Player 3'])
+        self.assertEqual(message['type'], 'add_players')
+        self.assertEqual(len(message['players']), 3)
+        await communicator.disconnect()
+
+
+async def read_streamed(response):
+    """ the JSON body of a StreamingHttpResponse served to the async client """
+    return json.loads(b''.join([chunk async for chunk in response.streaming_content]))
+
+
+class AsyncViewsTestCase(TestCase):
+
+    async def test_async_views_match_sync(self):
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(username='username', password='password', email='email@email.com')
+
+        response = await self.async_client.post(
+            f"/api/game/async/{game.gameId}/add/", data={'userId': str(account.userId)}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        added = json.loads(response.content)
+        self.assertEqual(added['message'], 'Player 1 added to the game')
+        self.assertEqual(added['game']['players'], [added['player']])
+        player_id = added['player']['playerId']
+
+        sync_info = await self.async_client.get(f"/api/game/{game.gameId}/info/")
+        async_info = await self.async_client.get(f"/api/game/async/{game.gameId}/info/")
+        self.assertEqual(async_info.status_code, 200)
+        self.assertEqual(json.loads(async_info.content), json.loads(sync_info.content))
+        not_modified = await self.async_client.get(
+            f"/api/game/async/{game.gameId}/info/", headers={'If-None-Match': async_info['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        missing = await self.async_client.get("/api/game/async/567890/info/")
+        self.assertEqual(missing.status_code, 404)
+        missing = await self.async_client.get(
+            "/api/game/async/567890/info/", headers={'If-None-Match': room_etag(0)})
+        self.assertEqual(missing.status_code, 404)
+
+        response = await self.async_client.post(
+            f"/api/game/async/{game.gameId}/name/",
+            data={'userId': str(account.userId), 'playerId': player_id, 'name': 'renamed'},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['game']['players'][0]['name'], 'renamed')
+        response = await self.async_client.post(
+            f"/api/game/async/{game.gameId}/name/",
+            data={'userId': str(uuid.uuid4()), 'playerId': player_id, 'name': 'stolen'},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+
+        socket_session_connect('session-1', str(account.userId), 'socket-1', game.gameId)
+        responses = [
+            await self.async_client.post(
+                f"/api/game/{prefix}{game.gameId}/claim/", data={'sessionId': 'session-1'}, content_type="application/json")
+            for prefix in ('', 'async/')
+        ]
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(json.loads(responses[1].content), json.loads(responses[0].content))
+        self.assertEqual(json.loads(responses[1].content)['player']['playerId'], player_id)
+        socket_session_disconnect('socket-1', game.gameId)
+
+        sync_games = await self.async_client.get("/api/game/")
+        async_games = await self.async_client.get("/api/game/async/")
+        self.assertEqual(await read_streamed(async_games), await read_streamed(sync_games))
+        self.assertEqual((await self.async_client.post("/api/game/async/")).status_code, 405)
+
+        await outbox.flush()
+
+    async def test_session_lookups_off_the_event_loop(self):
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(username='username', password='password', email='email@email.com')
+        player = await Player.objects.acreate(game=game, name='first', userId=account)
+        snapshots.clear()
+        loop_thread = threading.get_ident()
+        threads = []
+        player_sessions = socketSession.player_sessions
+
+        def record_thread(room_name):
+            threads.append(threading.get_ident())
+            return player_sessions(room_name)
+
+        async def run(function, *args):
+            # stands in for a store whose lookups block, as the sqlite one does
+            return await asyncio.to_thread(function, *args)
+
+        with mock.patch.object(socketSession, 'player_sessions', record_thread), \
+                mock.patch.object(socketSession, 'run', run):
+            response = await self.async_client.get(f"/api/game/async/{game.gameId}/info/")
+            self.assertEqual(response.status_code, 200)
+            response = await self.async_client.post(
+                f"/api/game/async/{game.gameId}/name/",
+                data={'userId': str(account.userId), 'playerId': str(player.playerId), 'name': 'renamed'},
+                content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+        await outbox.flush()
+
+    async def test_async_add_player_form_data(self):
+        # the sync view takes form posts through DRF's parsers, so the async one does too
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(username='username', password='password', email='email@email.com')
+        response = await self.async_client.post(
+            f"/api/game/async/{game.gameId}/add/", data={'userId': str(account.userId), 'name': 'form'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)['player']['name'], 'form')
+        await outbox.flush()
+
+
+class RoomStateTestCase(TestCase):
+
+    async def test_deltas_and_resync(self):
+        game = await Game.objects.acreate()
+        account = await Account.objects.acreate(username='username', password='password', email='email@email.com')
+        await outbox.flush()  # the game's own creation delta goes out before anyone has joined
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'type': 'resync'})
+        snapshot = await communicator.receive_json_from(2)
+        self.assertEqual(snapshot['type'], 'room_snapshot')
+        self.assertEqual(snapshot['game']['players'], [])
+
+        response = await self.async_client.post(
+            f"/api/game/{game.gameId}/add/",
+            data={'userId': str(account.userId), 'name': 'first'},
+            content_type="application/json"
+        )
+        player_id = json.loads(response.content)['player']['playerId']
+        added = await communicator.receive_json_from(2)
+        await communicator.receive_json_from(2)  # legacy add_player
+        self.assertEqual(added['previous'], snapshot['version'])
+        self.assertEqual(added['changes'][0]['op'], 'player_added')
+        self.assertEqual(added['changes'][0]['player']['name'], 'first')
+
+        await communicator.send_json_to({'type': 'sessionUser', 'sessionId': 'session-1', 'userId': str(account.userId)})
+        await communicator.receive_json_from(2)
+        await communicator.send_json_to({'type': 'sessionPlayer', 'playerId': player_id})
+        messages = [await communicator.receive_json_from(2) for _ in range(2)]
+        active = next(m for m in messages if m['type'] == 'room_delta')
+        self.assertEqual(active['previous'], added['version'])
+        self.assertEqual(active['changes'], [{'op': 'player_active', 'playerId': player_id, 'isActive': True}])
+
+        # a client that only saw the snapshot is replayed forward
+        await communicator.send_json_to({'type': 'resync', 'version': snapshot['version']})
+        replayed = [await communicator.receive_json_from(2) for _ in range(2)]
+        self.assertEqual(replayed, [added, active])
+
+        # one the log cannot help is sent the game again
+        await communicator.send_json_to({'type': 'resync', 'version': -1})
+        snapshot = await communicator.receive_json_from(2)
+        self.assertEqual(snapshot['type'], 'room_snapshot')
+        self.assertEqual(snapshot['version'], active['version'])
+        self.assertEqual(snapshot['game']['players'][0]['isActive'], True)
+        await communicator.disconnect()
+
+    async def test_session_deltas_sent_from_the_loop(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        loop_thread = threading.get_ident()
+        threads = []
+        post = outbox.post
+
+        def record_thread(group_name, message):
+            threads.append(threading.get_ident())
+            post(group_name, message)
+
+        async def run(function, *args):
+            # a store with a thread of its own, as the sqlite one has
+            return await asyncio.to_thread(function, *args)
+
+        with mock.patch.object(outbox, 'post', record_thread), mock.patch.object(socketSession, 'run', run):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'sessionUser', 'sessionId': 'session-1', 'userId': 'user-1'})
+            await communicator.receive_json_from(2)
+            await communicator.send_json_to({'type': 'sessionPlayer', 'playerId': 'player-1'})
+            messages = [await communicator.receive_json_from(2) for _ in range(2)]
+            await communicator.disconnect()
+        self.assertIn('room_delta', [message['type'] for message in messages])
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(set(threads), {loop_thread})
+        await outbox.flush()
+
+    def test_delta_recorded_once(self):
+        log = RoomLog()
+        delta = room_delta('ROOM01', 1, 2, [{'op': 'status', 'status': 'started'}])
+        log.record(delta)
+        # every other socket in the room hands the log its own copy of the delta
+        for _ in range(3):
+            log.record(json.loads(json.dumps(delta)))
+        self.assertIs(log.since('ROOM01', 1, 2)[0], delta)
+
+
+class CodecTestCase(TestCase):
+
+    def test_negotiate(self):
+        self.assertIs(negotiate([]), DEFAULT_CODEC)
+        self.assertIs(negotiate(['chat', 'game.compact-json']), CODECS['game.compact-json'])
+
+    def test_round_trip(self):
+        message = {'type': 'room_delta', 'gameId': 'ROOM01', 'changes': [
+            {'op': 'player_added', 'player': {'playerId': 'p', 'name': 'first', 'isActive': False}}]}
+        for codec in [DEFAULT_CODEC, *CODECS.values()]:
+            frame = codec.encode(message)
+            self.assertEqual(codec.decode(frame), message)
+        compact = CODECS['game.compact-json'].encode(message)
+        self.assertLess(len(compact), len(DEFAULT_CODEC.encode(message)))
+        self.assertTrue(compact.startswith('{"t":"room_delta"'))
+
+    def test_payload_keys_kept(self):
+        codec = CODECS['game.compact-json']
+        message = {'type': 'broadcast_message', 'data': {'message': 'hello', 't': 'user data'}}
+        self.assertEqual(codec.encode(message), '{"t":"broadcast_message","d":{"message":"hello","t":"user data"}}')
+        self.assertEqual(codec.decode('{"t":"clientMessage","m":{"s":1,"p":2}}'),
+                         {'type': 'clientMessage', 'message': {'s': 1, 'p': 2}})
+
+    async def test_compact_subprotocol(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/", subprotocols=['game.compact-json'])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, 'game.compact-json')
+
+        await communicator.send_to(text_data='{"t":"resync"}')
+        snapshot = json.loads(await communicator.receive_from(2))
+        self.assertEqual(snapshot['t'], 'room_snapshot')
+        self.assertEqual(snapshot[COMPACT_KEYS['game']]['players'], [])
+        await communicator.disconnect()
+
+    async def test_broadcast_encoded_once(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        communicators = []
+        for subprotocols in ([], [], ['game.compact-json']):
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/", subprotocols=subprotocols)
+            await communicator.connect()
+            communicators.append(communicator)
+
+        with mock.patch.object(DEFAULT_CODEC, 'encode', wraps=DEFAULT_CODEC.encode) as encode:
+            await communicators[0].send_json_to({'type': 'clientMessage', 'message': 'hello'})
+            received = [await communicator.receive_from(2) for communicator in communicators]
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(received[:2], ['{"message": "hello received"}'] * 2)
+        self.assertEqual(received[2], '{"m":"hello received"}')
+        for communicator in communicators:
+            await communicator.disconnect()
+
+
+class SocketQueueTestCase(TestCase):
+
+    async def test_coalesced_into_batch(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        with mock.patch('django.conf.settings.GAME_SOCKET_QUEUE', {'COALESCE_WINDOW': 0.05}, create=True):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+            await communicator.connect()
+        for number in range(3):
+            await communicator.send_json_to({'type': 'clientMessage', 'message': str(number)})
+        batch = await communicator.receive_json_from(2)
+        self.assertEqual(batch, {'type': 'batch', 'messages': [
+            {'message': '0 received'}, {'message': '1 received'}, {'message': '2 received'}]})
+        await communicator.disconnect()
+
+    async def test_overflow_drops(self):
+        sent, release = [], asyncio.Event()
+
+        async def send(**frame):
+            await release.wait()
+            sent.append(frame['text_data'])
+
+        queue = SocketQueue(send, None, DEFAULT_CODEC, max_size=2)
+        self.assertTrue(queue.put('1'))
+        await asyncio.sleep(0)  # the writer takes '1' and blocks on it
+        self.assertTrue(queue.put('2'))
+        self.assertTrue(queue.put('3'))
+        self.assertFalse(queue.put('4'))
+        self.assertEqual((len(queue), queue.dropped), (2, 1))
+        self.assertGreaterEqual(queue_metrics()['dropped'], 1)
+
+        release.set()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual(sent, ['1', '2', '3'])
+        queue.stop()
+
+    async def test_overflow_disconnects(self):
+        closed = []
+
+        async def send(**frame):
+            await asyncio.Event().wait()
+
+        async def close(code=None):
+            closed.append(code)
+
+        queue = SocketQueue(send, close, DEFAULT_CODEC, max_size=1, overflow='disconnect')
+        queue.put('1')
+        await asyncio.sleep(0)
+        queue.put('2')
+        self.assertFalse(queue.put('3'))
+        await asyncio.sleep(0)
+        self.assertEqual(closed, [SLOW_CONSUMER_CLOSE_CODE])
+        self.assertFalse(queue.put('4'))
+        queue.stop()
+
+    def test_metrics_view(self):
+        response = Client().get('/api/game/metrics/sockets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('deepest', json.loads(response.content))
+
+
+class SocketLimitsTestCase(TestCase):
+
+    async def connect(self, game, limits):
+        with mock.patch('django.conf.settings.GAME_SOCKET_LIMITS', limits, create=True):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+            connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_oversized_frame_closes(self):
+        game = await Game.objects.acreate()
+        communicator = await self.connect(game, {'MAX_FRAME_SIZE': 64})
+        with mock.patch.object(GameConsumer, 'receive') as receive:
+            await communicator.send_to(text_data='{"type": "clientMessage", "message": "%s"}' % ('x' * 64))
+            closed = await communicator.receive_output(2)
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': FRAME_TOO_BIG_CLOSE_CODE})
+        receive.assert_not_called()
+
+    async def test_socket_rate_limit(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        communicator = await self.connect(game, {'SOCKET_RATE': 0.01, 'SOCKET_BURST': 2})
+        for number in range(5):
+            await communicator.send_json_to({'type': 'clientMessage', 'message': str(number)})
+        received = [await communicator.receive_json_from(2) for _ in range(3)]
+        # the echoes go round the channel layer, the notice straight to the socket
+        self.assertCountEqual(received, [
+            {'message': '0 received'}, {'message': '1 received'}, {'type': 'rate_limited', 'scope': 'socket'}])
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        await communicator.disconnect()
+
+    async def test_room_rate_limit_is_shared(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        limits = {'ROOM_RATE': 0.01, 'ROOM_BURST': 1}
+        first = await self.connect(game, limits)
+        second = await self.connect(game, limits)
+        await first.send_json_to({'type': 'clientMessage', 'message': 'first'})
+        self.assertEqual(await second.receive_json_from(2), {'message': 'first received'})
+        self.assertEqual(await first.receive_json_from(2), {'message': 'first received'})
+
+        await second.send_json_to({'type': 'clientMessage', 'message': 'second'})
+        self.assertEqual(await second.receive_json_from(2), {'type': 'rate_limited', 'scope': 'room'})
+        self.assertTrue(await first.receive_nothing(0.1))
+        await first.disconnect()
+        await second.disconnect()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual([bucket.take() for _ in range(3)], [True, True, False])
+        bucket.updated -= 0.1
+        self.assertTrue(bucket.take())
+        self.assertTrue(all(TokenBucket(rate=0, burst=1).take() for _ in range(10)))
+
+
+class HeartbeatTestCase(TestCase):
+    heartbeat = {'PING_INTERVAL': 0.05, 'IDLE_TIMEOUT': 0.3, 'REAP_INTERVAL': 0.05}
+
+    async def connect(self, game):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/game/{game.gameId}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_ping_pong(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        with mock.patch('django.conf.settings.GAME_SOCKET_HEARTBEAT', {**self.heartbeat, 'IDLE_TIMEOUT': 0}, create=True):
+            communicator = await self.connect(game)
+            await communicator.send_json_to({'type': 'ping'})
+            self.assertEqual(await communicator.receive_json_from(2), {'type': 'pong'})
+            # a quiet socket is pinged by the server
+            self.assertEqual(await communicator.receive_json_from(2), {'type': 'ping'})
+            await communicator.disconnect()
+
+    async def test_silent_socket_is_evicted(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        evicted = reaper.evicted
+        with mock.patch('django.conf.settings.GAME_SOCKET_HEARTBEAT', self.heartbeat, create=True):
+            silent = await self.connect(game)
+            watcher = await self.connect(game)
+
+            async def keep_alive():
+                while True:
+                    await watcher.send_json_to({'type': 'pong'})
+                    await asyncio.sleep(0.05)
+
+            pinging = asyncio.ensure_future(keep_alive())
+            # answering once shows the client speaks the heartbeat
+            await silent.send_json_to({'type': 'pong'})
+            await silent.send_json_to({'type': 'sessionUser', 'sessionId': 'session-1', 'userId': 'user-1'})
+            await silent.send_json_to({'type': 'sessionPlayer', 'playerId': 'player-1'})
+            while (await watcher.receive_json_from(2))['type'] != 'handle_session_player':
+                pass
+            self.assertEqual(dict(get_player_sessions_from_room(str(game.gameId))), {'player-1': 'session-1'})
+
+            received = []
+            while True:
+                output = await silent.receive_output(2)
+                if output['type'] == 'websocket.close':
+                    break
+                received.append(json.loads(output['text'])['type'])
+            pinging.cancel()
+
+        self.assertEqual(output['code'], IDLE_CLOSE_CODE)
+        self.assertIn('ping', received)
+        self.assertEqual(reaper.evicted, evicted + 1)
+        self.assertEqual(dict(get_player_sessions_from_room(str(game.gameId))), {})
+        self.assertIsNone(get_socket_from_session('session-1'))
+
+        messages = []
+        while not any(message.get('type') == 'player_disconnected' for message in messages):
+            messages.append(await watcher.receive_json_from(2))
+        self.assertEqual(messages[-1]['data']['playerId'], 'player-1')
+
+        # the socket closing afterwards does not announce the player again
+        await silent.disconnect()
+        await watcher.send_json_to({'type': 'ping'})
+        while (message := await watcher.receive_json_from(2))['type'] != 'pong':
+            self.assertNotEqual(message['type'], 'player_disconnected')
+        await watcher.disconnect()
+
+    async def test_socket_that_never_pongs_is_kept(self):
+        game = await Game.objects.acreate()
+        await outbox.flush()
+        evicted = reaper.evicted
+        with mock.patch('django.conf.settings.GAME_SOCKET_HEARTBEAT', self.heartbeat, create=True):
+            communicator = await self.connect(game)
+            # pinged, but the client predates the heartbeat and never answers
+            self.assertEqual(await communicator.receive_json_from(2), {'type': 'ping'})
+            await asyncio.sleep(self.heartbeat['IDLE_TIMEOUT'] * 2)
+            self.assertEqual(reaper.evicted, evicted)
+            await communicator.send_json_to({'type': 'ping'})
+            while (await communicator.receive_json_from(2))['type'] != 'pong':
+                pass
+            await communicator.disconnect()